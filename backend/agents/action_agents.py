@@ -1,4 +1,5 @@
 from langchain_google_genai import ChatGoogleGenerativeAI
+from core.llm_scheduler import scheduled
 from typing import Dict, List
 from twilio.rest import Client
 import json
@@ -10,7 +11,8 @@ class StaffReallocationAgent:
     def __init__(self, gemini_api_key: str):
         self.llm = ChatGoogleGenerativeAI(
             model="gemini-2.0-flash-lite",
-            google_api_key=gemini_api_key
+            google_api_key=gemini_api_key,
+            callbacks=scheduled("background")
         )
     
     async def draft_reallocation_plan(self, recommendation: Dict, current_staff: Dict) -> Dict:
@@ -59,7 +61,8 @@ class SupplyChainAgent:
     def __init__(self, gemini_api_key: str):
         self.llm = ChatGoogleGenerativeAI(
             model="gemini-2.0-flash-lite",
-            google_api_key=gemini_api_key
+            google_api_key=gemini_api_key,
+            callbacks=scheduled("background")
         )
     
     async def draft_purchase_order(self, recommendation: Dict, inventory: List[Dict]) -> Dict:
@@ -102,7 +105,8 @@ class PatientAdvisoryAgent:
     def __init__(self, gemini_api_key: str, twilio_client: Client = None):
         self.llm = ChatGoogleGenerativeAI(
             model="gemini-2.0-flash-lite",
-            google_api_key=gemini_api_key
+            google_api_key=gemini_api_key,
+            callbacks=scheduled("background")
         )
         self.twilio = twilio_client
     
@@ -1,4 +1,5 @@
 from langchain_google_genai import ChatGoogleGenerativeAI
+from core.llm_scheduler import scheduled
 from langchain.prompts import ChatPromptTemplate
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain.tools import Tool
@@ -13,6 +14,7 @@ class OrchestratorAgent:
         self.llm = ChatGoogleGenerativeAI(
             model="gemini-2.0-flash-lite",
             google_api_key=gemini_api_key,
+            callbacks=scheduled("background"),
             temperature=0.5  # Balanced creativity and consistency
         )
         
@@ -1,4 +1,5 @@
 from langchain_google_genai import ChatGoogleGenerativeAI
+from core.llm_scheduler import scheduled
 from langchain.prompts import ChatPromptTemplate
 from prophet import Prophet
 import pandas as pd
@@ -14,6 +15,7 @@ class SentinelAgent:
         self.llm = ChatGoogleGenerativeAI(
             model="gemini-2.0-flash-lite",
             google_api_key=gemini_api_key,
+            callbacks=scheduled("background"),
             temperature=0.3  # Lower temperature for factual analysis
         )
         
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+import json
 
 from core.database import get_db
 from models.hospital import Bed, Staff, Inventory
@@ -11,6 +13,7 @@ from models.actions import Recommendation
 from agents import ArogyaSwarmGraph
 from services.cost_calculator import CostCalculator
 from services.rag_service import get_rag_service
+from core.llm_scheduler import get_scheduler
 
 router = APIRouter()
 
@@ -22,11 +25,16 @@ class CrisisSimulationRequest(BaseModel):
     crisis_type: str  # 'pollution', 'dengue', 'trauma'
 
 class RagQueryRequest(BaseModel):
-    question: str
+    question: str = Field(..., min_length=1)
     context: Optional[dict] = None
+    top_k: int = Field(3, ge=1, le=10)
+    weights: Optional[Dict[str, float]] = None  # rank fusion weights: {"lexical": ..., "vector": ...}
+    filters: Optional[Dict[str, Any]] = None  # metadata containment filter, e.g. {"category": "icu"}
+    deadline: Optional[float] = None  # seconds to wait for the LLM before answering extractively
 
 class RagIngestRequest(BaseModel):
     documents: List[dict]
+    prune: bool = False
 
 # ============================================
 # HOSPITAL STATE ENDPOINTS
@@ -369,19 +377,59 @@ async def query_rag_chatbot(
 ):
     """
     Query the RAG chatbot with a question
-    Returns AI-generated answer with source documents
+    Returns AI-generated answer with source documents; `filters` restricts retrieval by document metadata
     """
     try:
         rag_service = get_rag_service()
-        result = rag_service.query(
+        result = await rag_service.aquery(
             question=request.question,
             context=request.context,
-            top_k=3
+            top_k=request.top_k,
+            weights=request.weights,
+            filters=request.filters,
+            deadline=request.deadline
         )
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"RAG query failed: {str(e)}")
 
+@router.post("/rag/query/stream")
+async def stream_rag_chatbot(
+    request: RagQueryRequest,
+    http_request: Request
+):
+    """
+    Query the RAG chatbot and stream the answer as Server-Sent Events
+    Sends a `sources` event first, then `token` events, then `done` (or `error`);
+    a hedged answer (deadline missed) is followed by a `late_answer` event
+    """
+    rag_service = get_rag_service()
+    
+    async def event_stream():
+        events = rag_service.astream_query(
+            question=request.question,
+            context=request.context,
+            top_k=request.top_k,
+            weights=request.weights,
+            filters=request.filters,
+            deadline=request.deadline
+        )
+        try:
+            async for event in events:
+                # Stop generating (and paying for tokens) once the client is gone
+                if await http_request.is_disconnected():
+                    break
+                name = event.pop("event")
+                yield f"event: {name}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            await events.aclose()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/rag/ingest")
 async def ingest_rag_documents(
     request: RagIngestRequest,
@@ -390,6 +438,7 @@ async def ingest_rag_documents(
     """
     Ingest new documents into RAG system
     Requires documents with 'id', 'content', 'metadata' fields
+    Unchanged documents are skipped; `prune` deletes documents missing from the request
     """
     try:
         rag_service = get_rag_service()
@@ -398,14 +447,15 @@ async def ingest_rag_documents(
         if len(request.documents) > 10:
             background_tasks.add_task(
                 rag_service.ingest_documents,
-                request.documents
+                request.documents,
+                request.prune
             )
             return {
                 "status": "processing",
                 "message": f"Ingesting {len(request.documents)} documents in background"
             }
         else:
-            result = rag_service.ingest_documents(request.documents)
+            result = rag_service.ingest_documents(request.documents, prune=request.prune)
             return result
             
     except Exception as e:
@@ -429,6 +479,13 @@ async def get_rag_status():
             "error": str(e)
         }
 
+@router.get("/llm/scheduler")
+async def get_llm_scheduler_status():
+    """
+    Queue depth per priority, grants, average waits and remaining budget of the shared Gemini call scheduler
+    """
+    return get_scheduler().stats()
+
 # ==================== PHASE 1: DYNAMIC MULTILINGUAL SUPPORT ====================
 from services.translation_service import TranslationService
 import logging
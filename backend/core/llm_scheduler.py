@@ -0,0 +1,76 @@
+import os
+import sys
+from typing import Any, Dict, List
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+try:
+    from google.api_core.exceptions import ResourceExhausted
+except ImportError:  # installed with langchain-google-genai
+    ResourceExhausted = None
+
+# The scheduler lives in the rag package so rag.vertex and the agents share one instance
+RAG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "rag")
+if RAG_DIR not in sys.path:
+    sys.path.insert(0, RAG_DIR)
+
+from rag.scheduler import get_scheduler  # noqa: E402
+from rag.prompt import estimate_tokens  # noqa: E402
+
+# Output tokens reserved per agent call until actual usage is known
+AGENT_MAX_OUTPUT_TOKENS = 1024
+
+
+class SchedulerCallback(AsyncCallbackHandler):
+    """Makes LangChain chat model calls wait for a permit from the shared LLM scheduler
+
+    LangChain awaits on_chat_model_start before sending the request, so the
+    call is held in the scheduler's priority queue until the request and token
+    budgets allow it. Actual token usage is settled when the call ends.
+    """
+
+    def __init__(self, priority: str = "background", max_output_tokens: int = AGENT_MAX_OUTPUT_TOKENS):
+        self.priority = priority
+        self.max_output_tokens = max_output_tokens
+        self._permits: Dict[UUID, Any] = {}
+
+    async def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        prompt_tokens = sum(estimate_tokens(str(m.content)) for batch in messages for m in batch)
+        self._permits[run_id] = await get_scheduler().aacquire(prompt_tokens + self.max_output_tokens, self.priority)
+
+    async def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        permit = self._permits.pop(run_id, None)
+        if permit is not None:
+            permit.settle(_total_tokens(response))
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        permit = self._permits.pop(run_id, None)
+        if permit is not None:
+            # a failed call consumed no tokens; return its estimate to the budget
+            permit.settle(0)
+        if _rate_limited(error):
+            get_scheduler().penalize(5)
+
+
+def scheduled(priority: str = "background") -> List[SchedulerCallback]:
+    """Callbacks for a ChatGoogleGenerativeAI instance: `ChatGoogleGenerativeAI(..., callbacks=scheduled())`"""
+    return [SchedulerCallback(priority)]
+
+
+def _rate_limited(error: BaseException) -> bool:
+    """True if `error`, or an exception it was raised from, is Gemini's 429 (ResourceExhausted)"""
+    while error is not None:
+        if ResourceExhausted is not None and isinstance(error, ResourceExhausted):
+            return True
+        error = error.__cause__
+    return False
+
+
+def _total_tokens(response: Any):
+    for generations in getattr(response, "generations", None) or []:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("total_tokens")
+    return None
@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from sqlalchemy.orm import Session
 import asyncio
+import json
 import os
 from typing import List
 from datetime import datetime
@@ -11,7 +12,7 @@ from core.config import settings
 from core.database import engine, get_db, Base
 from core.error_handlers import setup_error_handlers
 from core.logging_config import setup_logging
-from api.routes import router
+from api.routes import router, RagQueryRequest
 from api.websocket import ConnectionManager
 from agents import ArogyaSwarmGraph
 from services.weather_service import WeatherService
@@ -61,6 +62,10 @@ async def lifespan(app: FastAPI):
     # Shutdown: Cancel monitoring
     # if agent_task:
     #     agent_task.cancel()
+    
+    # Shutdown: Release RAG database connections
+    if settings.ENABLE_RAG_CHATBOT:
+        await get_rag_service().ashutdown()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -101,6 +106,66 @@ async def websocket_endpoint(websocket: WebSocket):
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
+# WebSocket endpoint for streaming RAG answers
+@app.websocket("/ws/rag")
+async def rag_websocket_endpoint(websocket: WebSocket):
+    """Receive {"question", "context", "top_k", "weights", "filters", "deadline", "id"} messages; stream back RAG events as JSON
+    
+    Each question streams in its own task, so a hedged answer waiting on its
+    `late_answer` doesn't hold up the next question; events carry the
+    message's `id` (if given) to tell concurrent answers apart. When the LLM
+    misses the deadline the extractive answer is sent as `done`, and the
+    generated answer follows later as a `late_answer` event. Malformed
+    messages get an `error` event instead of closing the socket.
+    """
+    await websocket.accept()
+    rag_service = get_rag_service()
+    send_lock = asyncio.Lock()
+    tasks = set()
+    
+    async def send(event: dict):
+        async with send_lock:
+            await websocket.send_json(event)
+    
+    async def answer(request: RagQueryRequest, message_id):
+        events = rag_service.astream_query(
+            question=request.question,
+            context=request.context,
+            top_k=request.top_k,
+            weights=request.weights,
+            filters=request.filters,
+            deadline=request.deadline
+        )
+        try:
+            async for event in events:
+                await send(event if message_id is None else dict(event, id=message_id))
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # client went away mid-answer
+        finally:
+            await events.aclose()
+    
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            message_id = None
+            try:
+                message = json.loads(raw)
+                if not isinstance(message, dict):
+                    raise TypeError("message must be a JSON object")
+                message_id = message.get("id")
+                request = RagQueryRequest(**message)
+            except (ValueError, KeyError, TypeError) as e:
+                await send({"event": "error", "error": f"Invalid RAG query: {e}", "id": message_id})
+                continue
+            task = asyncio.create_task(answer(request, message_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+
 async def broadcast_aqi_updates():
     """Background task: Broadcast real-time AQI updates every 15 seconds"""
     aqi_service = AQIService(settings.OPENWEATHERMAP_API_KEY)
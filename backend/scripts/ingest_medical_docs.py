@@ -21,9 +21,21 @@ except ImportError:
     print("Warning: python-dotenv not installed")
 
 import json
+import argparse
 from rag.ingest import queue_documents, process_queue
+from rag.chunking import CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_STRATEGY
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ingest medical documents into the RAG knowledge base")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Max characters per chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP, help="Characters carried over between chunks")
+    parser.add_argument("--chunk-strategy", choices=["sentence", "heading"], default=CHUNK_STRATEGY,
+                        help="Split on sentence boundaries or on section headings")
+    parser.add_argument("--workers", type=int, default=1, help="Queue worker threads")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     print("=" * 60)
     print("RAG Medical Documents Ingestion Script")
     print("=" * 60)
@@ -54,7 +66,12 @@ def main():
         # Process queue (create embeddings and insert into database)
         print("🔄 Processing queue (creating embeddings and inserting into database)...")
         print("   This may take a few minutes...")
-        process_queue()
+        process_queue(
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            chunk_strategy=args.chunk_strategy,
+            workers=args.workers
+        )
         print()
         print("✓ All documents processed successfully!")
         print()
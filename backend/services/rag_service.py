@@ -4,9 +4,14 @@ Provides medical document search and question answering capabilities
 """
 import sys
 import os
-import re
-import math
-from typing import List, Dict, Any, Optional
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from functools import partial
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Any, NamedTuple, Optional, Tuple
 
 # Load environment variables from parent directories
 try:
@@ -34,21 +39,62 @@ RAG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__)
 if RAG_DIR not in sys.path:
     sys.path.insert(0, RAG_DIR)
 
-try:
-    from rag.vertex import embed_text, generate_text
-    from rag.db import init_db, get_all_documents, search_candidates_by_keyword, insert_document
-    from rag.cache import get_cached_embedding, set_cached_embedding
-except ImportError as e:
-    print(f"Warning: RAG modules not available: {e}")
-    # Define stub functions for when RAG is not available
-    def embed_text(text): raise NotImplementedError("RAG not available")
-    def generate_text(prompt): raise NotImplementedError("RAG not available")
-    def init_db(): pass
-    def get_all_documents(): return []
-    def search_candidates_by_keyword(kw, limit): return []
-    def insert_document(*args): pass
-    def get_cached_embedding(text): return None
-    def set_cached_embedding(text, emb): pass
+from rag.vertex import embed_text, generate_text, aembed_text, agenerate_text, astream_generate_text, aclose_clients
+from rag.vertex import EMBEDDER, close_clients, is_unavailable_error
+from rag.local_embed import HashedNgramEmbedder, LOCAL_VOCAB_FILE
+from rag.db import init_db, get_all_documents, search_lexical, corpus_stats, ping
+from rag.db import USE_PGVECTOR, search_by_embedding, get_embeddings, pool_stats, close_pool
+from rag.cache import get_cached_embedding, set_cached_embedding, aget_cached_embedding, aset_cached_embedding
+from rag.ingest import sync_documents
+from rag.chunking import group_by_source, source_id
+from rag.index import IndexHolder, VectorIndex, strip_embeddings
+from rag.bm25 import BM25Index
+from rag.text import tokenize, doc_terms
+from rag.answer_cache import SemanticAnswerCache
+from rag.hybrid import HybridRetriever
+from rag.prompt import build_prompt
+from rag.singleflight import SingleFlight, singleflight_stats
+from rag.scheduler import get_scheduler
+from rag.filters import validate_filters
+from rag.hedging import LatencyStats, first_item_deadline, DEADLINE, GENERATION_DEADLINE
+
+# Sentinel: query embedding not looked up yet (None means lookup failed)
+_NOT_FETCHED = object()
+
+# Answer cache: repeated (or near-identical) questions skip embedding + generation
+ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.environ.get("RAG_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# Hybrid retrieval: candidates per stage and default reciprocal rank fusion weights
+RETRIEVAL_CANDIDATES = int(os.environ.get("RAG_RETRIEVAL_CANDIDATES", "50"))
+RRF_K = int(os.environ.get("RAG_RRF_K", "60"))
+LEXICAL_WEIGHT = float(os.environ.get("RAG_LEXICAL_WEIGHT", "1.0"))
+VECTOR_WEIGHT = float(os.environ.get("RAG_VECTOR_WEIGHT", "1.0"))
+
+# Threads for sync generation with a deadline, so a late call can finish in the background
+GENERATION_WORKERS = int(os.environ.get("RAG_GENERATION_WORKERS", "8"))
+# Late generations allowed to hold those threads at once; past this, deadline queries
+# answer extractively without calling the LLM instead of queueing behind them
+MAX_LATE_GENERATIONS = int(os.environ.get("RAG_MAX_LATE_GENERATIONS", str(max(1, GENERATION_WORKERS // 2))))
+
+# get_status refreshes its cached corpus statistics at most this often (seconds)
+STATUS_TTL = float(os.environ.get("RAG_STATUS_TTL", "30"))
+
+# Offline embedder index, searched when no Gemini query embedding is available
+LOCAL_INDEX = os.environ.get("RAG_LOCAL_INDEX", "1") == "1"
+# After an embedding API failure, skip the API for this many seconds
+EMBED_COOLDOWN = float(os.environ.get("RAG_EMBED_COOLDOWN", "60"))
+
+
+class RetrievalIndexes(NamedTuple):
+    """In-memory indexes over one document snapshot, published together"""
+    vector: Optional[VectorIndex]
+    bm25: Optional[BM25Index]
+    local: Optional[VectorIndex]
+    documents: int
+
+_NO_INDEXES = RetrievalIndexes(None, None, None, 0)
 
 
 class RagService:
@@ -57,18 +103,60 @@ class RagService:
     def __init__(self):
         self.initialized = False
         self.document_count = 0
+        # Cached for get_status: row count / last ingest time, and the current index snapshot
+        self._corpus_stats: Dict[str, Any] = {"documents": 0, "last_ingest_at": None}
+        self._corpus_stats_at = 0.0
+        self._index_stats: Dict[str, Any] = {"state": "empty"}
+        self._warm_up_thread: Optional[threading.Thread] = None
+        # Vector, BM25 and local indexes, rebuilt copy-on-write after ingestion and
+        # swapped as one snapshot (see _build_indexes)
+        self._indexes = IndexHolder(self._build_indexes)
+        self._embed_retry_at = 0.0
+        # Concurrent identical questions share one retrieval + generation
+        self._query_flight = SingleFlight("rag_query")
+        # End-to-end latency per answer mode, and generations still running past their deadline
+        self._latency = LatencyStats()
+        self._late_tasks = set()
+        self._generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="rag-generation")
+        self._late_lock = threading.Lock()
+        self._late_generations = 0
+        self._shed_generations = 0
+        self._answer_cache = SemanticAnswerCache(
+            maxsize=ANSWER_CACHE_SIZE,
+            ttl=ANSWER_CACHE_TTL,
+            similarity_threshold=ANSWER_CACHE_THRESHOLD
+        )
+        self._retriever = HybridRetriever(
+            self._lexical_search,
+            self._vector_search,
+            candidates=RETRIEVAL_CANDIDATES,
+            rrf_k=RRF_K,
+            lexical_weight=LEXICAL_WEIGHT,
+            vector_weight=VECTOR_WEIGHT
+        )
+        
+    def initialize(self, background: bool = True) -> Dict[str, Any]:
+        """
+        Initialize RAG system - create tables, count documents and warm up the index
         
-    def initialize(self) -> Dict[str, Any]:
-        """Initialize RAG system - create tables and check status"""
+        Only a COUNT(*) runs before returning; loading the documents and
+        building the in-memory indexes happens on a background thread (unless
+        `background` is False), so the app accepts traffic right away. Until
+        the index is ready, retrieval is served by Postgres alone.
+        """
         try:
             init_db()
-            docs = get_all_documents()
-            self.document_count = len(docs)
+            self._refresh_corpus_stats()
             self.initialized = True
+            if background:
+                self._start_warm_up()
+            else:
+                self._rebuild_index(get_all_documents)
+            warming = " (index warming up in background)" if self._index_stats["state"] == "warming" else ""
             return {
                 "status": "success",
                 "document_count": self.document_count,
-                "message": f"RAG system initialized with {self.document_count} documents"
+                "message": f"RAG system initialized with {self.document_count} documents{warming}"
             }
         except Exception as e:
             return {
@@ -78,14 +166,37 @@ class RagService:
             }
     
     def get_status(self) -> Dict[str, Any]:
-        """Get RAG system health status"""
+        """
+        Get RAG system health status from cached corpus and index statistics
+        
+        Corpus stats are refreshed with COUNT(*) once they are older than
+        RAG_STATUS_TTL; in between, a `SELECT 1` checks that the database is
+        still reachable. `stats_age_s` says how old the served stats are.
+        """
+        error = None
         try:
-            docs = get_all_documents()
-            return {
-                "status": "healthy",
+            if time.monotonic() - self._corpus_stats_at > STATUS_TTL:
+                self._refresh_corpus_stats()
+            else:
+                ping()
+        except Exception as e:
+            error = str(e)
+        try:
+            status = {
+                "status": "unhealthy" if error else "healthy",
                 "initialized": self.initialized,
-                "document_count": len(docs),
-                "database_connected": True
+                "document_count": self.document_count,
+                "last_ingest_at": self._corpus_stats["last_ingest_at"],
+                "stats_age_s": round(time.monotonic() - self._corpus_stats_at, 1) if self._corpus_stats_at else None,
+                "index": dict(self._index_stats),
+                "database_connected": error is None,
+                "database_pool": pool_stats(),
+                "answer_cache": self._answer_cache.stats(),
+                "embedder": self._embedder_status(),
+                "coalescing": singleflight_stats(),
+                "llm_scheduler": get_scheduler().stats(),
+                "latency": self._latency.stats(),
+                "generation": self._generation_status()
             }
         except Exception as e:
             return {
@@ -95,12 +206,19 @@ class RagService:
                 "database_connected": False,
                 "error": str(e)
             }
+        if error:
+            status["error"] = error
+        return status
     
     def query(
         self, 
         question: str, 
         context: Optional[Dict[str, Any]] = None,
-        top_k: int = 3
+        top_k: int = 3,
+        weights: Optional[Dict[str, float]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: Optional[float] = None,
+        on_late_answer: Optional[Callable[[Dict[str, Any]], None]] = None
     ) -> Dict[str, Any]:
         """
         Query the RAG system with a question
@@ -109,107 +227,362 @@ class RagService:
             question: User's question
             context: Optional context from dashboard (AQI, bed availability, etc.)
             top_k: Number of documents to retrieve
+            weights: Optional rank fusion weights, e.g. {"lexical": 0.5, "vector": 1.0}
+            filters: Optional metadata filter; only documents whose metadata
+                contains it are retrieved, e.g. {"category": "icu"}
+            deadline: Seconds to wait for the LLM (default RAG_GENERATION_DEADLINE,
+                0 waits indefinitely). When it passes, the extractive answer is
+                returned with mode "extractive" and the generation keeps running.
+            on_late_answer: Called (on a worker thread) with the full response
+                once a generation that missed its deadline finishes
             
         Returns:
             Dict with answer, sources, confidence, and metadata
+        
+        Raises:
+            ValueError: If filters is not a dict
         """
+        filters = validate_filters(filters)
+        deadline = GENERATION_DEADLINE if deadline is None else deadline
+        started = time.perf_counter()
+        args = (question, context, top_k, weights, filters, deadline, on_late_answer)
+        if on_late_answer is not None:
+            # the late answer goes to this caller's callback, so don't share the call
+            response = self._query(*args)
+        else:
+            # Identical questions asked while one is in flight get its answer
+            key = self._flight_key(question, context, top_k, weights, filters, deadline)
+            response = dict(self._query_flight.do(key, self._query, *args))
+        self._record_latency(response, started)
+        return response
+    
+    def _query(
+        self,
+        question: str,
+        context: Optional[Dict[str, Any]],
+        top_k: int,
+        weights: Optional[Dict[str, float]],
+        filters: Optional[Dict[str, Any]],
+        deadline: float = 0.0,
+        on_late_answer: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Dict[str, Any]:
         try:
             # Enhance question with dashboard context if available
             enhanced_question = self._enhance_question_with_context(question, context)
+            scope = self._answer_scope(context, top_k, weights, filters)
+            
+            # Exact-match answer cache hit skips the embedding call entirely
+            cached = self._cached_answer(question, scope)
+            if cached:
+                return cached
+            
+            started = time.perf_counter()
+            query_embedding = self._get_query_embedding(enhanced_question)
+            embedding_ms = _elapsed_ms(started)
+            cached = self._cached_answer(question, scope, query_embedding)
+            if cached:
+                return cached
             
-            # Retrieve relevant documents
-            relevant_docs = self._retrieve_relevant(enhanced_question, top_k)
+            # Retrieve relevant documents (lexical + vector, rank-fused)
+            relevant_docs, timings = self._retrieve(enhanced_question, top_k, query_embedding, weights, filters)
+            timings["embedding_ms"] = embedding_ms
             
             if not relevant_docs:
-                return {
-                    "answer": "I don't have enough information in my knowledge base to answer this question. Please try rephrasing or ask about hospital operations, medical procedures, or health emergencies.",
-                    "sources": [],
-                    "confidence": 0.0,
-                    "mode": "no_documents"
-                }
+                return self._no_documents_response()
             
             # Build RAG prompt
-            prompt = self._build_rag_prompt(question, relevant_docs, context)
+            prompt, prompt_stats = self._build_rag_prompt(question, relevant_docs, context)
             
-            # Generate answer
+            started = time.perf_counter()
+            
+            def complete(answer: str, mode: str) -> Dict[str, Any]:
+                response = self._build_query_response(answer, mode, relevant_docs, enhanced_question, context)
+                response["timings"] = dict(timings, generation_ms=_elapsed_ms(started))
+                response["prompt_tokens"] = prompt_stats
+                self._store_answer(question, scope, query_embedding, response, relevant_docs)
+                return response
+            
+            # Generate answer, racing it against the deadline if there is one
             try:
-                answer = generate_text(prompt, temperature=0.2, max_output_tokens=512)
+                if deadline > 0:
+                    if self._late_generations >= MAX_LATE_GENERATIONS:
+                        # enough calls are already running late; don't queue another behind them
+                        with self._late_lock:
+                            self._shed_generations += 1
+                        return complete(self._generate_offline_response(question, relevant_docs), "extractive")
+                    future = self._generation_executor.submit(generate_text, prompt, temperature=0.2, max_output_tokens=512)
+                    # test done() rather than catching TimeoutError: generate_text raises it too
+                    wait_futures([future], timeout=deadline)
+                    if not future.done():
+                        if future.cancel():
+                            # still queued when the deadline passed: drop it rather than run it late
+                            with self._late_lock:
+                                self._shed_generations += 1
+                            return complete(self._generate_offline_response(question, relevant_docs), "extractive")
+                        with self._late_lock:
+                            self._late_generations += 1
+                        future.add_done_callback(partial(self._deliver_late_answer, complete, on_late_answer))
+                        return self._hedged_response(complete(self._generate_offline_response(question, relevant_docs), "extractive"))
+                    answer = future.result()
+                else:
+                    answer = generate_text(prompt, temperature=0.2, max_output_tokens=512)
                 mode = "rag"
             except Exception as e:
-                # Fallback to offline mode if API fails (rate limiting, SSL errors, network issues)
-                error_msg = str(e).lower()
-                if any(x in error_msg for x in ["rate limit", "429", "ssl", "connection", "timeout", "max retries"]):
-                    answer = self._generate_offline_response(question, relevant_docs)
-                    mode = "offline"
+                answer, mode = self._fallback_answer(e, question, relevant_docs)
+            
+            return complete(answer, mode)
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def aquery(
+        self, 
+        question: str, 
+        context: Optional[Dict[str, Any]] = None,
+        top_k: int = 3,
+        weights: Optional[Dict[str, float]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: Optional[float] = None,
+        on_late_answer: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Async version of query() that never blocks the event loop
+        
+        Embedding and generation go through the pooled async HTTP client;
+        database retrieval runs on a worker thread against the connection pool.
+        `on_late_answer` is awaited with the full response when a generation
+        that missed its deadline finishes.
+        """
+        filters = validate_filters(filters)
+        deadline = GENERATION_DEADLINE if deadline is None else deadline
+        started = time.perf_counter()
+        args = (question, context, top_k, weights, filters, deadline, on_late_answer)
+        if on_late_answer is not None:
+            response = await self._aquery(*args)
+        else:
+            key = self._flight_key(question, context, top_k, weights, filters, deadline)
+            response = dict(await self._query_flight.ado(key, self._aquery, *args))
+        self._record_latency(response, started)
+        return response
+    
+    async def _aquery(
+        self,
+        question: str,
+        context: Optional[Dict[str, Any]],
+        top_k: int,
+        weights: Optional[Dict[str, float]],
+        filters: Optional[Dict[str, Any]],
+        deadline: float = 0.0,
+        on_late_answer: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+    ) -> Dict[str, Any]:
+        try:
+            enhanced_question = self._enhance_question_with_context(question, context)
+            scope = self._answer_scope(context, top_k, weights, filters)
+            
+            cached = self._cached_answer(question, scope)
+            if cached:
+                return cached
+            
+            started = time.perf_counter()
+            query_embedding = await self._aget_query_embedding(enhanced_question)
+            embedding_ms = _elapsed_ms(started)
+            cached = self._cached_answer(question, scope, query_embedding)
+            if cached:
+                return cached
+            
+            relevant_docs, timings = await asyncio.to_thread(
+                self._retrieve, enhanced_question, top_k, query_embedding, weights, filters
+            )
+            timings["embedding_ms"] = embedding_ms
+            
+            if not relevant_docs:
+                return self._no_documents_response()
+            
+            prompt, prompt_stats = self._build_rag_prompt(question, relevant_docs, context)
+            
+            started = time.perf_counter()
+            
+            def complete(answer: str, mode: str) -> Dict[str, Any]:
+                response = self._build_query_response(answer, mode, relevant_docs, enhanced_question, context)
+                response["timings"] = dict(timings, generation_ms=_elapsed_ms(started))
+                response["prompt_tokens"] = prompt_stats
+                self._store_answer(question, scope, query_embedding, response, relevant_docs)
+                return response
+            
+            try:
+                if deadline > 0:
+                    generation = asyncio.ensure_future(agenerate_text(prompt, temperature=0.2, max_output_tokens=512))
+                    try:
+                        await asyncio.wait({generation}, timeout=deadline)
+                    except asyncio.CancelledError:
+                        generation.cancel()
+                        raise
+                    if not generation.done():
+                        # Deadline passed: answer extractively, let the generation finish in the background
+                        task = asyncio.ensure_future(self._adeliver_late_answer(generation, complete, on_late_answer))
+                        self._late_tasks.add(task)
+                        task.add_done_callback(self._late_tasks.discard)
+                        return self._hedged_response(complete(self._generate_offline_response(question, relevant_docs), "extractive"))
+                    answer = generation.result()
                 else:
-                    raise
+                    answer = await agenerate_text(prompt, temperature=0.2, max_output_tokens=512)
+                mode = "rag"
+            except Exception as e:
+                answer, mode = self._fallback_answer(e, question, relevant_docs)
             
-            # Extract source information
-            sources = [
-                {
-                    "id": doc.get("id", "unknown"),
-                    "content": doc.get("content", "")[:200] + "...",
-                    "metadata": doc.get("metadata", {})
-                }
-                for doc in relevant_docs
-            ]
+            return complete(answer, mode)
             
-            return {
-                "answer": answer,
-                "sources": sources,
-                "confidence": self._calculate_confidence(relevant_docs, enhanced_question),
-                "mode": mode,
-                "context_used": context is not None
-            }
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def astream_query(
+        self,
+        question: str,
+        context: Optional[Dict[str, Any]] = None,
+        top_k: int = 3,
+        weights: Optional[Dict[str, float]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: Optional[float] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming version of aquery()
+        
+        Yields events as soon as they are available:
+            {"event": "sources", "sources": [...]} once retrieval is done,
+            {"event": "token", "text": "..."} for each generated piece,
+            {"event": "done", ...} with the full response (as aquery returns it).
+        If the first token misses `deadline` (default RAG_GENERATION_DEADLINE),
+        the extractive answer is sent as the token and "done" (mode
+        "extractive"), and generation continues in the background until
+        {"event": "late_answer", ...} carries the LLM response (or the error).
+        Failures yield a final {"event": "error", ...}. Closing the generator
+        (client disconnected) cancels the upstream generation stream.
+        """
+        query_started = time.perf_counter()
+        deadline = GENERATION_DEADLINE if deadline is None else deadline
+        try:
+            filters = validate_filters(filters)
+            enhanced_question = self._enhance_question_with_context(question, context)
+            scope = self._answer_scope(context, top_k, weights, filters)
+            
+            cached = self._cached_answer(question, scope)
+            if not cached:
+                started = time.perf_counter()
+                query_embedding = await self._aget_query_embedding(enhanced_question)
+                embedding_ms = _elapsed_ms(started)
+                cached = self._cached_answer(question, scope, query_embedding)
+            if cached:
+                self._record_latency(cached, query_started)
+                yield {"event": "sources", "sources": cached["sources"]}
+                yield {"event": "token", "text": cached["answer"]}
+                yield dict(cached, event="done")
+                return
+            
+            relevant_docs, timings = await asyncio.to_thread(
+                self._retrieve, enhanced_question, top_k, query_embedding, weights, filters
+            )
+            timings["embedding_ms"] = embedding_ms
+            
+            if not relevant_docs:
+                response = self._no_documents_response()
+                self._record_latency(response, query_started)
+                yield {"event": "sources", "sources": []}
+                yield {"event": "token", "text": response["answer"]}
+                yield dict(response, event="done")
+                return
+            
+            yield {"event": "sources", "sources": self._build_sources(relevant_docs)}
+            prompt, prompt_stats = self._build_rag_prompt(question, relevant_docs, context)
+            
+            started = time.perf_counter()
+            pieces: List[str] = []
+            hedged = False
+            stream = astream_generate_text(prompt, temperature=0.2, max_output_tokens=512)
+            try:
+                async for text in first_item_deadline(stream, deadline):
+                    if text is DEADLINE:
+                        # No first token yet: answer extractively now, keep the stream for a late answer
+                        hedged = True
+                        response = self._build_query_response(
+                            self._generate_offline_response(question, relevant_docs), "extractive",
+                            relevant_docs, enhanced_question, context
+                        )
+                        response["timings"] = dict(timings, generation_ms=_elapsed_ms(started))
+                        response["prompt_tokens"] = prompt_stats
+                        response = self._hedged_response(response)
+                        self._record_latency(response, query_started)
+                        yield {"event": "token", "text": response["answer"]}
+                        yield dict(response, event="done")
+                        continue
+                    if not pieces:
+                        timings["first_token_ms"] = _elapsed_ms(started)
+                    pieces.append(text)
+                    if not hedged:
+                        yield {"event": "token", "text": text}
+                answer, mode = "".join(pieces), "rag"
+            except Exception as e:
+                if hedged:
+                    print(f"Late generation failed: {e}")
+                    yield dict(self._error_response(e), event="late_answer")
+                    return
+                # Once tokens are out the answer can't be swapped for the offline one
+                if pieces:
+                    raise
+                answer, mode = self._fallback_answer(e, question, relevant_docs)
+                yield {"event": "token", "text": answer}
+            timings["generation_ms"] = _elapsed_ms(started)
+            
+            response = self._build_query_response(answer, mode, relevant_docs, enhanced_question, context)
+            response["timings"] = timings
+            response["prompt_tokens"] = prompt_stats
+            self._store_answer(question, scope, query_embedding, response, relevant_docs)
+            if hedged:
+                self._latency.record("late_rag", timings["generation_ms"])
+                yield dict(response, event="late_answer")
+            else:
+                self._record_latency(response, query_started)
+                yield dict(response, event="done")
             
         except Exception as e:
-            return {
-                "answer": f"I encountered an error while processing your question: {str(e)}",
-                "sources": [],
-                "confidence": 0.0,
-                "mode": "error",
-                "error": str(e)
-            }
+            yield dict(self._error_response(e), event="error")
     
-    def ingest_documents(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def ingest_documents(self, documents: List[Dict[str, Any]], prune: bool = False) -> Dict[str, Any]:
         """
         Ingest new documents into RAG system
         
+        Documents are keyed by 'id' (or a stable hash of their content) and
+        fingerprinted; unchanged ones are skipped without embedding calls.
+        
         Args:
             documents: List of documents with 'id', 'content', 'metadata'
+            prune: Delete stored documents that are not in `documents`
             
         Returns:
-            Dict with status and count of ingested documents
+            Dict with status and counts of added, updated, skipped and deleted documents
         """
         try:
-            ingested = 0
-            failed = []
-            
-            for doc in documents:
-                try:
-                    doc_id = doc.get("id", str(hash(doc.get("content", ""))))
-                    content = doc.get("content", "")
-                    metadata = doc.get("metadata", {})
-                    
-                    # Get or create embedding
-                    embedding = get_cached_embedding(content)
-                    if not embedding:
-                        embedding = embed_text(content)
-                        set_cached_embedding(content, embedding)
-                    
-                    # Insert into database
-                    insert_document(doc_id, content, metadata, embedding)
-                    ingested += 1
-                    
-                except Exception as e:
-                    failed.append({"id": doc.get("id", "unknown"), "error": str(e)})
-            
-            self.document_count = len(get_all_documents())
+            # Chunk, embed cache misses in concurrent batches, and upsert changed documents
+            result = sync_documents(
+                documents,
+                prune=prune,
+                on_progress=lambda done, total, texts: print(f"RAG ingest: embedded batch {done}/{total} ({texts} texts)")
+            )
+            changed = result["ingested"] + result["deleted"]
+            failed = result["failed"]
+            
+            # Answers built from re-ingested or deleted documents are stale now
+            if changed:
+                self._answer_cache.invalidate_sources(changed)
+            
+            self._refresh_corpus_stats()
+            if changed:
+                self._rebuild_index(get_all_documents)
             
             return {
                 "status": "success",
-                "ingested": ingested,
-                "failed": len(failed),
+                "ingested": len(result["ingested"]),
+                **result["summary"],
+                "chunks": result["chunks"],
                 "total_documents": self.document_count,
                 "errors": failed
             }
@@ -222,8 +595,178 @@ class RagService:
                 "error": str(e)
             }
     
+    def use_local_indexes(self, docs: List[Dict[str, Any]]) -> None:
+        """
+        Serve retrieval from in-process BM25 and vector indexes over `docs`
+        
+        Postgres and pgvector are bypassed entirely; used by offline
+        benchmarks and evaluation runs.
+        """
+        self._indexes.rebuild(lambda: docs)
+        self._retriever.lexical_search = self._bm25_search
+        self._retriever.vector_search = self._index_search
+        self.document_count = len(docs)
+    
+    def shutdown(self) -> None:
+        """Release pooled database connections, the sync HTTP client and generation threads"""
+        self._generation_executor.shutdown(wait=False, cancel_futures=True)
+        close_clients()
+        close_pool()
+    
+    async def ashutdown(self) -> None:
+        """Release pooled database connections and HTTP clients"""
+        await aclose_clients()
+        self.shutdown()
+    
     # Private helper methods
     
+    def _no_documents_response(self) -> Dict[str, Any]:
+        return {
+            "answer": "I don't have enough information in my knowledge base to answer this question. Please try rephrasing or ask about hospital operations, medical procedures, or health emergencies.",
+            "sources": [],
+            "confidence": 0.0,
+            "mode": "no_documents"
+        }
+    
+    def _error_response(self, e: Exception) -> Dict[str, Any]:
+        return {
+            "answer": f"I encountered an error while processing your question: {str(e)}",
+            "sources": [],
+            "confidence": 0.0,
+            "mode": "error",
+            "error": str(e)
+        }
+    
+    @staticmethod
+    def _flight_key(
+        question: str,
+        context: Optional[Dict[str, Any]],
+        top_k: int,
+        weights: Optional[Dict[str, float]],
+        filters: Optional[Dict[str, Any]] = None,
+        deadline: float = 0.0
+    ) -> str:
+        return json.dumps(
+            {"q": " ".join(question.lower().split()), "context": context or {}, "top_k": top_k,
+             "weights": weights or {}, "filters": filters or {}, "deadline": deadline},
+            sort_keys=True,
+            default=str
+        )
+    
+    def _answer_scope(
+        self,
+        context: Optional[Dict[str, Any]],
+        top_k: int,
+        weights: Optional[Dict[str, float]] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> str:
+        if not self._answer_cache:
+            return ""
+        return self._answer_cache.make_scope(context, top_k=top_k, weights=weights, filters=filters)
+    
+    def _cached_answer(
+        self,
+        question: str,
+        scope: str,
+        query_embedding: Optional[List[float]] = None
+    ) -> Optional[Dict[str, Any]]:
+        if not self._answer_cache:
+            return None
+        return self._answer_cache.get(question, scope, query_embedding)
+    
+    def _store_answer(
+        self,
+        question: str,
+        scope: str,
+        query_embedding: Optional[List[float]],
+        response: Dict[str, Any],
+        relevant_docs: List[Dict[str, Any]]
+    ) -> None:
+        # Only cache real generations; offline answers should be retried next time
+        if not self._answer_cache or response.get("mode") != "rag":
+            return
+        source_ids = {source_id(doc) for doc in relevant_docs if source_id(doc)}
+        self._answer_cache.put(question, scope, query_embedding, response, source_ids)
+    
+    def _fallback_answer(self, error: Exception, question: str, docs: List[Dict[str, Any]]):
+        """Fallback to offline mode if API fails (rate limiting, SSL errors, network issues)"""
+        if is_unavailable_error(error):
+            return self._generate_offline_response(question, docs), "offline"
+        # errors raised outside the HTTP client only say what happened in their text
+        error_msg = str(error).lower()
+        if any(x in error_msg for x in ["rate limit", "429", "ssl", "connection", "timeout", "max retries"]):
+            return self._generate_offline_response(question, docs), "offline"
+        raise error
+    
+    def _hedged_response(self, response: Dict[str, Any]) -> Dict[str, Any]:
+        response["late_answer"] = "pending"
+        return response
+    
+    def _deliver_late_answer(self, complete, on_late_answer, future) -> None:
+        """Done-callback of a sync generation that missed its deadline"""
+        with self._late_lock:
+            self._late_generations -= 1
+        try:
+            response = complete(future.result(), "rag")
+            self._latency.record("late_rag", response["timings"]["generation_ms"])
+        except Exception as e:
+            print(f"Late generation failed: {e}")
+            response = self._error_response(e)
+        if on_late_answer is not None:
+            on_late_answer(response)
+    
+    async def _adeliver_late_answer(self, generation, complete, on_late_answer) -> None:
+        try:
+            response = complete(await generation, "rag")
+            self._latency.record("late_rag", response["timings"]["generation_ms"])
+        except Exception as e:
+            print(f"Late generation failed: {e}")
+            response = self._error_response(e)
+        if on_late_answer is not None:
+            await on_late_answer(response)
+    
+    def _generation_status(self) -> Dict[str, Any]:
+        """Generations still running past their deadline, and deadline queries answered without the LLM"""
+        with self._late_lock:
+            return {
+                "workers": GENERATION_WORKERS,
+                "late": self._late_generations,
+                "late_async": len(self._late_tasks),
+                "late_limit": MAX_LATE_GENERATIONS,
+                "shed": self._shed_generations
+            }
+    
+    def _record_latency(self, response: Dict[str, Any], started: float) -> None:
+        self._latency.record("cached" if response.get("cached") else response.get("mode", "unknown"), _elapsed_ms(started))
+    
+    def _build_query_response(
+        self,
+        answer: str,
+        mode: str,
+        relevant_docs: List[Dict[str, Any]],
+        enhanced_question: str,
+        context: Optional[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {
+            "answer": answer,
+            "sources": self._build_sources(relevant_docs),
+            "confidence": self._calculate_confidence(relevant_docs, enhanced_question),
+            "mode": mode,
+            "context_used": context is not None
+        }
+    
+    def _build_sources(self, relevant_docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Extract source information, grouping chunk hits by source document
+        return [
+            {
+                "id": group["id"] or "unknown",
+                "content": group["chunks"][0].get("content", "")[:200] + "...",
+                "metadata": group["metadata"],
+                "chunk_ids": [chunk.get("id") for chunk in group["chunks"]]
+            }
+            for group in group_by_source(relevant_docs)
+        ]
+    
     def _enhance_question_with_context(
         self, 
         question: str, 
@@ -245,82 +788,217 @@ class RagService:
             return f"{question} [Context: {', '.join(context_parts)}]"
         return question
     
-    def _retrieve_relevant(self, query: str, top_k: int) -> List[Dict[str, Any]]:
-        """Retrieve relevant documents using embeddings or keyword search"""
-        # Extract keywords for fallback search
-        words = [w for w in re.findall(r"\w+", query.lower()) if len(w) > 3]
-        candidates = []
+    def _refresh_corpus_stats(self) -> None:
+        self._corpus_stats = corpus_stats()
+        self._corpus_stats_at = time.monotonic()
+        self.document_count = self._corpus_stats["documents"]
+    
+    def _start_warm_up(self) -> None:
+        """Build the in-memory indexes on a daemon thread"""
+        if USE_PGVECTOR:
+            self._index_stats = {"state": "pgvector"}
+            return
+        self._index_stats = {"state": "warming"}
+        self._warm_up_thread = threading.Thread(
+            target=self._rebuild_index, args=(get_all_documents,), name="rag-index-warm-up", daemon=True
+        )
+        self._warm_up_thread.start()
+    
+    def _rebuild_index(self, load_docs) -> None:
+        """Build new indexes and swap them in without blocking readers
         
+        `load_docs` runs under the holder's build lock, so when ingests
+        overlap the snapshot loaded last is the one published last.
+        """
+        # With pgvector enabled Postgres does the ranking; don't hold the corpus in memory
+        if USE_PGVECTOR:
+            self._index_stats = {"state": "pgvector"}
+            return
+        started = time.perf_counter()
         try:
-            # Try keyword search first
-            for word in words[:3]:
-                candidates.extend(search_candidates_by_keyword(word, limit=50))
-            
-            # If no results, get all documents
-            if not candidates:
-                candidates = get_all_documents()
-                
+            indexes = self._indexes.rebuild(load_docs)
+            if indexes.local is not None:
+                # persisted so the CLI embeds queries with the corpus vocabulary
+                indexes.local.embedder.save(LOCAL_VOCAB_FILE)
+            self._index_stats = {
+                "state": "ready",
+                "documents": indexes.documents,
+                "vector_index_bytes": indexes.vector.nbytes,
+                "local_index_bytes": indexes.local.nbytes if indexes.local is not None else 0,
+                "build_ms": _elapsed_ms(started),
+                "built_at": datetime.now(timezone.utc).isoformat()
+            }
         except Exception as e:
-            print(f"Database error during retrieval: {e}")
-            return []
-        
-        if not candidates:
-            return []
+            print(f"Index rebuild failed: {e}")
+            # an earlier snapshot, if any, keeps serving
+            state = "ready" if self._indexes.index is not None else "failed"
+            self._index_stats = dict(self._index_stats, state=state, error=str(e))
+    
+    def _build_indexes(self, docs: List[Dict[str, Any]]) -> RetrievalIndexes:
+        """Vector, BM25 and (if enabled) local indexes over one snapshot of `docs`"""
+        # reduced precisions re-rank their candidates with vectors fetched from Postgres
+        vector = VectorIndex(docs, fetch_embeddings=get_embeddings)
+        # the vector index holds the only copy of the embeddings from here on
+        docs = strip_embeddings(docs)
+        local = self._build_local_index(docs) if LOCAL_INDEX else None
+        return RetrievalIndexes(vector, BM25Index(docs), local, len(docs))
+    
+    @property
+    def _current_indexes(self) -> RetrievalIndexes:
+        return self._indexes.index or _NO_INDEXES
+    
+    def _build_local_index(self, docs: List[Dict[str, Any]]):
+        """Fit a local embedder on `docs` and index them with it
         
-        # Get query embedding for similarity scoring
+        Each snapshot carries its own fitted embedder, so query vectors always
+        use the vocabulary the index was built with.
+        """
+        embedder = HashedNgramEmbedder(vocab_path=None)
+        vectors = embedder.fit_transform([d.get("content") or "" for d in docs])
+        index = VectorIndex(docs, precision="float32", embeddings=vectors)
+        index.embedder = embedder
+        return index
+    
+    def _embedding_api_available(self) -> bool:
+        return EMBEDDER != "local" and time.monotonic() >= self._embed_retry_at
+    
+    def _embedding_api_failed(self, e: Exception) -> None:
+        self._embed_retry_at = time.monotonic() + EMBED_COOLDOWN
+        print(f"Embedding API failed, using the local embedder for {EMBED_COOLDOWN:.0f}s: {e}")
+    
+    def _embedder_status(self) -> Dict[str, Any]:
+        local = self._current_indexes.local
+        return {
+            "query_embedder": EMBEDDER,
+            "api_cooldown_seconds": round(max(0.0, self._embed_retry_at - time.monotonic()), 1),
+            "local_index_documents": len(local) if local is not None else 0
+        }
+    
+    def _get_query_embedding(self, query: str) -> Optional[List[float]]:
+        """Get query embedding from cache or the embedding API (None if unavailable)"""
         query_embedding = get_cached_embedding(query)
-        if not query_embedding:
+        if not query_embedding and self._embedding_api_available():
             try:
                 query_embedding = embed_text(query)
                 set_cached_embedding(query, query_embedding)
-            except Exception:
+            except Exception as e:
+                self._embedding_api_failed(e)
                 query_embedding = None
-        
-        # Score documents
-        scored = []
-        query_tokens = set(re.findall(r"\w+", query.lower()))
-        
-        for candidate in candidates:
-            doc_embedding = candidate.get("embedding")
-            
-            if doc_embedding and query_embedding:
-                # Use cosine similarity
-                sim = self._cosine_similarity(query_embedding, doc_embedding)
-            else:
-                # Fallback to token overlap
-                doc_tokens = set(re.findall(r"\w+", candidate.get("content", "").lower()))
-                if not doc_tokens:
-                    sim = 0.0
-                else:
-                    sim = len(query_tokens & doc_tokens) / max(1, len(query_tokens | doc_tokens))
-            
-            scored.append((sim, candidate))
-        
-        # Sort by similarity and return top-k
-        scored.sort(key=lambda x: x[0], reverse=True)
-        return [doc for _, doc in scored[:top_k]]
+        return query_embedding or None
     
-    def _cosine_similarity(self, a: List[float], b: List[float]) -> float:
-        """Calculate cosine similarity between two vectors"""
-        if not a or not b or len(a) != len(b):
-            return 0.0
-        
-        dot_product = sum(x * y for x, y in zip(a, b))
-        norm_a = math.sqrt(sum(x * x for x in a))
-        norm_b = math.sqrt(sum(x * x for x in b))
+    async def _aget_query_embedding(self, query: str) -> Optional[List[float]]:
+        """Async version of _get_query_embedding"""
+        query_embedding = await aget_cached_embedding(query)
+        if not query_embedding and self._embedding_api_available():
+            try:
+                query_embedding = await aembed_text(query)
+                await aset_cached_embedding(query, query_embedding)
+            except Exception as e:
+                self._embedding_api_failed(e)
+                query_embedding = None
+        return query_embedding or None
+    
+    def _retrieve_relevant(
+        self,
+        query: str,
+        top_k: int,
+        query_embedding: Any = _NOT_FETCHED
+    ) -> List[Dict[str, Any]]:
+        """Retrieve relevant documents using hybrid lexical + vector search"""
+        docs, _ = self._retrieve(query, top_k, query_embedding)
+        return docs
+    
+    def _retrieve(
+        self,
+        query: str,
+        top_k: int,
+        query_embedding: Any = _NOT_FETCHED,
+        weights: Optional[Dict[str, float]] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ):
+        """Run lexical and vector search in parallel and fuse with reciprocal rank fusion
         
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
+        Metadata filters are pushed down to both stages: a JSONB containment
+        clause in Postgres, or a row bitmap over the in-memory indexes.
         
-        return dot_product / (norm_a * norm_b)
+        Returns:
+            Tuple of (documents, per-stage timings in ms)
+        """
+        if query_embedding is _NOT_FETCHED:
+            query_embedding = self._get_query_embedding(query)
+        # every stage of this query reads the same index snapshot
+        indexes = self._current_indexes
+        lexical_search = partial(self._retriever.lexical_search, filters=filters, indexes=indexes)
+        vector_search = partial(self._retriever.vector_search, filters=filters, indexes=indexes)
+        local = indexes.local
+        if query_embedding is None and local is not None and len(local):
+            # No Gemini embedding: rank with the local embedder against its own index
+            rows = local.filter_rows(filters) if filters else None
+            docs, info = self._retriever.retrieve(
+                query, local.embedder.embed(query), top_k, weights,
+                vector_search=lambda emb, limit: [doc for _, doc in local.search(emb, limit, rows)],
+                lexical_search=lexical_search
+            )
+            info["vector_backend"] = "local"
+        else:
+            docs, info = self._retriever.retrieve(
+                query, query_embedding, top_k, weights,
+                vector_search=vector_search, lexical_search=lexical_search
+            )
+        if filters:
+            info["filters"] = filters
+        return docs, info
+    
+    def _lexical_search(self, query: str, limit: int, filters: Optional[Dict[str, Any]] = None,
+                        indexes: Optional[RetrievalIndexes] = None) -> List[Dict[str, Any]]:
+        """Full-text search in Postgres, or the in-process BM25 index if it is unreachable"""
+        indexes = indexes or self._current_indexes
+        try:
+            return search_lexical(query, limit=limit, filters=filters)
+        except Exception as e:
+            if indexes.bm25 is None or not len(indexes.bm25):
+                raise
+            print(f"Database error during lexical search, using BM25: {e}")
+            return self._bm25_search(query, limit, filters, indexes)
+    
+    def _vector_search(self, query_embedding: List[float], limit: int, filters: Optional[Dict[str, Any]] = None,
+                       indexes: Optional[RetrievalIndexes] = None) -> List[Dict[str, Any]]:
+        """Nearest neighbours from pgvector or the in-memory index"""
+        if USE_PGVECTOR:
+            return search_by_embedding(query_embedding, limit, filters=filters)
+        return self._index_search(query_embedding, limit, filters, indexes)
+    
+    def _bm25_search(self, query: str, limit: int, filters: Optional[Dict[str, Any]] = None,
+                     indexes: Optional[RetrievalIndexes] = None) -> List[Dict[str, Any]]:
+        bm25 = (indexes or self._current_indexes).bm25
+        if bm25 is None:
+            return []
+        rows = bm25.filter_rows(filters) if filters else None
+        return [doc for _, doc in bm25.search(query, limit, rows)]
+    
+    def _index_search(self, query_embedding: List[float], limit: int, filters: Optional[Dict[str, Any]] = None,
+                      indexes: Optional[RetrievalIndexes] = None) -> List[Dict[str, Any]]:
+        index = (indexes or self._current_indexes).vector
+        if index is None:
+            return []
+        rows = index.filter_rows(filters) if filters else None
+        return [doc for _, doc in index.search(query_embedding, limit, rows)]
     
     def _build_rag_prompt(
         self, 
         question: str, 
         docs: List[Dict[str, Any]], 
         context: Optional[Dict[str, Any]]
-    ) -> str:
-        """Build prompt for RAG generation"""
+    ) -> Tuple[str, Dict[str, int]]:
+        """
+        Build prompt for RAG generation
+        
+        Retrieved documents are packed best-ranked first into the prompt
+        token budget (RAG_PROMPT_TOKEN_BUDGET), trimmed at sentence boundaries.
+        
+        Returns:
+            Tuple of (prompt, token accounting: budget, used, dropped, documents included/trimmed/dropped)
+        """
         prompt = "You are a medical AI assistant for Arogya-Swarm hospital management system. "
         prompt += "Use the following documents to answer the question. "
         prompt += "If the answer is not in the documents, say you don't know.\n\n"
@@ -336,16 +1014,12 @@ class RagService:
                 prompt += f"- Active Alerts: {context['active_alerts']}\n"
             prompt += "\n"
         
-        # Add retrieved documents
-        for i, doc in enumerate(docs, 1):
-            content = doc.get("content", "")
-            prompt += f"Document {i}:\n{content}\n\n"
-        
-        prompt += f"Question: {question}\n\n"
-        prompt += "Answer concisely and mention which document(s) you're referencing. "
-        prompt += "If discussing medical procedures, include safety considerations."
+        closing = f"Question: {question}\n\n"
+        closing += "Answer concisely and mention which document(s) you're referencing. "
+        closing += "If discussing medical procedures, include safety considerations."
         
-        return prompt
+        # Add retrieved documents, as many as fit the budget
+        return build_prompt(prompt, docs, closing)
     
     def _generate_offline_response(
         self, 
@@ -360,7 +1034,7 @@ class RagService:
         response = "Based on the medical knowledge base, here's the relevant information:\n\n"
         
         for i, doc in enumerate(docs, 1):
-            doc_id = doc.get("id", "").replace("_", " ").title()
+            doc_id = (source_id(doc) or "").replace("_", " ").title()
             content = doc.get("content", "")
             
             # Show full content for most relevant document, excerpts for others
@@ -386,11 +1060,12 @@ class RagService:
         
         # Simple heuristic: average similarity of top documents
         # In production, could use more sophisticated methods
-        query_tokens = set(re.findall(r"\w+", query.lower()))
+        query_tokens = set(tokenize(query))
         
         similarities = []
         for doc in docs:
-            doc_tokens = set(re.findall(r"\w+", doc.get("content", "").lower()))
+            # token sets precomputed at ingest; only legacy rows are tokenized here
+            doc_tokens = doc_terms(doc).keys()
             if doc_tokens:
                 sim = len(query_tokens & doc_tokens) / max(1, len(query_tokens | doc_tokens))
                 similarities.append(sim)
@@ -402,6 +1077,10 @@ class RagService:
         return round(min(avg_sim * 100, 95.0), 1)
 
 
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
 # Global RAG service instance
 _rag_service = None
 
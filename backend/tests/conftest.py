@@ -3,6 +3,7 @@
 # Pytest Fixtures and Configuration
 # ============================================
 
+import os
 import pytest
 import asyncio
 from fastapi.testclient import TestClient
@@ -120,3 +121,12 @@ def sample_recommendation(db_session):
     db_session.add(rec)
     db_session.commit()
     return rec
+
+def pytest_collection_modifyitems(config, items):
+    """Skip benchmark-marked tests unless asked for with --benchmark-only or RAG_BENCH=1"""
+    if os.environ.get("RAG_BENCH") or config.getoption("benchmark_only", default=False):
+        return
+    skip = pytest.mark.skip(reason="benchmark: run with --benchmark-only or RAG_BENCH=1")
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(skip)
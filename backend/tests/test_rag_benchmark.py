@@ -0,0 +1,65 @@
+# ============================================
+# FILE: backend/tests/test_rag_benchmark.py
+# RAG Retrieval Benchmarks (offline; run with --benchmark-only)
+# ============================================
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.benchmark
+
+from rag import bench
+from services.rag_service import RagService
+
+@pytest.fixture(scope="module")
+def corpus():
+    """Medical documents with cached embeddings, padded to 1k documents"""
+    base = bench.load_corpus()
+    if not any(d["embedding"] for d in base):
+        pytest.skip("no cached embeddings for the medical documents")
+    return bench.scale_corpus(base, 1000)
+
+@pytest.fixture(scope="module")
+def service(corpus):
+    svc = RagService()
+    svc.use_local_indexes(corpus)
+    return svc
+
+@pytest.fixture(scope="module")
+def probes(corpus):
+    return bench.probe_queries(corpus[:15])
+
+def test_bench_service_questions(benchmark, service):
+    """Benchmark retrieval for the labelled question set (BM25 + local embedder when uncached)"""
+    queries = bench.question_queries()
+
+    def run():
+        return [service._retrieve_relevant(q, 3, query_embedding=emb) for q, emb, _ in queries]
+
+    results = benchmark(run)
+    recall = sum(bench.recall_at_k(hits, expected) for hits, (_, _, expected) in zip(results, queries)) / len(queries)
+    benchmark.extra_info["recall@3"] = recall
+    assert recall >= 0.75
+
+def test_bench_service_hybrid_probes(benchmark, service, probes):
+    """Benchmark hybrid (BM25 + vector) retrieval with title + embedding probes"""
+    def run():
+        return [service._retrieve_relevant(q, 3, query_embedding=emb) for q, emb, _ in probes]
+
+    results = benchmark(run)
+    recall = sum(bench.recall_at_k(hits, expected) for hits, (_, _, expected) in zip(results, probes)) / len(probes)
+    benchmark.extra_info["recall@3"] = recall
+    assert recall >= 0.9
+
+def test_bench_cli_probes(benchmark, corpus, probes):
+    """Benchmark the CLI's retrieve_relevant over the same corpus"""
+    from rag.cli import retrieve_relevant
+
+    def run():
+        return [retrieve_relevant(q, 3, candidates=corpus, query_embedding=emb, embed=False) for q, emb, _ in probes]
+
+    results = benchmark.pedantic(run, rounds=3, iterations=1)
+    recall = sum(bench.recall_at_k(hits, expected) for hits, (_, _, expected) in zip(results, probes)) / len(probes)
+    benchmark.extra_info["recall@3"] = recall
+    assert recall >= 0.9
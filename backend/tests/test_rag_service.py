@@ -0,0 +1,925 @@
+# ============================================
+# FILE: backend/tests/test_rag_service.py
+# RAG Service Tests (no database / network)
+# ============================================
+
+import pytest
+
+from services import rag_service as rag_module
+from services.rag_service import RagService
+from rag.index import VectorIndex
+
+DOCS = [
+    {"id": "oxygen", "content": "Oxygen cylinder inventory protocol", "metadata": {}, "embedding": [1.0, 0.0, 0.0]},
+    {"id": "dengue", "content": "Dengue outbreak response", "metadata": {}, "embedding": [0.0, 1.0, 0.0]},
+    {"id": "icu", "content": "ICU capacity management", "metadata": {}, "embedding": [0.6, 0.0, 0.8]},
+]
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    """RagService with in-memory indexes and no external calls"""
+    def db_down(*args, **kwargs):
+        raise RuntimeError("DATABASE_URL not set")
+
+    monkeypatch.setattr(rag_module, "USE_PGVECTOR", False)
+    monkeypatch.setattr(rag_module, "LOCAL_VOCAB_FILE", str(tmp_path / "local_vocab.json"))
+    monkeypatch.setattr(rag_module, "search_lexical", db_down)
+    svc = RagService()
+    svc._rebuild_index(lambda: DOCS)
+    return svc
+
+def test_vector_index_top_k_order():
+    """Test index returns best matches first"""
+    index = VectorIndex(DOCS)
+    hits = index.search([1.0, 0.0, 0.1], top_k=2)
+    assert [doc["id"] for _, doc in hits] == ["oxygen", "icu"]
+    assert hits[0][0] > hits[1][0]
+
+def test_vector_index_skips_mismatched_dimensions():
+    """Test documents with wrong embedding size are left out"""
+    index = VectorIndex(DOCS + [{"id": "bad", "content": "x", "embedding": [1.0]}])
+    assert len(index) == 3
+    assert index.search([1.0], top_k=3) == []
+
+def test_retrieve_uses_index(service, monkeypatch):
+    """Test retrieval ranks from the in-memory index"""
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.0, 1.0, 0.0])
+    docs = service._retrieve_relevant("dengue cases", top_k=1)
+    assert docs[0]["id"] == "dengue"
+
+async def test_aquery_falls_back_offline(service, monkeypatch):
+    """Test async query returns offline answer when generation is rate limited"""
+    async def fake_embedding(query):
+        return [1.0, 0.0, 0.0]
+
+    async def rate_limited(prompt, **kwargs):
+        raise RuntimeError("429 Too Many Requests")
+
+    monkeypatch.setattr(service, "_aget_query_embedding", fake_embedding)
+    monkeypatch.setattr(rag_module, "agenerate_text", rate_limited)
+
+    result = await service.aquery("oxygen shortage procedure", top_k=1)
+    assert result["mode"] == "offline"
+    assert result["sources"][0]["id"] == "oxygen"
+
+def test_answer_cache_exact_semantic_and_invalidation():
+    """Test answer cache matches by question, then embedding, and drops stale answers"""
+    from rag.answer_cache import SemanticAnswerCache
+
+    cache = SemanticAnswerCache(maxsize=4, ttl=60, similarity_threshold=0.9)
+    scope = cache.make_scope({"aqi": 250}, top_k=3)
+    cache.put("Oxygen shortage procedure?", scope, [1.0, 0.0], {"answer": "A", "mode": "rag"}, ["oxygen"])
+
+    assert cache.get("oxygen shortage  procedure", scope)["cached"] == "exact"
+    assert cache.get("what to do when oxygen runs low", scope, [0.99, 0.05])["cached"] == "semantic"
+    assert cache.get("what to do when oxygen runs low", cache.make_scope(None, top_k=3), [0.99, 0.05]) is None
+
+    assert cache.invalidate_sources(["oxygen"]) == 1
+    assert cache.get("Oxygen shortage procedure?", scope) is None
+
+def test_retrieve_falls_back_to_bm25_when_database_down(service, monkeypatch):
+    """Test lexical BM25 ranking is used when Postgres and embeddings are unavailable"""
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: None)
+    docs = service._retrieve_relevant("ICU capacity", top_k=2)
+    assert docs[0]["id"] == "icu"
+
+def test_local_embedder_serves_vector_stage_when_api_down(service, monkeypatch):
+    """Test a failed embedding call falls back to the local index and then skips the API"""
+    calls = []
+
+    def api_down(text):
+        calls.append(text)
+        raise RuntimeError("503 Service Unavailable")
+
+    monkeypatch.setattr(rag_module, "get_cached_embedding", lambda text: None)
+    monkeypatch.setattr(rag_module, "set_cached_embedding", lambda text, emb: None)
+    monkeypatch.setattr(rag_module, "embed_text", api_down)
+
+    docs, info = service._retrieve("dengue outbreaks", top_k=1)
+    assert docs[0]["id"] == "dengue"
+    assert info["vector_backend"] == "local" and info["vector_hits"] > 0
+
+    service._retrieve("oxygen cylinders", top_k=1)
+    assert len(calls) == 1  # cooling down: the API is not retried
+
+def test_local_embedder_vocabulary_round_trip(tmp_path):
+    """Test the hashed n-gram embedder ranks by shared n-grams and persists its vocabulary"""
+    from rag.local_embed import HashedNgramEmbedder
+
+    texts = [d["content"] for d in DOCS]
+    embedder = HashedNgramEmbedder(dim=256, vocab_path=None)
+    vectors = embedder.fit_transform(texts)
+    scores = vectors @ embedder.embed_many(["oxygen inventory"])[0]
+    assert int(scores.argmax()) == 0
+
+    embedder.save(str(tmp_path / "vocab.json"))
+    loaded = HashedNgramEmbedder(dim=256, vocab_path=str(tmp_path / "vocab.json"))
+    assert loaded.doc_count == 3
+    assert loaded.embed("oxygen inventory") == pytest.approx(embedder.embed("oxygen inventory"))
+
+def test_cli_offline_retrieval_reuses_corpus_indexes(monkeypatch):
+    """Test the CLI builds its offline indexes once per corpus and then only searches them"""
+    from rag import cli
+
+    builds = []
+    real_builders = dict(cli._INDEX_BUILDERS)
+    monkeypatch.setattr(cli, "_INDEX_BUILDERS", {k: (lambda docs, k=k: builds.append(k) or real_builders[k](docs)) for k in real_builders})
+    monkeypatch.setattr(cli, "_INDEX_CACHE", type(cli._INDEX_CACHE)())
+
+    corpus = [dict(d) for d in DOCS]
+    first = cli.retrieve_relevant("dengue outbreak", 1, candidates=corpus, embed=False)
+    second = cli.retrieve_relevant("oxygen cylinder", 1, candidates=corpus, embed=False)
+    third = cli.retrieve_relevant("icu", 1, candidates=corpus, query_embedding=[0.6, 0.0, 0.8])
+    assert [first[0]["id"], second[0]["id"], third[0]["id"]] == ["dengue", "oxygen", "icu"]
+    assert sorted(builds) == ["bm25", "local", "vector"]
+
+def test_overlapping_rebuilds_publish_the_latest_snapshot_as_a_unit(service):
+    """Test a rebuild that loaded first can't swap its older snapshot in last"""
+    import threading
+
+    loading, release = threading.Event(), threading.Event()
+
+    def slow_older_load():
+        loading.set()
+        release.wait(2)
+        return DOCS[:1]
+
+    older = threading.Thread(target=service._rebuild_index, args=(slow_older_load,))
+    older.start()
+    assert loading.wait(2)
+    newer = threading.Thread(target=service._rebuild_index, args=(lambda: DOCS,))
+    newer.start()
+    release.set()
+    older.join(2)
+    newer.join(2)
+
+    indexes = service._indexes.index
+    assert len(indexes.vector) == len(indexes.bm25.docs) == len(indexes.local) == indexes.documents == 3
+    assert service.get_status()["index"]["documents"] == 3
+
+def test_cli_fetches_vectors_for_lexical_hits_by_id(monkeypatch):
+    """Test full-text hits carry no vectors; the CLI fetches them for its candidates only"""
+    from rag import cli
+
+    lean = [{"id": d["id"], "content": d["content"], "metadata": {}, "parent_id": None, "terms": None, "score": 0.1} for d in DOCS]
+    fetched = []
+    monkeypatch.setattr(cli, "search_lexical", lambda query, limit=50: [dict(h) for h in lean])
+    monkeypatch.setattr(cli, "get_documents", lambda ids: fetched.extend(ids) or [d for i in ids for d in DOCS if d["id"] == i])
+    top = cli.retrieve_relevant("icu", 1, query_embedding=[0.6, 0.0, 0.8])
+    assert top[0]["id"] == "icu" and fetched == [d["id"] for d in DOCS]
+
+def test_prompt_packs_best_documents_within_token_budget():
+    """Test prompt assembly trims at sentence boundaries and reports dropped tokens"""
+    from rag.prompt import build_prompt, estimate_tokens
+
+    long_doc = {"id": "long", "content": " ".join(f"Step {i} of the surge protocol applies." for i in range(200))}
+    docs = [DOCS[0], long_doc, DOCS[1]]
+    prompt, stats = build_prompt("Answer from the documents.\n\n", docs, "Question: oxygen?", budget=120)
+
+    assert estimate_tokens(prompt) <= 120
+    assert prompt.index("Oxygen cylinder") < prompt.index("Step 0 of the surge protocol applies.")
+    assert prompt.count("surge protocol applies.") < 200 and "Step 199" not in prompt
+    assert stats["documents_trimmed"] == 1 and stats["tokens_dropped"] > 0
+    assert stats["tokens_used"] == estimate_tokens(prompt)
+
+def test_query_reports_prompt_tokens(service, monkeypatch):
+    """Test query responses carry the prompt token accounting"""
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [1.0, 0.0, 0.0])
+    monkeypatch.setattr(rag_module, "generate_text", lambda prompt, **kwargs: "Check cylinder inventory.")
+
+    result = service.query("oxygen inventory", top_k=2)
+    assert result["prompt_tokens"]["documents_included"] == 2
+    assert result["prompt_tokens"]["tokens_used"] <= result["prompt_tokens"]["token_budget"]
+
+def test_concurrent_identical_queries_share_one_generation(service, monkeypatch):
+    """Test identical questions in flight at the same time coalesce into one upstream call"""
+    import threading
+    import time
+
+    calls = []
+    release = threading.Event()
+
+    def slow_generate(prompt, **kwargs):
+        calls.append(prompt)
+        release.wait(5)
+        return "Check cylinder inventory."
+
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [1.0, 0.0, 0.0])
+    monkeypatch.setattr(rag_module, "generate_text", slow_generate)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.query("Oxygen inventory?"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while service._query_flight.stats()["shared"] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert [r["answer"] for r in results] == ["Check cylinder inventory."] * 4
+    assert len({id(r) for r in results}) == 4  # callers get their own copies
+
+async def test_concurrent_identical_embeddings_share_one_request(monkeypatch):
+    """Test aembed_text coalesces concurrent requests for the same text"""
+    import asyncio
+    from rag import vertex
+
+    calls = []
+
+    async def slow_post(url, body, **kwargs):
+        calls.append(body)
+        await asyncio.sleep(0.01)
+        return {"embedding": {"values": [0.1, 0.2]}}
+
+    monkeypatch.setattr(vertex, "API_KEY", "test-key")
+    monkeypatch.setattr(vertex, "_apost", slow_post)
+
+    results = await asyncio.gather(*[vertex.aembed_text("oxygen shortage") for _ in range(5)])
+    assert len(calls) == 1
+    assert results == [[0.1, 0.2]] * 5
+    assert vertex._embed_flight.stats()["in_flight"] == 0
+
+async def test_llm_scheduler_serves_interactive_before_background():
+    """Test queued interactive calls are granted ahead of background ones"""
+    import asyncio
+    from rag.scheduler import LLMScheduler
+
+    scheduler = LLMScheduler(rpm=600, tpm=0)
+    scheduler._requests.level = 0  # request budget used up
+    order = []
+
+    async def call(priority):
+        await scheduler.aacquire(100, priority)
+        order.append(priority)
+
+    background = [asyncio.create_task(call("background")) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert scheduler.stats()["queue_depth"]["background"] == 2
+    await asyncio.gather(call("interactive"), *background)
+
+    assert order == ["interactive", "background", "background"]
+    stats = scheduler.stats()
+    assert stats["granted"]["background"] == 2 and stats["queue_depth"]["background"] == 0
+
+def test_llm_scheduler_token_budget_and_rate_limit_pause():
+    """Test token-per-minute budget and a 429 pause hold back the next call"""
+    import time
+    from rag.scheduler import LLMScheduler
+
+    scheduler = LLMScheduler(rpm=0, tpm=6000)  # 100 tokens per second
+    scheduler.acquire(6000).settle(5990)
+    started = time.monotonic()
+    scheduler.acquire(20)
+    assert time.monotonic() - started >= 0.05
+
+    scheduler.penalize(0.2)
+    started = time.monotonic()
+    scheduler.acquire(0, "batch")
+    assert time.monotonic() - started >= 0.15
+    assert scheduler.stats()["rate_limited"] == 1
+
+async def test_agent_llm_calls_go_through_scheduler():
+    """Test LangChain chat models with the scheduler callback take a background permit"""
+    from langchain_core.language_models import FakeListChatModel
+    from core.llm_scheduler import get_scheduler, scheduled
+
+    before = get_scheduler().stats()["granted"]["background"]
+    llm = FakeListChatModel(responses=["ok"], callbacks=scheduled("background"))
+    result = await llm.ainvoke("status?")
+    assert result.content == "ok"
+    assert get_scheduler().stats()["granted"]["background"] == before + 1
+
+async def test_agent_llm_errors_refund_tokens_and_pause_only_on_rate_limits(monkeypatch):
+    """Test a failed agent call returns its token estimate and only ResourceExhausted pauses callers"""
+    from uuid import uuid4
+    from google.api_core.exceptions import ResourceExhausted
+    from rag.scheduler import LLMScheduler
+    from core import llm_scheduler
+
+    scheduler = LLMScheduler(rpm=0, tpm=60000)
+    monkeypatch.setattr(llm_scheduler, "get_scheduler", lambda: scheduler)
+    callback = llm_scheduler.SchedulerCallback(max_output_tokens=1000)
+
+    for error in (ValueError("upstream said 429 somewhere"), ResourceExhausted("quota exceeded")):
+        run_id = uuid4()
+        await callback.on_chat_model_start({}, [[]], run_id=run_id)
+        assert scheduler.stats()["tokens_available"] < 59500
+        await callback.on_llm_error(error, run_id=run_id)
+        assert scheduler.stats()["tokens_available"] >= 59999
+    assert scheduler.stats()["rate_limited"] == 1
+
+def test_vertex_reuses_pooled_client_and_enforces_total_timeout(monkeypatch):
+    """Test sync calls share one keep-alive client and give up after the total timeout"""
+    import asyncio
+    import httpx
+    from rag import vertex
+
+    connections = []
+
+    def handler(request):
+        connections.append(request.url.path)
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "ok"}]}}],
+                                         "usageMetadata": {"totalTokenCount": 12}})
+
+    monkeypatch.setattr(vertex, "API_KEY", "test-key")
+    monkeypatch.setattr(vertex, "_client", httpx.Client(transport=httpx.MockTransport(handler)))
+    client = vertex._get_client()
+    assert vertex.generate_text("hello") == "ok"
+    assert vertex.generate_text("hello again") == "ok"
+    assert vertex._get_client() is client and len(connections) == 2
+
+    monkeypatch.setattr(vertex, "HTTP_TOTAL_TIMEOUT", -1.0)
+    with pytest.raises(RuntimeError, match="max retries exceeded") as raised:
+        vertex._post("https://example.invalid/v1", {}, max_retries=0)
+    assert isinstance(raised.value.__cause__, httpx.TimeoutException)
+
+    vertex.close_clients()
+    assert client.is_closed and vertex._get_client() is not client
+    vertex.close_clients()
+
+    async def loop_client():
+        client = vertex._get_async_client()
+        assert vertex._get_async_client() is client
+        return client, list(vertex._async_clients.values())
+
+    first, _ = asyncio.run(loop_client())
+    second, live = asyncio.run(loop_client())
+    # one client per loop; the closed loop's client is dropped rather than kept alive
+    assert second is not first and live == [second]
+
+    async def shutdown():
+        client, _ = await loop_client()
+        await vertex.aclose_clients()
+        return client
+
+    assert asyncio.run(shutdown()).is_closed and not vertex._async_clients
+
+def test_initialize_counts_then_warms_index_in_background(monkeypatch, tmp_path):
+    """Test startup only counts rows and status is served from cached stats"""
+    import threading
+
+    release = threading.Event()
+    loads = []
+
+    def slow_load(conn=None):
+        loads.append(1)
+        release.wait(5)
+        return DOCS
+
+    monkeypatch.setattr(rag_module, "USE_PGVECTOR", False)
+    monkeypatch.setattr(rag_module, "LOCAL_VOCAB_FILE", str(tmp_path / "local_vocab.json"))
+    monkeypatch.setattr(rag_module, "init_db", lambda: None)
+    monkeypatch.setattr(rag_module, "corpus_stats", lambda conn=None: {"documents": 3, "last_ingest_at": "2026-01-01T00:00:00+00:00"})
+    monkeypatch.setattr(rag_module, "ping", lambda conn=None: None)
+    monkeypatch.setattr(rag_module, "get_all_documents", slow_load)
+    svc = RagService()
+
+    result = svc.initialize()
+    assert result["document_count"] == 3
+    assert svc.get_status()["index"]["state"] == "warming"
+
+    release.set()
+    svc._warm_up_thread.join(5)
+    status = svc.get_status()
+    assert len(loads) == 1
+    assert status["document_count"] == 3 and status["last_ingest_at"].startswith("2026-01-01")
+    assert status["index"]["state"] == "ready" and status["index"]["documents"] == 3
+    assert status["index"]["vector_index_bytes"] > 0 and "build_ms" in status["index"]
+
+    def db_down(conn=None):
+        raise RuntimeError("connection refused")
+
+    # fresh stats are still served, but the outage shows up right away
+    monkeypatch.setattr(rag_module, "ping", db_down)
+    status = svc.get_status()
+    assert status["status"] == "unhealthy" and status["database_connected"] is False
+    assert status["document_count"] == 3 and status["stats_age_s"] is not None
+
+def test_metadata_filters_match_jsonb_containment():
+    """Test filter bitmaps follow Postgres metadata @> semantics"""
+    from rag.filters import MetadataBitmaps, matches
+
+    metas = [
+        {"category": "icu", "tags": ["oxygen", "ventilator"], "level": 1},
+        {"category": "icu", "tags": ["beds"], "source": {"kind": "sop"}},
+        {"category": "outbreak", "level": 1.0},
+        {},
+    ]
+    bitmaps = MetadataBitmaps([{"metadata": m} for m in metas])
+    for filters in ({"category": "icu"}, {"tags": ["oxygen"]}, {"tags": "oxygen"}, {"level": 1},
+                    {"source": {"kind": "sop"}}, {"category": "icu", "tags": ["beds"]}, {"tags": []}):
+        expected = [i for i, m in enumerate(metas) if matches(m, filters)]
+        assert bitmaps.rows(filters).tolist() == expected
+    assert bitmaps.rows({"category": "icu"}).tolist() == [0, 1]
+    assert bitmaps.rows({"level": 1}).tolist() == [0, 2]
+    assert bitmaps.rows({"tags": "oxygen"}).tolist() == []
+
+def test_filtered_retrieval_only_scores_matching_documents(service, monkeypatch):
+    """Test metadata filters restrict both in-memory stages and key the answer cache"""
+    docs = [dict(d, metadata={"category": "icu" if d["id"] == "icu" else "general"}) for d in DOCS]
+    service._rebuild_index(lambda: docs)
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [1.0, 0.0, 0.0])
+    monkeypatch.setattr(rag_module, "generate_text", lambda prompt, **kwargs: "Answer.")
+
+    hits, info = service._retrieve("oxygen capacity", top_k=3, query_embedding=[1.0, 0.0, 0.0],
+                                   filters={"category": "icu"})
+    assert [d["id"] for d in hits] == ["icu"]
+    assert info["filters"] == {"category": "icu"}
+
+    unfiltered = service.query("oxygen cylinder", top_k=1)
+    filtered = service.query("oxygen cylinder", top_k=1, filters={"category": "icu"})
+    assert unfiltered["sources"][0]["id"] == "oxygen"
+    assert filtered["sources"][0]["id"] == "icu" and "cached" not in filtered
+    with pytest.raises(ValueError):
+        service.query("oxygen capacity", filters=["icu"])
+
+def test_reciprocal_rank_fusion_weights():
+    """Test RRF merges rankings and honours per-stage weights"""
+    from rag.hybrid import reciprocal_rank_fusion
+
+    a, b, c = {"id": "a"}, {"id": "b"}, {"id": "c"}
+    fused = reciprocal_rank_fusion({"lexical": [a, b], "vector": [b, c]}, k=60)
+    assert [doc["id"] for _, doc in fused] == ["b", "a", "c"]
+
+    vector_only = reciprocal_rank_fusion({"lexical": [a, b], "vector": [c, b]}, {"lexical": 0.0}, k=60)
+    assert [doc["id"] for _, doc in vector_only] == ["c", "b"]
+
+def test_query_reports_stage_timings(service, monkeypatch):
+    """Test hybrid query response carries per-stage timings"""
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.6, 0.0, 0.8])
+    monkeypatch.setattr(rag_module, "generate_text", lambda prompt, **kwargs: "Use ICU surge beds.")
+
+    result = service.query("ICU capacity plan", top_k=2)
+    assert result["mode"] == "rag"
+    assert result["sources"][0]["id"] == "icu"
+    for stage in ("embedding_ms", "lexical_ms", "vector_ms", "fusion_ms", "generation_ms"):
+        assert stage in result["timings"]
+
+def test_chunking_respects_size_and_groups_sources():
+    """Test chunks stay within budget, overlap, and group back to their source"""
+    from rag.chunking import chunk_document, group_by_source
+
+    text = " ".join(f"Step {i} of the oxygen protocol is documented here." for i in range(40))
+    chunks = chunk_document("oxygen", text, {"category": "protocol"}, size=200, overlap=60)
+    assert len(chunks) > 1
+    assert all(len(c["content"]) <= 200 for c in chunks)
+    assert chunks[0]["content"].split(". ")[-1].rstrip(".") in chunks[1]["content"]
+    assert chunks[1]["id"] == "oxygen#1" and chunks[1]["metadata"]["chunk_count"] == len(chunks)
+
+    groups = group_by_source([chunks[2], {"id": "icu", "metadata": {}}, chunks[0]])
+    assert [g["id"] for g in groups] == ["oxygen", "icu"]
+    assert [c["id"] for c in groups[0]["chunks"]] == ["oxygen#2", "oxygen#0"]
+
+async def test_astream_query_sends_sources_then_tokens(service, monkeypatch):
+    """Test streaming query emits sources first, then tokens, then the full answer"""
+    async def fake_embedding(query):
+        return [1.0, 0.0, 0.0]
+
+    async def fake_stream(prompt, **kwargs):
+        for piece in ["Check ", "cylinder ", "stock."]:
+            yield piece
+
+    monkeypatch.setattr(service, "_aget_query_embedding", fake_embedding)
+    monkeypatch.setattr(rag_module, "astream_generate_text", fake_stream)
+
+    events = [event async for event in service.astream_query("oxygen shortage procedure", top_k=1)]
+    assert [e["event"] for e in events] == ["sources", "token", "token", "token", "done"]
+    assert events[0]["sources"][0]["id"] == "oxygen"
+    assert events[-1]["answer"] == "Check cylinder stock."
+    assert "first_token_ms" in events[-1]["timings"]
+
+    cached = await service.aquery("oxygen shortage procedure", top_k=1)
+    assert cached["cached"] == "exact"
+
+async def test_aquery_answers_extractively_when_generation_misses_deadline(service, monkeypatch):
+    """Test hedged query returns the extractive answer at the deadline and delivers the LLM answer later"""
+    import asyncio
+
+    async def fake_embedding(query):
+        return [1.0, 0.0, 0.0]
+
+    async def slow_generate(prompt, **kwargs):
+        await asyncio.sleep(0.3)
+        return "Check cylinder stock."
+
+    late = asyncio.get_running_loop().create_future()
+
+    async def on_late_answer(response):
+        late.set_result(response)
+
+    monkeypatch.setattr(service, "_aget_query_embedding", fake_embedding)
+    monkeypatch.setattr(rag_module, "agenerate_text", slow_generate)
+
+    result = await service.aquery("oxygen shortage procedure", top_k=1, deadline=0.05, on_late_answer=on_late_answer)
+    assert result["mode"] == "extractive" and result["late_answer"] == "pending"
+    assert result["sources"][0]["id"] == "oxygen"
+    assert result["timings"]["generation_ms"] < 250
+
+    late_response = await asyncio.wait_for(late, 2)
+    assert late_response["mode"] == "rag" and late_response["answer"] == "Check cylinder stock."
+    assert (await service.aquery("oxygen shortage procedure", top_k=1))["cached"] == "exact"
+
+    latency = service._latency.stats()
+    assert latency["extractive"]["count"] == 1 and latency["late_rag"]["count"] == 1
+    assert latency["cached"]["count"] == 1
+
+async def test_astream_query_sends_late_answer_after_hedged_done(service, monkeypatch):
+    """Test streaming query hedges on a slow first token and streams the LLM answer as late_answer"""
+    import asyncio
+
+    async def fake_embedding(query):
+        return [1.0, 0.0, 0.0]
+
+    async def slow_stream(prompt, **kwargs):
+        await asyncio.sleep(0.2)
+        for piece in ["Check ", "stock."]:
+            yield piece
+
+    monkeypatch.setattr(service, "_aget_query_embedding", fake_embedding)
+    monkeypatch.setattr(rag_module, "astream_generate_text", slow_stream)
+
+    events = [e async for e in service.astream_query("oxygen shortage procedure", top_k=1, deadline=0.05)]
+    assert [e["event"] for e in events] == ["sources", "token", "done", "late_answer"]
+    assert events[2]["mode"] == "extractive" and events[1]["text"] == events[2]["answer"]
+    assert events[3]["mode"] == "rag" and events[3]["answer"] == "Check stock."
+
+def test_query_deadline_returns_extractive_answer(service, monkeypatch):
+    """Test sync query answers extractively at the deadline and hands the late answer to the callback"""
+    import threading
+
+    release = threading.Event()
+    delivered = []
+    done = threading.Event()
+
+    def slow_generate(prompt, **kwargs):
+        release.wait(2)
+        return "Use ICU surge beds."
+
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.6, 0.0, 0.8])
+    monkeypatch.setattr(rag_module, "generate_text", slow_generate)
+
+    result = service.query("ICU capacity plan", top_k=1, deadline=0.05,
+                           on_late_answer=lambda r: (delivered.append(r), done.set()))
+    assert result["mode"] == "extractive"
+    release.set()
+    assert done.wait(2)
+    assert delivered[0]["mode"] == "rag" and delivered[0]["answer"] == "Use ICU surge beds."
+
+def test_late_generations_are_capped_and_reported(service, monkeypatch):
+    """Test deadline queries stop queueing generations behind late ones and status counts them"""
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    release = threading.Event()
+    calls = []
+
+    def slow_generate(prompt, **kwargs):
+        calls.append(prompt)
+        release.wait(2)
+        return "Use ICU surge beds."
+
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.6, 0.0, 0.8])
+    monkeypatch.setattr(rag_module, "generate_text", slow_generate)
+    monkeypatch.setattr(rag_module, "MAX_LATE_GENERATIONS", 1)
+    service._generation_executor = ThreadPoolExecutor(max_workers=1)
+
+    assert service.query("ICU capacity plan", top_k=1, deadline=0.05)["late_answer"] == "pending"
+    # the late call holds the limit: the next query answers without calling the LLM
+    shed = service.query("Oxygen cylinder inventory", top_k=1, deadline=0.05)
+    assert shed["mode"] == "extractive" and "late_answer" not in shed and len(calls) == 1
+    status = service._generation_status()
+    assert status["late"] == 1 and status["shed"] == 1
+
+    # under the limit but with no free worker, a call still queued at the deadline is dropped
+    monkeypatch.setattr(rag_module, "MAX_LATE_GENERATIONS", 5)
+    queued = service.query("Dengue outbreak response", top_k=1, deadline=0.05)
+    assert "late_answer" not in queued and len(calls) == 1
+    assert service._generation_status()["shed"] == 2
+
+    release.set()
+    for _ in range(100):
+        if service._generation_status()["late"] == 0:
+            break
+        time.sleep(0.01)
+    assert service._generation_status()["late"] == 0
+    service.shutdown()
+
+def test_query_deadline_treats_generation_timeout_as_failure(service, monkeypatch):
+    """Test a TimeoutError raised by generation takes the offline fallback, not the hedged path"""
+    def timed_out(prompt, **kwargs):
+        raise TimeoutError("read timeout")
+
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.6, 0.0, 0.8])
+    monkeypatch.setattr(rag_module, "generate_text", timed_out)
+
+    result = service.query("ICU capacity plan", top_k=1, deadline=5)
+    assert result["mode"] == "offline" and "late_answer" not in result
+
+@pytest.mark.parametrize("error", ["dns", "deadline", "read_timeout"])
+def test_query_falls_back_offline_on_httpx_transport_errors(service, monkeypatch, error):
+    """Test sync generation failures from httpx get the offline answer whatever their message says"""
+    import httpx
+    from rag import vertex
+
+    errors = {
+        "dns": httpx.ConnectError("[Errno -2] Name or service not known"),
+        "deadline": httpx.TimeoutException("No complete response within 120s"),
+        "read_timeout": httpx.ReadTimeout("timed out"),
+    }
+
+    assert vertex.is_unavailable_error(errors[error])
+
+    def handler(request):
+        raise errors[error]
+
+    monkeypatch.setattr(vertex, "API_KEY", "test-key")
+    monkeypatch.setattr(vertex, "_client", httpx.Client(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(vertex.time, "sleep", lambda s: None)
+    monkeypatch.setattr(rag_module, "generate_text", vertex.generate_text)
+    monkeypatch.setattr(service, "_get_query_embedding", lambda q: [0.6, 0.0, 0.8])
+
+    with pytest.raises(RuntimeError, match="max retries exceeded") as raised:
+        vertex._post("https://example.invalid/v1", {}, max_retries=0)
+    assert isinstance(raised.value.__cause__, httpx.TransportError)
+
+    assert service.query("ICU capacity plan", top_k=1)["mode"] == "offline"
+    assert service.query("ICU capacity plan", top_k=1, deadline=5)["mode"] == "offline"
+    vertex.close_clients()
+
+def test_precomputed_features_match_on_the_fly_scoring():
+    """Test persisted term frequencies and norms give the same rankings as raw content"""
+    from rag.bm25 import BM25Index
+    from rag.index import embedding_norm
+    from rag.text import term_frequencies
+
+    enriched = [dict(d, terms=term_frequencies(d["content"]), embedding_norm=embedding_norm(d["embedding"])) for d in DOCS]
+    raw_hits = VectorIndex(DOCS).search([1.0, 0.0, 0.1], top_k=3)
+    hits = VectorIndex(enriched).search([1.0, 0.0, 0.1], top_k=3)
+    assert [d["id"] for _, d in hits] == [d["id"] for _, d in raw_hits]
+    assert [round(s, 5) for s, _ in hits] == [round(s, 5) for s, _ in raw_hits]
+
+    assert BM25Index(enriched).search("ICU capacity", 1)[0][1]["id"] == "icu"
+    # confidence reads the stored token set rather than the content
+    assert RagService()._calculate_confidence([{"content": "", "terms": {"icu": 1}}], "icu") > 0
+
+def test_quantized_index_reranks_to_exact_order():
+    """Test float16/int8 indexes shrink vector storage and keep float32 results after re-rank"""
+    import numpy as np
+    from rag.index import recall_at_k
+    from rag.db import _row_to_doc
+    from rag.cache import pack_embedding
+
+    rng = np.random.default_rng(7)
+    docs = [{"id": str(i), "embedding": rng.normal(size=32).tolist()} for i in range(500)]
+    queries = [rng.normal(size=32).tolist() for _ in range(20)]
+    report = recall_at_k(docs, queries, k=5, rerank_factor=4)
+    assert report["float16"]["recall"] == report["int8"]["recall"] == 1.0
+    assert report["int8"]["nbytes"] < report["float16"]["nbytes"] < report["float32"]["nbytes"]
+
+    fetched = []
+    vectors = {d["id"]: d["embedding"] for d in DOCS}
+    index = VectorIndex(DOCS, precision="int8", fetch_embeddings=lambda ids: fetched.extend(ids) or {i: vectors[i] for i in ids})
+    hits = index.search([1.0, 0.0, 0.1], top_k=2)
+    assert [d["id"] for _, d in hits] == ["oxygen", "icu"] and sorted(fetched) == sorted(vectors)
+    # the quantized matrix is the only vector storage; reported size matches what is kept
+    assert all("embedding" not in d for d in index.docs) and "embedding" in DOCS[0]
+    assert index.nbytes == index.matrix.nbytes + index.scales.nbytes
+
+    def db_down(ids):
+        raise RuntimeError("connection refused")
+
+    index = VectorIndex(DOCS, precision="int8", fetch_embeddings=db_down)
+    assert [d["id"] for _, d in index.search([1.0, 0.0, 0.1], top_k=2)] == ["oxygen", "icu"]
+
+    # binary column round-trips as a float32 array and takes precedence over the JSONB column
+    row = ("x", "text", {}, None, None, None, None, pack_embedding([0.5, -1.0]))
+    embedding = _row_to_doc(row)["embedding"]
+    assert isinstance(embedding, np.ndarray) and embedding.tolist() == [0.5, -1.0]
+    assert VectorIndex([_row_to_doc(row)]).dim == 2
+
+def test_sync_documents_skips_unchanged_and_prunes(monkeypatch):
+    """Test re-ingestion is keyed on stable content hashes and only embeds changes"""
+    from rag import ingest
+
+    rows = {}
+    embedded = []
+
+    def fake_hashes(ids, conn=None):
+        stored = {}
+        for row in rows.values():
+            stored[row[4] or row[0]] = row[5]
+        return {i: stored[i] for i in ids if i in stored}
+
+    def fake_insert(new_rows, conn=None, replace_parents=False):
+        parents = {r[4] for r in new_rows}
+        for key in [k for k, r in rows.items() if r[4] in parents]:
+            del rows[key]
+        rows.update({r[0]: r for r in new_rows})
+
+    def fake_delete(ids, conn=None):
+        for key in [k for k, r in rows.items() if (r[4] or r[0]) in ids]:
+            del rows[key]
+
+    monkeypatch.setattr(ingest, "get_content_hashes", fake_hashes)
+    monkeypatch.setattr(ingest, "insert_documents", fake_insert)
+    monkeypatch.setattr(ingest, "delete_documents", fake_delete)
+    monkeypatch.setattr(ingest, "get_source_ids", lambda conn=None: sorted({r[4] or r[0] for r in rows.values()}))
+    monkeypatch.setattr(ingest, "embed_with_cache", lambda texts, **kw: embedded.extend(texts) or [[1.0]] * len(texts))
+
+    corpus = [{"content": "Oxygen protocol"}, {"id": "icu", "content": "ICU surge plan"}]
+    first = ingest.sync_documents(corpus)
+    assert first["summary"]["added"] == 2
+    assert ingest.document_id("Oxygen protocol") in first["added"]
+
+    embedded.clear()
+    second = ingest.sync_documents([corpus[0], {"id": "icu", "content": "ICU surge plan v2"}, {"id": "new", "content": "Dengue"}], prune=True)
+    assert second["summary"] == {"added": 1, "updated": 1, "skipped": 1, "deleted": 0, "failed": 0}
+    assert embedded == ["ICU surge plan v2", "Dengue"]
+
+    third = ingest.sync_documents([{"id": "new", "content": "Dengue"}], prune=True)
+    assert third["skipped"] == ["new"]
+    assert sorted(third["deleted"]) == sorted([ingest.document_id("Oxygen protocol"), "icu"])
+
+def test_sources_stream_jsonl_text_dirs_and_json_arrays(tmp_path):
+    """Test ingestion sources parse each format incrementally"""
+    import json
+    from rag.sources import iter_source, iter_json_array
+
+    docs = [{"id": f"d{i}", "content": f"Protocol {i} " + "x" * 50, "metadata": {"n": i * 1.5}} for i in range(20)]
+    array = tmp_path / "docs.json"
+    array.write_text(json.dumps(docs, indent=1), encoding="utf-8")
+    assert list(iter_json_array(str(array), read_size=7)) == docs
+    assert list(iter_source(str(array))) == docs
+
+    lines = tmp_path / "docs.jsonl"
+    lines.write_text("\n".join(json.dumps(d) for d in docs[:3]) + "\n\n", encoding="utf-8")
+    assert [d["id"] for d in iter_source(str(lines))] == ["d0", "d1", "d2"]
+
+    library = tmp_path / "library"
+    (library / "icu").mkdir(parents=True)
+    (library / "icu" / "surge.md").write_text("# ICU surge\n\nOpen overflow beds.", encoding="utf-8")
+    (library / "oxygen.txt").write_text("Check cylinder stock daily.", encoding="utf-8")
+    (library / "empty.txt").write_text("  ", encoding="utf-8")
+    (library / "image.png").write_bytes(b"\x89PNG")
+    texts = list(iter_source(str(library)))
+    assert [d["id"] for d in texts] == ["oxygen.txt", "icu/surge.md"]
+    assert texts[1]["metadata"] == {"source": "icu/surge.md", "format": "md", "title": "ICU surge"}
+
+    (tmp_path / "bad.json").write_text('{"id": "x"}', encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_source(str(tmp_path / "bad.json")))
+
+def test_ingest_stream_pulls_one_group_at_a_time(monkeypatch):
+    """Test streaming ingestion reads, embeds and upserts in bounded groups"""
+    from rag import ingest
+
+    pulled = []
+    upserts = []
+
+    def source():
+        for i in range(10):
+            pulled.append(i)
+            yield {"id": f"d{i}", "content": f"Document {i}"}
+
+    def fake_insert(rows, conn=None, replace_parents=False):
+        # the source must not have been read past the group being written
+        upserts.append((len(rows), len(pulled)))
+
+    monkeypatch.setattr(ingest, "get_content_hashes", lambda ids, conn=None: {})
+    monkeypatch.setattr(ingest, "insert_documents", fake_insert)
+    monkeypatch.setattr(ingest, "embed_with_cache", lambda texts, **kw: [[1.0]] * len(texts))
+    monkeypatch.setattr(ingest, "get_source_ids", lambda conn=None: ["d0", "gone"])
+    monkeypatch.setattr(ingest, "delete_documents", lambda ids, conn=None: None)
+
+    progress = []
+    result = ingest.ingest_stream(source(), prune=True, group_size=4, on_group=progress.append)
+    assert upserts == [(4, 4), (4, 8), (2, 10)]
+    assert result["summary"] == {"added": 10, "updated": 0, "skipped": 0, "deleted": 1, "failed": 0}
+    assert result["documents"] == 10 and result["chunks"] == 10 and result["groups"] == 3
+    assert [p["documents"] for p in progress] == [4, 8, 10]
+    assert "docs_per_s" in result
+
+def test_queue_processor_retries_and_dead_letters(tmp_path):
+    """Test queue workers claim files once, retry failures and dead-letter poison files"""
+    import json
+    import os
+    from rag.worker import QueueProcessor
+
+    for i in range(6):
+        (tmp_path / f"doc{i}.json").write_text(json.dumps({"id": f"d{i}", "content": "x"}))
+    (tmp_path / "poison.json").write_text(json.dumps({"id": "bad", "content": "x"}))
+    (tmp_path / "broken.json").write_text("{not json")
+
+    seen = []
+    flaky = {"doc3.json": 1}
+
+    def process_batch(items):
+        errors = {}
+        for name, doc in items:
+            seen.append(name)
+            if name == "poison.json":
+                errors[name] = "embedding failed"
+            elif flaky.get(name):
+                flaky[name] -= 1
+                errors[name] = "429 Too Many Requests"
+        return errors
+
+    processor = QueueProcessor(process_batch, str(tmp_path), workers=3, batch_files=2, max_attempts=3, retry_base=0)
+    stats = processor.run()
+
+    assert stats["completed"] == 6 and stats["dead_lettered"] == 2 and stats["retried"] == 3
+    assert seen.count("doc0.json") == 1 and seen.count("doc3.json") == 2 and seen.count("poison.json") == 3
+    assert sorted(os.listdir(tmp_path / "dead-letter")) == ["broken.json", "poison.json"]
+    assert json.loads((tmp_path / "dead-letter" / "poison.json").read_text())["_attempts"] == 3
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".json")]
+    assert json.loads(open(processor.checkpoint_path).read())["status"] == "finished"
+
+def test_rag_websocket_streams_questions_concurrently_and_reports_bad_messages(monkeypatch):
+    """Test /ws/rag answers each question in its own task and turns bad messages into error events"""
+    import asyncio
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    import main
+
+    class FakeRag:
+        async def astream_query(self, question, **kwargs):
+            yield {"event": "done", "answer": question, "top_k": kwargs["top_k"]}
+            if question == "slow":
+                await asyncio.sleep(0.3)
+                yield {"event": "late_answer", "answer": "late"}
+
+    monkeypatch.setattr(main, "get_rag_service", lambda: FakeRag())
+    app = FastAPI()
+    app.add_api_websocket_route("/ws/rag", main.rag_websocket_endpoint)
+
+    with TestClient(app).websocket_connect("/ws/rag") as ws:
+        ws.send_text("not json")
+        assert ws.receive_json()["event"] == "error"
+        ws.send_json(["question"])
+        assert ws.receive_json()["event"] == "error"
+        ws.send_json({"question": "x", "top_k": 500, "id": 7})
+        error = ws.receive_json()
+        assert error["event"] == "error" and error["id"] == 7 and "top_k" in error["error"]
+
+        ws.send_json({"question": "slow", "id": 1})
+        ws.send_json({"question": "fast", "id": 2, "top_k": 5})
+        events = [ws.receive_json() for _ in range(3)]
+    assert [(e["event"], e["id"]) for e in events] == [("done", 1), ("done", 2), ("late_answer", 1)]
+    assert events[1]["top_k"] == 5
+
+def test_init_db_skips_ddl_when_schema_is_current_and_builds_indexes_concurrently():
+    """Test init_db only runs DDL for what the catalog says is missing"""
+    from rag import db
+
+    class FakeCursor:
+        def __init__(self, conn):
+            self.conn = conn
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def execute(self, sql, params=None):
+            self.conn.executed.append((sql, self.conn.autocommit))
+        def fetchall(self):
+            sql = self.conn.executed[-1][0]
+            if "information_schema.columns" in sql:
+                return [(c,) for c in self.conn.columns]
+            return list(self.conn.indexes.items())
+
+    class FakeConn:
+        def __init__(self, columns, indexes):
+            self.columns, self.indexes = columns, indexes
+            self.executed = []
+            self.autocommit = False
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def cursor(self):
+            return FakeCursor(self)
+
+    def ddl(conn):
+        return [(sql, autocommit) for sql, autocommit in conn.executed if not sql.startswith("SELECT")]
+
+    current = FakeConn(["id", "content", "metadata", "embedding", *db._COLUMNS], {n: True for n in db._INDEXES})
+    db._ensure_schema(current)
+    assert ddl(current) == []
+
+    # an interrupted concurrent build left the tsvector index invalid; one column is missing
+    stale = FakeConn(["id", "content", "metadata", "embedding", "parent_id"],
+                     {"documents_parent_id_idx": True, "documents_content_tsv_idx": False})
+    db._ensure_schema(stale)
+    statements = ddl(stale)
+    assert not any("ALTER TABLE documents ADD COLUMN IF NOT EXISTS parent_id" in sql for sql, _ in statements)
+    assert all(not autocommit for sql, autocommit in statements if sql.startswith(("ALTER", "CREATE TABLE")))
+    concurrent = [sql for sql, autocommit in statements if "CONCURRENTLY" in sql and autocommit]
+    assert concurrent == [
+        "DROP INDEX CONCURRENTLY IF EXISTS documents_content_tsv_idx",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS documents_metadata_idx ON documents USING gin (metadata jsonb_path_ops)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS documents_content_tsv_idx ON documents USING gin (content_tsv)",
+    ]
+    assert stale.autocommit is False
@@ -1,3 +1,3 @@
 """RAG helper package"""
 
-__all__ = ["cli", "db", "vertex", "cache", "ingest"]
+__all__ = ["cli", "db", "vertex", "cache", "ingest", "index", "answer_cache", "text", "bm25", "hybrid", "chunking", "worker", "bench", "local_embed", "prompt", "singleflight", "scheduler", "filters", "sources", "hedging", "metrics"]
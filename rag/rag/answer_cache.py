@@ -0,0 +1,149 @@
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip().rstrip("?!. ")
+
+
+class _Entry:
+    __slots__ = ("scope", "embedding", "response", "source_ids", "expires_at")
+
+    def __init__(self, scope, embedding, response, source_ids, expires_at):
+        self.scope = scope
+        self.embedding = embedding
+        self.response = response
+        self.source_ids = source_ids
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """TTL/LRU cache of generated answers, keyed by question and scope.
+
+    Lookup is an exact match on the normalized question within a scope
+    (dashboard context, top_k), then a nearest-neighbour match on the query
+    embedding among entries of the same scope. Entries remember the ids of the
+    documents they were built from so re-ingesting any of them drops the answer.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0, similarity_threshold: float = 0.95):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_source: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidated": 0, "evicted": 0}
+
+    @staticmethod
+    def make_scope(context: Optional[Dict[str, Any]] = None, **extra) -> str:
+        return json.dumps({"context": context or {}, **extra}, sort_keys=True, default=str)
+
+    def get(self, question: str, scope: str, embedding: Optional[List[float]] = None) -> Optional[Dict[str, Any]]:
+        if self.maxsize <= 0:
+            return None
+        key = self._key(question, scope)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                return dict(entry.response, cached="exact")
+
+            if embedding is not None:
+                best_key, best_sim = self._nearest(scope, embedding)
+                if best_key is not None and best_sim >= self.similarity_threshold:
+                    self._entries.move_to_end(best_key)
+                    self._stats["semantic_hits"] += 1
+                    return dict(self._entries[best_key].response, cached="semantic")
+                self._stats["misses"] += 1
+        return None
+
+    def put(self, question: str, scope: str, embedding: Optional[List[float]],
+            response: Dict[str, Any], source_ids: Iterable[str]) -> None:
+        if self.maxsize <= 0:
+            return
+        key = self._key(question, scope)
+        vec = _unit(embedding)
+        source_ids = set(source_ids)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = _Entry(scope, vec, response, source_ids, time.monotonic() + self.ttl)
+            for sid in source_ids:
+                self._by_source.setdefault(sid, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._stats["evicted"] += 1
+
+    def invalidate_sources(self, source_ids: Iterable[str]) -> int:
+        """Drop every answer built from any of `source_ids`."""
+        removed = 0
+        with self._lock:
+            for sid in source_ids:
+                for key in list(self._by_source.get(sid, ())):
+                    if self._drop(key):
+                        removed += 1
+            self._stats["invalidated"] += removed
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_source.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), maxsize=self.maxsize)
+
+    def _key(self, question: str, scope: str) -> str:
+        return f"{scope}\x00{normalize_question(question)}"
+
+    def _nearest(self, scope: str, embedding: List[float]):
+        q = _unit(embedding)
+        if q is None:
+            return None, -1.0
+        keys, vecs = [], []
+        for key, entry in self._entries.items():
+            if entry.scope == scope and entry.embedding is not None and len(entry.embedding) == len(q):
+                keys.append(key)
+                vecs.append(entry.embedding)
+        if not keys:
+            return None, -1.0
+        sims = np.stack(vecs) @ q
+        best = int(np.argmax(sims))
+        return keys[best], float(sims[best])
+
+    def _expire(self, now: float) -> None:
+        expired = [k for k, e in self._entries.items() if e.expires_at <= now]
+        for key in expired:
+            self._drop(key)
+
+    def _drop(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for sid in entry.source_ids:
+            keys = self._by_source.get(sid)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_source[sid]
+        return True
+
+
+def _unit(embedding) -> Optional[np.ndarray]:
+    if embedding is None or not len(embedding):
+        return None
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else None
@@ -0,0 +1,236 @@
+"""Offline retrieval benchmark: latency, throughput, recall@k and memory.
+
+Documents come from data/medical_documents.json with their embeddings from
+the cache (cache/embeddings.json, then the binary store); nothing calls the
+embedding API or Postgres. Two query sets are run against each target:
+
+* labelled questions, ranked by BM25 plus the local embedder unless their
+  embedding is cached;
+* probes: a document's title plus its embedding with noise added, exercising
+  the lexical and vector stages together.
+
+`scale_corpus` pads the corpus with synthetic near-duplicates so the same
+queries can be timed at 1k/10k/100k documents. A synthetic document counts
+as relevant when the document it was derived from is.
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+from array import array
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .cache import EMBED_FILE, _hash_text, get_cached_embedding
+from .chunking import source_id, split_sentences
+from .metrics import peak_rss_mb
+
+DATA_FILE = os.path.join(os.path.dirname(__file__), "..", "data", "medical_documents.json")
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "backend")
+
+# (question, ids of the documents that answer it)
+BENCH_QUESTIONS: List[Tuple[str, List[str]]] = [
+    ("What should we do during high AQI events?", ["respiratory_surge_protocol", "pollution_patient_advisory"]),
+    ("Oxygen shortage procedure?", ["oxygen_inventory_management"]),
+    ("How to handle dengue outbreak?", ["dengue_outbreak_response"]),
+    ("How to manage ICU capacity during surge?", ["icu_capacity_management"]),
+    ("What are the staff fatigue protocols?", ["staff_fatigue_management"]),
+    ("When should overflow beds be opened as occupancy rises?", ["bed_management_surge"]),
+    ("How do we prepare for burn injuries during Diwali?", ["festival_trauma_surge"]),
+    ("Can telemedicine reduce ER visits?", ["telemedicine_surge_support"]),
+    ("What does proactive surge management cost compared to reactive?", ["cost_analysis_surge_response"]),
+    ("How many ambulances are available during a surge?", ["ambulance_coordination"]),
+    ("Which medications should be stockpiled?", ["medication_stockpiling"]),
+    ("Counseling for anxious patients and staff", ["mental_health_surge_support"]),
+    ("PPE and hygiene rules for high patient volume", ["infection_control_surge"]),
+    ("What data feeds the surge prediction model?", ["data_driven_predictions"]),
+    ("Multilingual advisories for patients when pollution is severe", ["pollution_patient_advisory"]),
+]
+
+Query = Tuple[str, Optional[List[float]], List[str]]
+
+
+def load_corpus(path: str = DATA_FILE, cache_path: str = EMBED_FILE) -> List[Dict[str, Any]]:
+    """Documents with embeddings looked up offline; uncached documents keep None."""
+    with open(path, "r", encoding="utf-8") as f:
+        docs = json.load(f)
+    cached = _load_json_cache(cache_path)
+    corpus = []
+    for d in docs:
+        content = d.get("content") or ""
+        corpus.append({
+            "id": d["id"],
+            "content": content,
+            "metadata": d.get("metadata") or {},
+            "embedding": cached.get(_hash_text(content)) or get_cached_embedding(content),
+        })
+    return corpus
+
+
+def scale_corpus(docs: List[Dict[str, Any]], size: int, seed: int = 0, noise: float = 0.03) -> List[Dict[str, Any]]:
+    """Pad `docs` to `size` with synthetic variants of them.
+
+    Each variant shuffles and drops sentences of its base document, mixes in
+    one sentence of another, and perturbs the base embedding with Gaussian
+    noise (per-dimension std `noise` on the unit vector). Embeddings are kept
+    as compact float32 arrays so 100k documents fit in memory.
+    """
+    if size <= len(docs):
+        return list(docs[:size])
+    rng = np.random.default_rng(seed)
+    units = _unit_embeddings(docs)
+    sentences = [split_sentences(d["content"]) or [d["content"]] for d in docs]
+    scaled = list(docs)
+    for i in range(size - len(docs)):
+        b = i % len(docs)
+        picked = [s for s in sentences[b] if rng.random() < 0.7] or sentences[b][:1]
+        rng.shuffle(picked)
+        other = sentences[int(rng.integers(len(docs)))]
+        picked.append(other[int(rng.integers(len(other)))])
+        embedding = None
+        if units[b] is not None:
+            vec = units[b] + rng.normal(0.0, noise, units[b].shape).astype(np.float32)
+            embedding = array("f", (vec / np.linalg.norm(vec)).astype(np.float32).tobytes())
+        scaled.append({
+            "id": f"syn{i}-{docs[b]['id']}",
+            "content": " ".join(picked),
+            "metadata": dict(docs[b].get("metadata") or {}, synthetic_of=docs[b]["id"]),
+            "embedding": embedding,
+        })
+    return scaled
+
+
+def question_queries(cache_path: str = EMBED_FILE) -> List[Query]:
+    cached = _load_json_cache(cache_path)
+    return [
+        (q, cached.get(_hash_text(q)) or get_cached_embedding(q), expected)
+        for q, expected in BENCH_QUESTIONS
+    ]
+
+
+def probe_queries(docs: List[Dict[str, Any]], seed: int = 1, noise: float = 0.03) -> List[Query]:
+    """One query per embedded document: its title and a noisy copy of its embedding."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for d, unit in zip(docs, _unit_embeddings(docs)):
+        if unit is None:
+            continue
+        vec = unit + rng.normal(0.0, noise, unit.shape).astype(np.float32)
+        title = d["content"].split(":", 1)[0]
+        queries.append((title, (vec / np.linalg.norm(vec)).tolist(), [d["id"]]))
+    return queries
+
+
+def recall_at_k(hits: List[Dict[str, Any]], expected: List[str]) -> float:
+    found = {(d.get("metadata") or {}).get("synthetic_of") or source_id(d) for d in hits}
+    return len(found & set(expected)) / len(expected) if expected else 1.0
+
+
+def measure(search: Callable[[str, Optional[List[float]], int], List[Dict[str, Any]]],
+            queries: List[Query], top_k: int = 3, repeat: int = 3) -> Dict[str, float]:
+    """Latency percentiles, throughput and mean recall@k of `search(text, embedding, top_k)`."""
+    latencies, recalls = [], []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text, embedding, expected in queries:
+            t0 = time.perf_counter()
+            hits = search(text, embedding, top_k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            recalls.append(recall_at_k(hits, expected))
+    elapsed = time.perf_counter() - started
+    return {
+        "queries": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "p95_ms": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        "qps": len(latencies) / elapsed if elapsed else 0.0,
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+    }
+
+
+def service_target(corpus: List[Dict[str, Any]]):
+    """RagService._retrieve_relevant over in-process indexes, plus memory used to build them."""
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+    from services.rag_service import RagService
+
+    service = RagService()
+    tracemalloc.start()
+    service.use_local_indexes(corpus)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory = {
+        "index_build_peak_mb": peak / 2**20,
+        "vector_index_mb": service._indexes.index.vector.nbytes / 2**20,
+    }
+
+    def search(text, embedding, top_k):
+        return service._retrieve_relevant(text, top_k, query_embedding=embedding)
+    return search, memory
+
+
+def cli_target(corpus: List[Dict[str, Any]]):
+    """The CLI's retrieve_relevant with the corpus as its candidate set."""
+    from .cli import retrieve_relevant
+
+    def search(text, embedding, top_k):
+        return retrieve_relevant(text, top_k, candidates=corpus, query_embedding=embedding, embed=False)
+    return search, {}
+
+
+TARGETS = {"service": service_target, "cli": cli_target}
+
+
+def run_bench(scales: List[int], top_k: int = 3, repeat: int = 3, targets: List[str] = ("service", "cli"),
+              cli_max_docs: int = 10000, path: str = DATA_FILE) -> List[Dict[str, Any]]:
+    base = load_corpus(path)
+    workloads = {"questions": question_queries(), "probes": probe_queries(base)}
+    rows = []
+    for size in scales:
+        corpus = scale_corpus(base, size)
+        for name in targets:
+            if name == "cli" and size > cli_max_docs:
+                rows.append({"target": name, "docs": len(corpus), "skipped": f"more than {cli_max_docs} documents"})
+                continue
+            search, memory = TARGETS[name](corpus)
+            for workload, queries in workloads.items():
+                row = {"target": name, "docs": len(corpus), "workload": workload, "top_k": top_k}
+                row.update(measure(search, queries, top_k, repeat))
+                row.update(memory)
+                rows.append(row)
+    return rows
+
+
+def print_report(rows: List[Dict[str, Any]], rss_mb: Optional[float] = None):
+    print(f"{'target':<8} {'docs':>7} {'workload':<10} {'p50 ms':>8} {'p95 ms':>8} {'qps':>8} "
+          f"{'recall@k':>8} {'index MB':>9} {'build MB':>9}")
+    for r in rows:
+        if "skipped" in r:
+            print(f"{r['target']:<8} {r['docs']:>7} skipped: {r['skipped']}")
+            continue
+        print(f"{r['target']:<8} {r['docs']:>7} {r['workload']:<10} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+              f"{r['qps']:>8.1f} {r['recall']:>8.3f} {r.get('vector_index_mb', 0):>9.2f} "
+              f"{r.get('index_build_peak_mb', 0):>9.2f}")
+    if rss_mb is not None:
+        print(f"Peak process RSS: {rss_mb:.1f} MB")
+
+
+def _load_json_cache(path: str) -> Dict[str, List[float]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _unit_embeddings(docs: List[Dict[str, Any]]) -> List[Optional[np.ndarray]]:
+    units = []
+    for d in docs:
+        emb = d.get("embedding")
+        if emb is None or not len(emb):
+            units.append(None)
+            continue
+        vec = np.asarray(emb, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        units.append(vec / norm if norm else None)
+    return units
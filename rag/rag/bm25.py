@@ -0,0 +1,81 @@
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .filters import MetadataBitmaps
+from .text import doc_terms, query_terms
+
+
+class BM25Index:
+    """In-process Okapi BM25 index with precomputed term weights.
+
+    At build time every posting stores its final BM25 contribution
+    (idf * saturated, length-normalized tf), so scoring a query is just a
+    scatter-add of a few posting arrays followed by argpartition.
+    """
+
+    def __init__(self, docs: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.docs = [d for d in docs if d.get("content")]
+        self.k1 = k1
+        self.b = b
+
+        # persisted term frequencies when the rows carry them
+        term_freqs = [doc_terms(d) for d in self.docs]
+        self.doc_len = np.asarray([sum(tf.values()) for tf in term_freqs], dtype=np.float32)
+        self.avgdl = float(self.doc_len.mean()) if len(self.doc_len) else 0.0
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for doc_idx, tf in enumerate(term_freqs):
+            for term, count in tf.items():
+                postings.setdefault(term, []).append((doc_idx, count))
+
+        n = len(self.docs)
+        self.doc_freq: Dict[str, int] = {}
+        self.idf: Dict[str, float] = {}
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, plist in postings.items():
+            df = len(plist)
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            ids = np.fromiter((p[0] for p in plist), dtype=np.int32, count=df)
+            tf = np.fromiter((p[1] for p in plist), dtype=np.float32, count=df)
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[ids] / (self.avgdl or 1.0))
+            self.doc_freq[term] = df
+            self.idf[term] = idf
+            self._postings[term] = (ids, (idf * tf * (self.k1 + 1.0) / (tf + norm)).astype(np.float32))
+        self._bitmaps: Optional[MetadataBitmaps] = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def filter_rows(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Rows whose metadata contains ``filters`` (see ``rag.filters``), for ``search(rows=...)``."""
+        if self._bitmaps is None:
+            self._bitmaps = MetadataBitmaps(self.docs)
+        return self._bitmaps.rows(filters)
+
+    def search(self, query: str, top_k: int, rows: Optional[np.ndarray] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return up to ``top_k`` ``(bm25, doc)`` pairs with a positive score, best first.
+
+        ``rows`` restricts the candidates to those rows (e.g. ``filter_rows(...)``).
+        """
+        if not len(self) or top_k <= 0 or (rows is not None and not len(rows)):
+            return []
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for term in query_terms(query, min_len=1):
+            posting = self._postings.get(term)
+            if posting is not None:
+                ids, weights = posting
+                scores[ids] += weights
+
+        if rows is None:
+            matched = np.flatnonzero(scores > 0)
+        else:
+            rows = np.asarray(rows)
+            matched = rows[scores[rows] > 0]
+        if not len(matched):
+            return []
+        k = min(top_k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]] if k < len(matched) else matched
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(float(scores[i]), self.docs[i]) for i in top]
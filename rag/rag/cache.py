@@ -1,36 +1,237 @@
 import os
 import json
+import atexit
+import asyncio
+import sqlite3
+import struct
 import hashlib
-from threading import Lock
+import threading
+from collections import OrderedDict
 
-_lock = Lock()
+import numpy as np
 
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", "cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
+# Legacy JSON cache; imported once into the store on first open
 EMBED_FILE = os.path.join(CACHE_DIR, "embeddings.json")
+STORE_FILE = os.environ.get("RAG_CACHE_STORE") or os.path.join(CACHE_DIR, "embeddings.sqlite3")
 
-def _load_cache():
-    if not os.path.exists(EMBED_FILE):
-        return {}
-    with open(EMBED_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+LRU_SIZE = int(os.environ.get("RAG_CACHE_LRU_SIZE", "4096"))
+FLUSH_BATCH = int(os.environ.get("RAG_CACHE_FLUSH_BATCH", "64"))
+FLUSH_INTERVAL = float(os.environ.get("RAG_CACHE_FLUSH_INTERVAL", "2.0"))
 
-def _save_cache(d):
-    with open(EMBED_FILE, "w", encoding="utf-8") as f:
-        json.dump(d, f)
 
 def _hash_text(text: str) -> str:
     return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
+
+def pack_embedding(embedding) -> bytes:
+    """Pack an embedding as little-endian float32."""
+    return struct.pack(f"<{len(embedding)}f", *embedding)
+
+
+def unpack_embedding(blob: bytes) -> np.ndarray:
+    """Little-endian float32 bytes as a read-only array over the same buffer (no per-float objects)."""
+    return np.frombuffer(blob, dtype="<f4")
+
+
+class EmbeddingStore:
+    """Persistent embedding cache keyed by SHA-256 of the text.
+
+    Three tiers: an in-memory LRU, a write-behind buffer that is flushed in
+    batches (by size, on a timer, and at exit), and an indexed SQLite table
+    holding packed float32 blobs. Reads and writes never rewrite the whole
+    cache, so cost per call stays flat as the cache grows.
+    """
+
+    def __init__(self, path: str = STORE_FILE, lru_size: int = LRU_SIZE,
+                 flush_batch: int = FLUSH_BATCH, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.lru_size = lru_size
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+
+        self._lru = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            emb = self._lru.get(key)
+            if emb is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return emb
+            blob = self._pending.get(key)
+        if blob is None:
+            with self._db_lock:
+                row = self._db.execute("SELECT data FROM embeddings WHERE key = ?", (key,)).fetchone()
+            blob = row[0] if row else None
+        if blob is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        emb = unpack_embedding(blob).tolist()
+        with self._lock:
+            self.hits += 1
+            self._remember(key, emb)
+        return emb
+
+    def peek(self, key: str):
+        """Memory-only lookup (LRU and write buffer); never touches disk."""
+        with self._lock:
+            emb = self._lru.get(key)
+            if emb is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return emb
+            blob = self._pending.get(key)
+        return unpack_embedding(blob).tolist() if blob is not None else None
+
+    def put(self, key: str, embedding):
+        blob = pack_embedding(embedding)
+        with self._lock:
+            self._remember(key, list(embedding))
+            self._pending[key] = blob
+            should_flush = len(self._pending) >= self.flush_batch
+        self._ensure_flusher()
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write buffered entries to disk in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, data) VALUES (?, ?)",
+                list(batch.items())
+            )
+            self._db.commit()
+        return len(batch)
+
+    def import_json(self, path: str = EMBED_FILE) -> int:
+        """One-shot import of the legacy `{sha256: [floats]}` JSON cache."""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rows = [(k, pack_embedding(v)) for k, v in data.items() if v]
+        with self._db_lock:
+            self._db.executemany("INSERT OR IGNORE INTO embeddings (key, data) VALUES (?, ?)", rows)
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)",
+                (os.path.abspath(path),)
+            )
+            self._db.commit()
+        return len(rows)
+
+    def json_imported(self) -> bool:
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+        return row is not None
+
+    def stats(self):
+        with self._db_lock:
+            stored = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        with self._lock:
+            return {
+                "stored": stored,
+                "pending": len(self._pending),
+                "lru_entries": len(self._lru),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _remember(self, key, emb):
+        # caller holds self._lock
+        self._lru[key] = emb
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None or self.flush_interval <= 0:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="embedding-cache-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Embedding cache flush failed: {e}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> EmbeddingStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = EmbeddingStore()
+                if not store.json_imported():
+                    store.import_json()
+                atexit.register(store.flush)
+                _store = store
+    return _store
+
+
 def get_cached_embedding(text: str):
-    key = _hash_text(text)
-    with _lock:
-        d = _load_cache()
-        return d.get(key)
+    return get_store().get(_hash_text(text))
+
 
 def set_cached_embedding(text: str, embedding):
+    get_store().put(_hash_text(text), embedding)
+
+
+async def aget_cached_embedding(text: str):
+    """Async lookup: memory hits return inline, disk reads run in a thread."""
     key = _hash_text(text)
-    with _lock:
-        d = _load_cache()
-        d[key] = embedding
-        _save_cache(d)
+    store = get_store()
+    emb = store.peek(key)
+    if emb is not None:
+        return emb
+    return await asyncio.to_thread(store.get, key)
+
+
+async def aset_cached_embedding(text: str, embedding):
+    await asyncio.to_thread(get_store().put, _hash_text(text), embedding)
+
+
+def flush_cache():
+    return get_store().flush()
+
+
+def import_json_cache(path: str = EMBED_FILE) -> int:
+    return get_store().import_json(path)
@@ -0,0 +1,135 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+# Chunk sizes are in characters; ~4 characters per token for English text
+CHUNK_SIZE = int(os.environ.get("RAG_CHUNK_SIZE", "800"))
+CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "150"))
+CHUNK_STRATEGY = os.environ.get("RAG_CHUNK_STRATEGY", "sentence")  # sentence | heading
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])|\n{2,}")
+# Markdown headings, or short title lines ending in a colon ("Key actions:")
+_HEADING = re.compile(r"^(#{1,6}\s+.+|[A-Z][^\n.!?]{0,80}:)\s*$", re.MULTILINE)
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_END.split(text or "") if s and s.strip()]
+
+
+def split_sections(text: str) -> List[Dict[str, str]]:
+    """Split on heading lines; each section keeps its heading for context."""
+    sections = []
+    matches = list(_HEADING.finditer(text or ""))
+    if not matches or matches[0].start() > 0:
+        end = matches[0].start() if matches else len(text or "")
+        body = (text or "")[:end].strip()
+        if body:
+            sections.append({"heading": "", "body": body})
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[m.end():end].strip()
+        heading = m.group(1).lstrip("#").strip()
+        if body or heading:
+            sections.append({"heading": heading, "body": body})
+    return sections
+
+
+def _hard_split(text: str, size: int, overlap: int) -> List[str]:
+    """Split an over-long sentence on word boundaries (characters as a last resort)."""
+    words = text.split()
+    if len(words) > 1:
+        return _pack(words, size, overlap)
+    step = max(1, size - overlap)
+    return [text[i:i + size] for i in range(0, max(1, len(text) - overlap), step)]
+
+
+def _pack(sentences: List[str], size: int, overlap: int, prefix: str = "") -> List[str]:
+    """Greedily pack sentences into chunks of at most `size` characters.
+
+    The trailing sentences of each chunk (up to `overlap` characters) are
+    repeated at the start of the next one so context isn't cut mid-thought.
+    """
+    budget = max(1, size - len(prefix))
+    pieces: List[str] = []
+    for s in sentences:
+        pieces.extend(_hard_split(s, budget, overlap) if len(s) > budget else [s])
+
+    chunks: List[str] = []
+    current: List[str] = []
+    length = 0
+    for piece in pieces:
+        added = len(piece) + (1 if current else 0)
+        if current and length + added > budget:
+            chunks.append(prefix + " ".join(current))
+            carry: List[str] = []
+            carried = 0
+            for prev in reversed(current):
+                if carried + len(prev) + 1 > overlap:
+                    break
+                carry.insert(0, prev)
+                carried += len(prev) + 1
+            while carry and carried + len(piece) > budget:
+                carried -= len(carry.pop(0)) + 1
+            current, length = carry, max(0, carried - 1)
+            added = len(piece) + (1 if current else 0)
+        current.append(piece)
+        length += added
+    if current:
+        chunks.append(prefix + " ".join(current))
+    return chunks
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+               strategy: str = CHUNK_STRATEGY) -> List[str]:
+    """Split text into overlapping chunks on sentence (or heading) boundaries."""
+    text = (text or "").strip()
+    if not text:
+        return []
+    overlap = max(0, min(overlap, size // 2))
+    if len(text) <= size:
+        return [text]
+    if strategy == "heading":
+        chunks: List[str] = []
+        for section in split_sections(text):
+            prefix = f"{section['heading'].rstrip(':')}: " if section["heading"] else ""
+            chunks.extend(_pack(split_sentences(section["body"]), size, overlap, prefix))
+        return chunks
+    return _pack(split_sentences(text), size, overlap)
+
+
+def chunk_id(parent_id: str, index: int) -> str:
+    return f"{parent_id}#{index}"
+
+
+def chunk_document(doc_id: str, content: str, metadata: Optional[Dict[str, Any]] = None,
+                   size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+                   strategy: str = CHUNK_STRATEGY) -> List[Dict[str, Any]]:
+    """Chunk one document; every chunk references its parent document id."""
+    metadata = metadata or {}
+    texts = chunk_text(content, size, overlap, strategy)
+    return [
+        {
+            "id": chunk_id(doc_id, i),
+            "parent_id": doc_id,
+            "content": t,
+            "metadata": dict(metadata, parent_id=doc_id, chunk_index=i, chunk_count=len(texts)),
+        }
+        for i, t in enumerate(texts)
+    ]
+
+
+def source_id(doc: Dict[str, Any]) -> str:
+    """Id of the source document a hit came from (itself, for unchunked rows)."""
+    return doc.get("parent_id") or (doc.get("metadata") or {}).get("parent_id") or doc.get("id")
+
+
+def group_by_source(hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Group chunk-level hits by source document, keeping best-hit order."""
+    groups: Dict[str, Dict[str, Any]] = {}
+    for hit in hits:
+        sid = source_id(hit)
+        group = groups.get(sid)
+        if group is None:
+            group = groups[sid] = {"id": sid, "metadata": hit.get("metadata") or {}, "chunks": []}
+        group["chunks"].append(hit)
+    return list(groups.values())
@@ -13,49 +13,194 @@ import os
 import json
 import sys
 import math
-import re
-from typing import List
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List
 
-from .ingest import queue_documents, process_queue
-from .cache import get_cached_embedding, set_cached_embedding
-from .vertex import embed_text, generate_text
-from .db import get_all_documents, search_candidates_by_keyword, init_db
+from .ingest import queue_documents, process_queue, ingest_stream, print_summary, print_throughput
+from .cache import get_cached_embedding, set_cached_embedding, import_json_cache, EMBED_FILE
+from .vertex import embed_text, generate_text, get_embedder, is_unavailable_error
+from .db import get_all_documents, get_documents, search_lexical, init_db, migrate_to_pgvector, backfill_features
+from .db import convert_embeddings, embedding_storage_stats
+from .ingest import embed_with_cache
+from .worker import QUEUE_WORKERS, QUEUE_MAX_ATTEMPTS
+from .index import recall_at_k, PRECISIONS, VectorIndex
+from .bm25 import BM25Index
+from .hybrid import reciprocal_rank_fusion
+from .prompt import build_prompt, PROMPT_TOKEN_BUDGET
+from .sources import iter_source, FORMATS
 
 
-def cosine_sim(a: List[float], b: List[float]) -> float:
+def cosine_sim(a: List[float], b: List[float], na: float = None, nb: float = None) -> float:
+    """Cosine similarity; pass precomputed norms to skip recomputing them."""
     if not a or not b:
         return -1.0
     dot = sum(x*y for x,y in zip(a,b))
-    na = math.sqrt(sum(x*x for x in a))
-    nb = math.sqrt(sum(x*x for x in b))
+    na = na or math.sqrt(sum(x*x for x in a))
+    nb = nb or math.sqrt(sum(x*x for x in b))
     if na == 0 or nb == 0:
         return -1.0
     return dot/(na*nb)
 
 
-def build_rag_prompt(question: str, docs: List[dict]) -> str:
-    s = "Use the following documents to answer the question. If answer not found, say you don't know.\n\n"
-    for i, d in enumerate(docs, 1):
-        s += f"Document {i}:\n{d['content']}\n\n"
-    s += f"Question: {question}\nAnswer concisely with references to the documents when applicable."
-    return s
+# Offline indexes of the last few candidate sets, keyed by corpus fingerprint
+_INDEX_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_INDEX_CACHE_SIZE = 4
+# Ranked list length per stage before rank fusion
+RRF_CANDIDATES = 50
+
+
+def _corpus_key(docs: List[dict]) -> str:
+    h = hashlib.sha1()
+    for d in docs:
+        h.update(str(d.get('id')).encode('utf-8'))
+        h.update(b'\0')
+        h.update((d.get('content') or '').encode('utf-8'))
+        h.update(b'\1')
+    return h.hexdigest()
+
+
+def _build_local_index(docs: List[dict]) -> VectorIndex:
+    local = get_embedder("local")
+    index = VectorIndex(docs, precision="float32", embeddings=local.embed_many([d.get('content') or '' for d in docs]))
+    index.embedder = local
+    return index
+
+
+_INDEX_BUILDERS = {
+    "bm25": BM25Index,
+    "local": _build_local_index,
+    "vector": lambda docs: VectorIndex(docs, precision="float32"),
+}
+
+
+def corpus_index(docs: List[dict], kind: str):
+    """BM25 ("bm25"), local-embedder ("local") or embedding ("vector") index over `docs`.
+
+    Built on first use and reused while the same corpus is queried again, so
+    repeated questions cost a search, not a rebuild.
+    """
+    key = _corpus_key(docs)
+    entry = _INDEX_CACHE.get(key)
+    if entry is None:
+        entry = _INDEX_CACHE[key] = {}
+        while len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+            _INDEX_CACHE.popitem(last=False)
+    else:
+        _INDEX_CACHE.move_to_end(key)
+    if kind not in entry:
+        entry[kind] = _INDEX_BUILDERS[kind](docs)
+    return entry[kind]
+
+
+def build_rag_prompt(question: str, docs: List[dict], budget: int = PROMPT_TOKEN_BUDGET):
+    """Prompt with as many top-ranked documents as fit `budget` tokens, plus its token accounting."""
+    preamble = "Use the following documents to answer the question. If answer not found, say you don't know.\n\n"
+    closing = f"Question: {question}\nAnswer concisely with references to the documents when applicable."
+    return build_prompt(preamble, docs, closing, budget)
 
 
 def cmd_ingest(args):
     path = args.file
     if not os.path.exists(path):
         print("File not found:", path); sys.exit(1)
-    with open(path, 'r', encoding='utf-8') as f:
-        docs = json.load(f)
-    if not isinstance(docs, list):
-        print("Input file must contain a JSON array of documents."); sys.exit(1)
-    queue_documents(docs)
-    print(f"Queued {len(docs)} documents for ingestion.")
+    try:
+        count = queue_documents(iter_source(path, args.format))
+    except ValueError as e:
+        print(e); sys.exit(1)
+    print(f"Queued {count} documents for ingestion.")
+
+
+def cmd_sync(args):
+    if not os.path.exists(args.file):
+        print("File not found:", args.file); sys.exit(1)
+    init_db()
+
+    def on_group(stats):
+        print(f"Group {stats['groups']}:", end="")
+        print_throughput(stats)
+
+    try:
+        result = ingest_stream(iter_source(args.file, args.format), prune=args.prune, group_size=args.group_size,
+                               on_group=on_group, force=args.force)
+    except ValueError as e:
+        print(e); sys.exit(1)
+    for failure in result['failed']:
+        print(f"Failed {failure['id']}: {failure['error']}")
+    print_summary(result['summary'])
+    print_throughput(result)
 
 
 def cmd_process_queue(args):
-    process_queue()
-    print("Queue processed (processed files removed on success).")
+    process_queue(workers=args.workers, max_attempts=args.max_attempts, wait_for_retries=not args.no_wait)
+    print("Queue processed (processed files removed on success, poison files in queue/dead-letter).")
+
+
+def cmd_migrate_pgvector(args):
+    migrated = migrate_to_pgvector(batch_size=args.batch_size)
+    print(f"Backfilled pgvector column for {migrated} documents.")
+    print("Set RAG_USE_PGVECTOR=1 so new inserts and searches use it.")
+
+
+def cmd_backfill_features(args):
+    init_db()
+    updated = backfill_features(batch_size=args.batch_size)
+    print(f"Stored term frequencies and embedding norms for {updated} documents.")
+
+
+def cmd_convert_embeddings(args):
+    init_db()
+    converted = convert_embeddings(batch_size=args.batch_size, keep_json=args.keep_json)
+    stats = embedding_storage_stats()
+    print(f"Packed {converted} JSON embeddings into the binary column.")
+    print(f"JSONB: {stats['json_rows']} rows, {stats['json_bytes']} bytes; "
+          f"binary: {stats['binary_rows']} rows, {stats['binary_bytes']} bytes")
+    if converted and not args.keep_json:
+        print("Run VACUUM documents; to return the freed JSONB space to the table.")
+
+
+def cmd_recall_report(args):
+    with open(args.file, 'r', encoding='utf-8') as f:
+        docs = json.load(f)
+    texts = [d.get('content') or d.get('text') or '' for d in docs]
+    embeddings = embed_with_cache(texts)
+    failed = sum(isinstance(e, Exception) for e in embeddings)
+    if failed:
+        print(f"Skipping {failed} documents whose embedding failed.")
+    corpus = [
+        {'id': d.get('id') or str(i), 'embedding': e}
+        for i, (d, e) in enumerate(zip(docs, embeddings)) if not isinstance(e, Exception)
+    ]
+    # every document doubles as a query; --question adds real questions on top
+    queries = [d['embedding'] for d in corpus]
+    for question, emb in zip(args.question, embed_with_cache(args.question)):
+        if not isinstance(emb, Exception):
+            queries.append(emb)
+    print(f"Recall@{args.k} vs exact float32 over {len(corpus)} documents and {len(queries)} queries:")
+    for rerank in sorted({0, args.rerank_factor}):
+        report = recall_at_k(corpus, queries, k=args.k, rerank_factor=rerank)
+        label = f"re-rank x{rerank}" if rerank else "no re-rank"
+        for precision in PRECISIONS:
+            r = report[precision]
+            print(f"  {precision:<8} {label:<12} recall={r['recall']:.3f}  index={r['nbytes']} bytes")
+
+
+def cmd_bench(args):
+    from .bench import run_bench, print_report
+    from .metrics import peak_rss_mb
+    scales = [int(s) for s in args.scales.split(',') if s.strip()]
+    targets = [t for t in args.targets.split(',') if t.strip()]
+    rows = run_bench(scales, top_k=args.k, repeat=args.repeat, targets=targets, cli_max_docs=args.cli_max_docs)
+    print_report(rows, peak_rss_mb())
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+        print(f"Wrote {args.json}")
+
+
+def cmd_import_cache(args):
+    imported = import_json_cache(args.file)
+    print(f"Imported {imported} embeddings from {args.file}.")
 
 
 def generate_offline_response(question: str, docs: List[dict]) -> str:
@@ -74,7 +219,15 @@ def generate_offline_response(question: str, docs: List[dict]) -> str:
     return response
 
 
-def retrieve_relevant(query: str, top_k: int = 3):
+def retrieve_relevant(query: str, top_k: int = 3, candidates: List[dict] = None,
+                      query_embedding: List[float] = None, embed: bool = True):
+    """Rank candidates for a query.
+
+    Candidates come from Postgres (falling back to local files) unless given;
+    the query embedding comes from the cache or the API (unless `embed` is
+    False) unless given. Without an embedding, BM25 is fused with the
+    local n-gram embedder's ranking.
+    """
     def load_local_documents():
         # Try a couple of fallback locations for local documents
         candidates = []
@@ -101,61 +254,56 @@ def retrieve_relevant(query: str, top_k: int = 3):
                     continue
         return []
 
-    # try database-backed keyword search; if DB is unavailable, fall back to local files
-    words = [w for w in re.findall(r"\w+", query.lower()) if len(w) > 3]
-    candidates = []
-    db_error = None
-    try:
-        print(f"[DEBUG] Searching PostgreSQL for keywords: {words[:3]}")
-        for w in words[:3]:
-            candidates.extend(search_candidates_by_keyword(w, limit=50))
-        if not candidates:
-            print("[DEBUG] No keyword matches, fetching all documents from PostgreSQL")
-            candidates = get_all_documents()
-        print(f"[DEBUG] Found {len(candidates)} documents from PostgreSQL")
-    except Exception as e:
-        db_error = str(e)
-        print(f"[DEBUG] PostgreSQL error: {db_error}")
-        print("[DEBUG] Falling back to local documents")
-        candidates = load_local_documents()
-        print(f"[DEBUG] Found {len(candidates)} local documents")
+    # try database-backed full-text search; if DB is unavailable, fall back to local files
+    lexical_hits = False
+    if candidates is None:
+        db_error = None
+        try:
+            print(f"[DEBUG] Full-text searching PostgreSQL for: {query!r}")
+            candidates = search_lexical(query, limit=50)
+            lexical_hits = bool(candidates)
+            if not candidates:
+                print("[DEBUG] No full-text matches, fetching all documents from PostgreSQL")
+                candidates = get_all_documents()
+            print(f"[DEBUG] Found {len(candidates)} documents from PostgreSQL")
+        except Exception as e:
+            db_error = str(e)
+            print(f"[DEBUG] PostgreSQL error: {db_error}")
+            print("[DEBUG] Falling back to local documents")
+            candidates = load_local_documents()
+            print(f"[DEBUG] Found {len(candidates)} local documents")
 
     # try to obtain a query embedding (use cache first). If Vertex is not available,
-    # fall back to token-overlap scoring below.
-    q_emb = get_cached_embedding(query)
-    got_embedding = True
-    if not q_emb:
-        try:
-            q_emb = embed_text(query)
-            set_cached_embedding(query, q_emb)
-        except Exception:
-            q_emb = None
-            got_embedding = False
-
-    # compute similarity (embedding cosine when possible, else token overlap heuristic)
-    q_tokens = set(re.findall(r"\w+", query.lower()))
-    scored = []
-    for c in candidates:
-        emb = c.get('embedding')
-        sim = 0.0
-        if emb and q_emb:
+    # fall back to BM25 lexical ranking below.
+    q_emb = query_embedding
+    if q_emb is None and embed:
+        q_emb = get_cached_embedding(query)
+        if not q_emb:
             try:
-                sim = cosine_sim(q_emb, emb)
+                q_emb = embed_text(query)
+                set_cached_embedding(query, q_emb)
             except Exception:
-                sim = 0.0
-        elif not got_embedding:
-            # token overlap heuristic
-            d_tokens = set(re.findall(r"\w+", c.get('content', '').lower()))
-            if not d_tokens:
-                sim = 0.0
-            else:
-                sim = len(q_tokens & d_tokens) / max(1, len(q_tokens | d_tokens))
-        else:
-            sim = 0.0
-        scored.append((sim, c))
+                q_emb = None
+
+    if not q_emb:
+        # offline: BM25 fused with the local embedder over the candidate set
+        limit = max(top_k, RRF_CANDIDATES)
+        lexical = [d for _, d in corpus_index(candidates, "bm25").search(query, limit)]
+        local = corpus_index(candidates, "local")
+        semantic = [d for _, d in local.search(local.embedder.embed(query), limit)]
+        fused = reciprocal_rank_fusion({"lexical": lexical, "vector": semantic})
+        return [d for _, d in fused[:top_k]]
+
+    if lexical_hits:
+        # full-text hits carry no vectors; fetch them for just these rows
+        candidates = get_documents([c["id"] for c in candidates])
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = [s[1] for s in scored[:top_k]]
+    # embedding cosine over the cached index (norms come from ingestion);
+    # candidates without a usable embedding sink to the bottom.
+    top = [d for _, d in corpus_index(candidates, "vector").search(q_emb, top_k)]
+    if len(top) < top_k:
+        ranked = {d.get("id") for d in top}
+        top.extend([c for c in candidates if c.get("id") not in ranked][:top_k - len(top)])
     return top
 
 
@@ -183,13 +331,15 @@ def cmd_chat(args):
             print("Goodbye.")
             break
         docs = retrieve_relevant(q, top_k=3)
-        prompt = build_rag_prompt(q, docs)
+        prompt, prompt_stats = build_rag_prompt(q, docs)
+        print(f"[DEBUG] Prompt: ~{prompt_stats['tokens_used']}/{prompt_stats['token_budget']} tokens, "
+              f"{prompt_stats['tokens_dropped']} context tokens dropped")
         try:
             resp = generate_text(prompt)
         except Exception as e:
             error_msg = str(e)
-            if "rate limit" in error_msg.lower() or "429" in error_msg:
-                print("\n--- Offline Mode (API Rate Limited) ---\n")
+            if is_unavailable_error(e) or "rate limit" in error_msg.lower() or "429" in error_msg:
+                print("\n--- Offline Mode (API Unavailable) ---\n")
                 resp = generate_offline_response(q, docs)
             else:
                 print("Generation error:", e)
@@ -203,12 +353,57 @@ def main():
     sub = p.add_subparsers(dest='cmd')
 
     ing = sub.add_parser('ingest')
-    ing.add_argument('--file', required=True, help='JSON file with array of documents (each should have id/content/metadata)')
+    ing.add_argument('--file', required=True, help='JSON array, JSON Lines file, or .txt/.md file or directory of documents (each JSON document should have id/content/metadata)')
+    ing.add_argument('--format', choices=FORMATS, help='Source format (default: from the extension; directories are text)')
     ing.set_defaults(func=cmd_ingest)
 
+    sync = sub.add_parser('sync', help='Stream a corpus through chunk/embed/upsert, skipping unchanged documents')
+    sync.add_argument('--file', required=True, help='JSON array, JSON Lines file, or .txt/.md file or directory')
+    sync.add_argument('--format', choices=FORMATS, help='Source format (default: from the extension; directories are text)')
+    sync.add_argument('--group-size', type=int, default=None, help='Documents read, embedded and upserted per group (bounds memory)')
+    sync.add_argument('--prune', action='store_true', help='Delete stored documents missing from the file')
+    sync.add_argument('--force', action='store_true', help='Re-ingest even if fingerprints match')
+    sync.set_defaults(func=cmd_sync)
+
     proc = sub.add_parser('process-queue')
+    proc.add_argument('--workers', type=int, default=QUEUE_WORKERS, help='Worker threads claiming files (processes may also run side by side)')
+    proc.add_argument('--max-attempts', type=int, default=QUEUE_MAX_ATTEMPTS, help='Failures before a file is dead-lettered')
+    proc.add_argument('--no-wait', action='store_true', help='Exit instead of waiting for files that are backing off')
     proc.set_defaults(func=cmd_process_queue)
 
+    mig = sub.add_parser('migrate-pgvector', help='Add pgvector column/index and backfill from JSONB embeddings')
+    mig.add_argument('--batch-size', type=int, default=1000)
+    mig.set_defaults(func=cmd_migrate_pgvector)
+
+    feat = sub.add_parser('backfill-features', help='Store term frequencies and embedding norms for existing documents')
+    feat.add_argument('--batch-size', type=int, default=1000)
+    feat.set_defaults(func=cmd_backfill_features)
+
+    conv = sub.add_parser('convert-embeddings', help='Pack JSONB embeddings of existing rows into the binary float32 column')
+    conv.add_argument('--batch-size', type=int, default=1000)
+    conv.add_argument('--keep-json', action='store_true', help='Keep the JSONB copy instead of clearing it')
+    conv.set_defaults(func=cmd_convert_embeddings)
+
+    rec = sub.add_parser('recall-report', help='Compare float16/int8 index recall with float32')
+    rec.add_argument('--file', default=os.path.join(os.path.dirname(__file__), '..', 'data', 'medical_documents.json'))
+    rec.add_argument('--k', type=int, default=3)
+    rec.add_argument('--rerank-factor', type=int, default=4)
+    rec.add_argument('--question', action='append', default=[], help='Extra query text (repeatable)')
+    rec.set_defaults(func=cmd_recall_report)
+
+    bench = sub.add_parser('bench', help='Offline retrieval benchmark: latency, throughput, recall@k, memory')
+    bench.add_argument('--scales', default='15,1000,10000', help='Comma-separated corpus sizes (synthetic padding), e.g. 1000,10000,100000')
+    bench.add_argument('--k', type=int, default=3)
+    bench.add_argument('--repeat', type=int, default=3, help='Passes over each query set')
+    bench.add_argument('--targets', default='service,cli', help='service (RagService._retrieve_relevant) and/or cli (retrieve_relevant)')
+    bench.add_argument('--cli-max-docs', type=int, default=10000, help='Skip the pure-Python CLI ranking above this corpus size')
+    bench.add_argument('--json', help='Also write the results to this file')
+    bench.set_defaults(func=cmd_bench)
+
+    imp = sub.add_parser('import-cache', help='Import a legacy JSON embedding cache into the binary store')
+    imp.add_argument('--file', default=EMBED_FILE)
+    imp.set_defaults(func=cmd_import_cache)
+
     chat = sub.add_parser('chat')
     chat.set_defaults(func=cmd_chat)
 
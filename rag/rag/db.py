@@ -1,9 +1,17 @@
 import os
 import json
+import time
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2 import extensions, pool as pg_pool
+from psycopg2.extras import Json, execute_values
 from typing import List, Dict, Any
 
+from .text import query_terms, term_frequencies
+from .index import embedding_norm
+from .cache import pack_embedding, unpack_embedding
+
 # Load environment variables from .env file
 try:
     from dotenv import load_dotenv
@@ -13,58 +21,618 @@ except ImportError:
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Optional pgvector storage: embeddings are mirrored into a `vector` column so
+# Postgres can rank documents with an ANN index instead of shipping vectors.
+USE_PGVECTOR = os.environ.get("RAG_USE_PGVECTOR", "").lower() in ("1", "true", "yes")
+EMBEDDING_DIM = int(os.environ.get("RAG_EMBEDDING_DIM", "768"))
+PGVECTOR_INDEX = os.environ.get("RAG_PGVECTOR_INDEX", "hnsw").lower()  # hnsw | ivfflat
+PGVECTOR_IVFFLAT_LISTS = int(os.environ.get("RAG_PGVECTOR_IVFFLAT_LISTS", "100"))
+PGVECTOR_EF_SEARCH = int(os.environ.get("RAG_PGVECTOR_EF_SEARCH", "0"))
+
+# Embedding column format for new writes: "binary" packs little-endian float32
+# into `embedding_bin` (bytea); "json" keeps the legacy JSONB float list.
+EMBEDDING_STORAGE = os.environ.get("RAG_EMBEDDING_STORAGE", "binary").lower()
+
+# Text search configuration for the generated tsvector column
+FULLTEXT_CONFIG = os.environ.get("RAG_FULLTEXT_CONFIG", "english")
+
+# Connection pool sizing; connections idle longer than the health-check
+# interval are pinged with SELECT 1 before being handed out.
+POOL_MIN = int(os.environ.get("RAG_DB_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("RAG_DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.environ.get("RAG_DB_POOL_TIMEOUT", "30"))
+POOL_HEALTHCHECK_IDLE = float(os.environ.get("RAG_DB_POOL_HEALTHCHECK_IDLE", "30"))
+
 def get_conn():
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL not set")
     return psycopg2.connect(DATABASE_URL)
 
-def init_db():
-    """Create documents table if it doesn't exist."""
-    sql = """
-    CREATE TABLE IF NOT EXISTS documents (
-        id TEXT PRIMARY KEY,
-        content TEXT NOT NULL,
-        metadata JSONB,
-        embedding JSONB
-    );
+
+class ConnectionPool:
+    """Thread-safe Postgres pool that blocks (up to a timeout) when exhausted.
+
+    Wraps psycopg2's ThreadedConnectionPool, which raises as soon as every
+    connection is checked out, with a semaphore so callers queue instead, and
+    adds idle health checks and usage statistics.
     """
-    conn = get_conn()
+
+    def __init__(self, dsn: str, minconn: int = POOL_MIN, maxconn: int = POOL_MAX,
+                 timeout: float = POOL_TIMEOUT, healthcheck_idle: float = POOL_HEALTHCHECK_IDLE):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used: Dict[int, float] = {}
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+            "discarded": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+        }
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise pg_pool.PoolError(f"No database connection available within {self.timeout}s")
+        try:
+            conn = self._pool.getconn()
+            if not self._healthy(conn):
+                with self._lock:
+                    self._stats["healthcheck_failures"] += 1
+                self._discard(conn)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds"] += time.monotonic() - start
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+        return conn
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                    return
+            with self._lock:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["min_size"] = self.minconn
+        stats["max_size"] = self.maxconn
+        stats["open"] = len(self._pool._used) + len(self._pool._pool)
+        stats["idle"] = len(self._pool._pool)
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._last_used.pop(id(conn), None)
+            self._stats["discarded"] += 1
+        self._pool.putconn(conn, close=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL not set")
+                _pool = ConnectionPool(DATABASE_URL)
+    return _pool
+
+@contextmanager
+def connection(conn=None):
+    """Yield `conn` if given, otherwise a pooled connection returned on exit."""
+    if conn is not None:
+        yield conn
+        return
+    p = get_pool()
+    pooled = p.getconn()
     try:
+        yield pooled
+    finally:
+        p.putconn(pooled)
+
+def pool_stats() -> Dict[str, Any]:
+    if _pool is None:
+        return {"open": 0, "in_use": 0, "max_size": POOL_MAX, "min_size": POOL_MIN}
+    return _pool.stats()
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+# Columns added to the original (id, content, metadata, embedding) table
+_COLUMNS = {
+    # chunk rows point at the source document they were cut from
+    "parent_id": "TEXT",
+    # scoring features computed once at ingest: term frequencies and embedding L2 norm
+    "terms": "JSONB",
+    "embedding_norm": "DOUBLE PRECISION",
+    # packed float32 embedding, ~4 bytes per dimension instead of JSON text
+    "embedding_bin": "BYTEA",
+    # fingerprint of the source document a row was built from (see rag.ingest.fingerprint)
+    "content_hash": "TEXT",
+    # when the row was last written, for corpus statistics
+    "ingested_at": "TIMESTAMPTZ DEFAULT now()",
+    # tsvector of the content for ranked lexical search
+    "content_tsv": f"tsvector GENERATED ALWAYS AS (to_tsvector('{FULLTEXT_CONFIG}', coalesce(content, ''))) STORED",
+}
+
+_INDEXES = {
+    "documents_parent_id_idx": "(parent_id)",
+    # serves metadata @> filters (jsonb_path_ops: containment only, smaller than the default opclass)
+    "documents_metadata_idx": "USING gin (metadata jsonb_path_ops)",
+    "documents_content_tsv_idx": "USING gin (content_tsv)",
+}
+
+def init_db():
+    """Create the documents table and whichever of its columns and indexes are missing."""
+    with connection() as conn:
+        _ensure_schema(conn, pgvector=USE_PGVECTOR)
+
+def _ensure_schema(conn, pgvector: bool = False):
+    """Bring the documents table up to date, doing nothing if it already is.
+
+    The catalog is read first, so a startup against a current schema runs
+    no DDL and takes no table locks. Missing indexes are built with CREATE
+    INDEX CONCURRENTLY outside a transaction, so ingestion and queries keep
+    running while a large table is indexed.
+    """
+    columns, indexes = dict(_COLUMNS), dict(_INDEXES)
+    if pgvector:
+        columns["embedding_vec"] = f"vector({EMBEDDING_DIM})"
+        if PGVECTOR_INDEX == "ivfflat":
+            indexes["documents_embedding_vec_idx"] = (
+                f"USING ivfflat (embedding_vec vector_cosine_ops) WITH (lists = {PGVECTOR_IVFFLAT_LISTS})"
+            )
+        else:
+            indexes["documents_embedding_vec_idx"] = "USING hnsw (embedding_vec vector_cosine_ops)"
+    existing_columns, existing_indexes = _schema_state(conn)
+    missing = [name for name in columns if name not in existing_columns]
+    if missing or not existing_columns:
         with conn:
             with conn.cursor() as cur:
-                cur.execute(sql)
-    finally:
-        conn.close()
+                if "embedding_vec" in missing:
+                    cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+                cur.execute(
+                    "CREATE TABLE IF NOT EXISTS documents ("
+                    "id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata JSONB, embedding JSONB)"
+                )
+                for name in missing:
+                    cur.execute(f"ALTER TABLE documents ADD COLUMN IF NOT EXISTS {name} {columns[name]}")
+    pending = {name: d for name, d in indexes.items() if not existing_indexes.get(name)}
+    if pending:
+        _create_indexes(conn, pending, invalid=[name for name in pending if name in existing_indexes])
 
-def insert_document(doc_id: str, content: str, metadata: Dict[str, Any], embedding: List[float]):
-    conn = get_conn()
+def _schema_state(conn):
+    """(column names, {index name: is valid}) of the documents table; both empty if it doesn't exist."""
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = 'documents'"
+            )
+            columns = {r[0] for r in cur.fetchall()}
+            cur.execute(
+                "SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = to_regclass('documents')"
+            )
+            indexes = dict(cur.fetchall())
+    return columns, indexes
+
+def _create_indexes(conn, indexes: Dict[str, str], invalid=()):
+    """CREATE INDEX CONCURRENTLY each of `indexes`, replacing any left invalid by an interrupted build."""
+    autocommit = conn.autocommit
+    conn.autocommit = True  # CONCURRENTLY can't run inside a transaction block
     try:
+        with conn.cursor() as cur:
+            for name in invalid:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            for name, definition in indexes.items():
+                cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON documents {definition}")
+    finally:
+        conn.autocommit = autocommit
+
+def _vector_literal(embedding):
+    """Format an embedding as a pgvector text literal, or None if unusable."""
+    if embedding is None or len(embedding) != EMBEDDING_DIM:
+        return None
+    return "[" + ",".join(repr(float(x)) for x in embedding) + "]"
+
+def insert_document(doc_id: str, content: str, metadata: Dict[str, Any], embedding: List[float], conn=None,
+                    parent_id: str = None, content_hash: str = None):
+    insert_documents([(doc_id, content, metadata, embedding, parent_id, content_hash)], conn=conn)
+
+def insert_documents(rows, conn=None, page_size: int = 100, replace_parents: bool = False) -> int:
+    """Upsert many (id, content, metadata, embedding[, parent_id[, content_hash]]) rows with multi-row INSERTs.
+
+    With `replace_parents`, rows of the same parent documents that are not in
+    this batch (chunks from an older, longer version, or the unchunked row
+    itself) are deleted in the same transaction. Term frequencies and the
+    embedding norm are computed here and stored with each row; the embedding
+    goes to `embedding_bin` or the JSONB column depending on EMBEDDING_STORAGE.
+    """
+    if not rows:
+        return 0
+    rows = [tuple(r) + (None,) * (6 - len(r)) for r in rows]
+    # a batch must not touch the same id twice in one ON CONFLICT statement
+    deduped = list({r[0]: r for r in rows}.values())
+    columns = "id, content, metadata, embedding, embedding_bin, parent_id, content_hash, terms, embedding_norm"
+    template = "(%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+    values = [
+        (i, c, Json(m), *_embedding_columns(e), p, h, Json(term_frequencies(c)), embedding_norm(e))
+        for i, c, m, e, p, h in deduped
+    ]
+    if USE_PGVECTOR:
+        columns += ", embedding_vec"
+        template = template[:-1] + ",%s::vector)"
+        values = [v + (_vector_literal(r[3]),) for v, r in zip(values, deduped)]
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns.split(", ")[1:]) + ", ingested_at = now()"
+    sql = f"INSERT INTO documents ({columns}) VALUES %s ON CONFLICT (id) DO UPDATE SET {updates}"
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                if replace_parents:
+                    parents = sorted({r[4] for r in deduped if r[4]})
+                    if parents:
+                        cur.execute(
+                            "DELETE FROM documents WHERE (parent_id = ANY(%s) OR id = ANY(%s)) AND NOT (id = ANY(%s))",
+                            (parents, parents, [r[0] for r in deduped])
+                        )
+                execute_values(cur, sql, values, template=template, page_size=page_size)
+    return len(deduped)
+
+def _embedding_columns(embedding):
+    """(JSONB, bytea) values for an embedding under the configured storage format."""
+    if embedding is None:
+        return None, None
+    if EMBEDDING_STORAGE == "json":
+        return Json(embedding), None
+    return None, psycopg2.Binary(pack_embedding(embedding))
+
+_DOC_COLUMNS = "id, content, metadata, embedding, parent_id, terms, embedding_norm, embedding_bin"
+
+def _row_to_doc(r):
+    # binary embeddings win over JSON; unpacking float32 is far cheaper than JSON parsing
+    embedding = unpack_embedding(r[7]) if r[7] is not None else r[3]
+    return {"id": r[0], "content": r[1], "metadata": r[2], "embedding": embedding, "parent_id": r[4],
+            "terms": r[5], "embedding_norm": r[6]}
+
+def get_content_hashes(source_ids: List[str], conn=None) -> Dict[str, Any]:
+    """Map each stored source document id to its fingerprint.
+
+    A document whose rows disagree or predate fingerprints maps to None, so
+    callers treat it as changed.
+    """
+    if not source_ids:
+        return {}
+    with connection(conn) as conn:
+        # ends the read transaction, so callers don't sit idle in transaction afterwards
         with conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO documents (id, content, metadata, embedding) VALUES (%s,%s,%s,%s) ON CONFLICT (id) DO UPDATE SET content = EXCLUDED.content, metadata = EXCLUDED.metadata, embedding = EXCLUDED.embedding",
-                    (doc_id, content, Json(metadata), Json(embedding) if embedding is not None else None)
+                    "SELECT COALESCE(parent_id, id), "
+                    "CASE WHEN count(*) = count(content_hash) AND count(DISTINCT content_hash) = 1 "
+                    "THEN min(content_hash) END "
+                    "FROM documents WHERE parent_id = ANY(%s) OR id = ANY(%s) GROUP BY 1",
+                    (list(source_ids), list(source_ids))
                 )
-    finally:
-        conn.close()
+                return {r[0]: r[1] for r in cur.fetchall()}
 
-def get_all_documents():
-    conn = get_conn()
-    try:
+def get_source_ids(conn=None) -> List[str]:
+    """Ids of every stored source document (chunk rows collapse to their parent)."""
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT COALESCE(parent_id, id) FROM documents")
+                return [r[0] for r in cur.fetchall()]
+
+def delete_documents(source_ids: List[str], conn=None) -> int:
+    """Delete source documents together with all of their chunk rows."""
+    if not source_ids:
+        return 0
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM documents WHERE parent_id = ANY(%s) OR id = ANY(%s)",
+                    (list(source_ids), list(source_ids))
+                )
+                return cur.rowcount
+
+def corpus_stats(conn=None) -> Dict[str, Any]:
+    """Row count and last write time, without reading document content or embeddings."""
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*), max(ingested_at) FROM documents")
+                count, last_ingest = cur.fetchone()
+    return {"documents": count, "last_ingest_at": last_ingest.isoformat() if last_ingest else None}
+
+def ping(conn=None):
+    """Round-trip `SELECT 1` on a pooled connection; raises if the database is unreachable."""
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+
+def get_all_documents(conn=None):
+    with connection(conn) as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT id, content, metadata, embedding FROM documents")
+            cur.execute(f"SELECT {_DOC_COLUMNS} FROM documents")
             rows = cur.fetchall()
-            return [ {"id": r[0], "content": r[1], "metadata": r[2], "embedding": r[3]} for r in rows ]
-    finally:
-        conn.close()
+            return [ _row_to_doc(r) for r in rows ]
 
-def search_candidates_by_keyword(keyword: str, limit: int = 50):
-    conn = get_conn()
-    try:
+def get_documents(ids: List[str], conn=None) -> List[Dict[str, Any]]:
+    """Full rows (embedding and scoring features included) for `ids`, in the order given."""
+    if not ids:
+        return []
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {_DOC_COLUMNS} FROM documents WHERE id = ANY(%s)", (list(ids),))
+                docs = {d["id"]: d for d in map(_row_to_doc, cur.fetchall())}
+    return [docs[i] for i in ids if i in docs]
+
+def get_embeddings(ids: List[str], conn=None) -> Dict[str, Any]:
+    """Map each of `ids` that has a stored embedding to it (float32 array or JSON list)."""
+    if not ids:
+        return {}
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id, embedding, embedding_bin FROM documents WHERE id = ANY(%s)", (list(ids),))
+                rows = cur.fetchall()
+    return {i: unpack_embedding(b) if b is not None else e for i, e, b in rows if b is not None or e is not None}
+
+def search_candidates_by_keyword(keyword: str, limit: int = 50, conn=None):
+    with connection(conn) as conn:
         with conn.cursor() as cur:
             pattern = f"%{keyword}%"
-            cur.execute("SELECT id, content, metadata, embedding FROM documents WHERE content ILIKE %s LIMIT %s", (pattern, limit))
+            cur.execute(f"SELECT {_DOC_COLUMNS} FROM documents WHERE content ILIKE %s LIMIT %s", (pattern, limit))
             rows = cur.fetchall()
-            return [ {"id": r[0], "content": r[1], "metadata": r[2], "embedding": r[3]} for r in rows ]
-    finally:
-        conn.close()
+            return [ _row_to_doc(r) for r in rows ]
+
+def search_lexical(query: str, limit: int = 50, filters: Dict[str, Any] = None, conn=None):
+    """Rank documents against the query terms with one GIN-indexed tsvector query.
+
+    Terms are OR-ed so a document matching any of them is a candidate; rows
+    come back ordered by ts_rank_cd with the rank in `score`. `filters`
+    restricts candidates by JSONB containment on `metadata`, as in
+    `search_by_embedding`. Rows carry id, content, metadata, parent_id and
+    the stored term frequencies, but no vectors; callers that need those
+    fetch them with `get_documents`.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    tsquery = " | ".join(terms)
+    where = "content_tsv @@ q"
+    params: List[Any] = [tsquery]
+    if filters:
+        where += " AND metadata @> %s"
+        params.append(Json(filters))
+    params.append(limit)
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, content, metadata, parent_id, terms, ts_rank_cd(content_tsv, q) AS score "
+                    f"FROM documents, to_tsquery('{FULLTEXT_CONFIG}', %s) AS q "
+                    f"WHERE {where} ORDER BY score DESC LIMIT %s",
+                    params
+                )
+                rows = cur.fetchall()
+                return [ {"id": r[0], "content": r[1], "metadata": r[2], "parent_id": r[3], "terms": r[4], "score": float(r[5])} for r in rows ]
+
+def search_by_embedding(query_vec: List[float], k: int = 5, filters: Dict[str, Any] = None, conn=None):
+    """Return the top-k documents ranked by pgvector cosine distance.
+
+    `filters` is matched against `metadata` with JSONB containment, e.g.
+    {"category": "icu"}. Rows carry a `score` (cosine similarity) instead of
+    the embedding, so no vectors travel back over the wire.
+    """
+    if not USE_PGVECTOR:
+        raise RuntimeError("pgvector storage is not enabled (set RAG_USE_PGVECTOR=1)")
+    literal = _vector_literal(query_vec)
+    if literal is None:
+        raise ValueError(f"Query embedding must have {EMBEDDING_DIM} dimensions")
+
+    where = "embedding_vec IS NOT NULL"
+    params: List[Any] = [literal]
+    if filters:
+        where += " AND metadata @> %s"
+        params.append(Json(filters))
+    params.extend([literal, k])
+
+    with connection(conn) as conn:
+        with conn:
+            with conn.cursor() as cur:
+                if PGVECTOR_EF_SEARCH and PGVECTOR_INDEX == "hnsw":
+                    cur.execute(f"SET LOCAL hnsw.ef_search = {PGVECTOR_EF_SEARCH}")
+                cur.execute(
+                    "SELECT id, content, metadata, parent_id, terms, 1 - (embedding_vec <=> %s::vector) AS score "
+                    f"FROM documents WHERE {where} "
+                    "ORDER BY embedding_vec <=> %s::vector LIMIT %s",
+                    params
+                )
+                rows = cur.fetchall()
+                return [ {"id": r[0], "content": r[1], "metadata": r[2], "parent_id": r[3], "terms": r[4], "score": float(r[5])} for r in rows ]
+
+def migrate_to_pgvector(batch_size: int = 1000) -> int:
+    """Create the pgvector column/index and backfill it from the JSONB embeddings.
+
+    Safe to re-run: only rows whose vector column is still NULL are touched.
+    Returns the number of rows backfilled.
+    """
+    total = 0
+    with connection() as conn:
+        _ensure_schema(conn, pgvector=True)
+        while True:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE documents SET embedding_vec = (embedding::text)::vector "
+                        "WHERE id IN ("
+                        "  SELECT id FROM documents WHERE embedding_vec IS NULL AND embedding IS NOT NULL "
+                        "  AND jsonb_typeof(embedding) = 'array' AND jsonb_array_length(embedding) = %s LIMIT %s"
+                        ")",
+                        (EMBEDDING_DIM, batch_size)
+                    )
+                    updated = cur.rowcount
+            total += updated
+            if updated < batch_size:
+                break
+        # rows stored in binary form can't be cast in SQL; convert them here
+        while True:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, embedding_bin FROM documents WHERE embedding_vec IS NULL "
+                        "AND embedding_bin IS NOT NULL AND length(embedding_bin) = %s LIMIT %s",
+                        (EMBEDDING_DIM * 4, batch_size)
+                    )
+                    rows = cur.fetchall()
+                    if rows:
+                        execute_values(
+                            cur,
+                            "UPDATE documents AS d SET embedding_vec = v.vec::vector "
+                            "FROM (VALUES %s) AS v (id, vec) WHERE d.id = v.id",
+                            [(i, _vector_literal(unpack_embedding(b))) for i, b in rows],
+                            page_size=batch_size
+                        )
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    return total
+
+
+def backfill_features(batch_size: int = 1000) -> int:
+    """Compute `terms` and `embedding_norm` for rows ingested before they existed.
+
+    Safe to re-run: only rows with NULL `terms` are touched. Returns the
+    number of rows updated.
+    """
+    total = 0
+    with connection() as conn:
+        while True:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, content, embedding, embedding_bin FROM documents WHERE terms IS NULL LIMIT %s",
+                        (batch_size,)
+                    )
+                    rows = cur.fetchall()
+                    if not rows:
+                        break
+                    execute_values(
+                        cur,
+                        "UPDATE documents AS d SET terms = v.terms::jsonb, embedding_norm = v.norm::double precision "
+                        "FROM (VALUES %s) AS v (id, terms, norm) WHERE d.id = v.id",
+                        [
+                            (i, Json(term_frequencies(c)), embedding_norm(unpack_embedding(b) if b is not None else e))
+                            for i, c, e, b in rows
+                        ],
+                        page_size=batch_size
+                    )
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    return total
+
+
+def convert_embeddings(batch_size: int = 1000, keep_json: bool = False) -> int:
+    """Pack JSONB embeddings of existing rows into `embedding_bin`.
+
+    Unless `keep_json`, the JSONB copy is cleared to reclaim its space (run
+    VACUUM afterwards). Safe to re-run. Returns the number of rows converted.
+    """
+    total = 0
+    with connection() as conn:
+        while True:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT id, embedding FROM documents WHERE embedding_bin IS NULL "
+                        "AND jsonb_typeof(embedding) = 'array' LIMIT %s",
+                        (batch_size,)
+                    )
+                    rows = cur.fetchall()
+                    if rows:
+                        execute_values(
+                            cur,
+                            "UPDATE documents AS d SET embedding_bin = v.bin"
+                            + ("" if keep_json else ", embedding = NULL")
+                            + " FROM (VALUES %s) AS v (id, bin) WHERE d.id = v.id",
+                            [(i, psycopg2.Binary(pack_embedding(e))) for i, e in rows],
+                            page_size=batch_size
+                        )
+            total += len(rows)
+            if len(rows) < batch_size:
+                break
+    return total
+
+def embedding_storage_stats(conn=None) -> Dict[str, Any]:
+    """On-disk bytes used by the JSONB and binary embedding columns."""
+    with connection(conn) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(embedding), coalesce(sum(pg_column_size(embedding)), 0), "
+                "count(embedding_bin), coalesce(sum(pg_column_size(embedding_bin)), 0) FROM documents"
+            )
+            json_rows, json_bytes, bin_rows, bin_bytes = cur.fetchone()
+    return {"json_rows": json_rows, "json_bytes": int(json_bytes), "binary_rows": bin_rows, "binary_bytes": int(bin_bytes)}
@@ -0,0 +1,95 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def validate_filters(filters: Any) -> Optional[Dict[str, Any]]:
+    """Return `filters` as a metadata filter dict (None if empty), or raise ValueError."""
+    if filters is None:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError(f"Metadata filters must be an object, got {type(filters).__name__}")
+    return filters or None
+
+
+def matches(metadata: Any, filters: Dict[str, Any]) -> bool:
+    """True if `metadata` contains `filters`, with Postgres `metadata @> filters` semantics."""
+    return _contains(metadata or {}, filters)
+
+
+class MetadataBitmaps:
+    """Per-value row postings over one index snapshot's documents.
+
+    Top-level scalar values and the scalar elements of list values are
+    indexed, so a filter like ``{"category": "icu", "tags": ["oxygen"]}``
+    becomes the AND of a few boolean masks. Clauses that can't be answered
+    from the postings (nested objects) are checked row by row, but only on
+    rows that survived the indexed clauses.
+    """
+
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self.size = len(docs)
+        self._metadata = [d.get("metadata") or {} for d in docs]
+        postings: Dict[Tuple[str, str, str], List[int]] = {}
+        for row, metadata in enumerate(self._metadata):
+            if not isinstance(metadata, dict):
+                continue
+            for key, value in metadata.items():
+                if isinstance(value, list):
+                    for element in value:
+                        if _is_scalar(element):
+                            postings.setdefault((key, "[]", _scalar_key(element)), []).append(row)
+                elif _is_scalar(value):
+                    postings.setdefault((key, "=", _scalar_key(value)), []).append(row)
+        self._postings = {k: np.asarray(sorted(set(rows)), dtype=np.int32) for k, rows in postings.items()}
+
+    def mask(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Boolean mask of the rows whose metadata contains `filters`."""
+        mask = np.ones(self.size, dtype=bool)
+        unindexed = {}
+        for key, value in filters.items():
+            if _is_scalar(value):
+                self._restrict(mask, [(key, "=", _scalar_key(value))])
+            elif isinstance(value, list) and all(_is_scalar(e) for e in value):
+                self._restrict(mask, [(key, "[]", _scalar_key(e)) for e in value])
+                if not value:
+                    unindexed[key] = value  # [] matches any list value
+            else:
+                unindexed[key] = value
+        if unindexed:
+            for row in np.flatnonzero(mask):
+                if not _contains(self._metadata[row], unindexed):
+                    mask[row] = False
+        return mask
+
+    def rows(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Row numbers (ascending) whose metadata contains `filters`."""
+        return np.flatnonzero(self.mask(filters))
+
+    def _restrict(self, mask: np.ndarray, keys: List[Tuple[str, str, str]]):
+        for key in keys:
+            clause = np.zeros(self.size, dtype=bool)
+            posting = self._postings.get(key)
+            if posting is not None:
+                clause[posting] = True
+            mask &= clause
+
+
+def _is_scalar(value: Any) -> bool:
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+def _scalar_key(value: Any) -> str:
+    # JSONB compares numbers by value (1 == 1.0) but never equates true with 1
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return json.dumps(value)
+
+
+def _contains(value: Any, pattern: Any) -> bool:
+    if isinstance(pattern, dict):
+        return isinstance(value, dict) and all(k in value and _contains(value[k], p) for k, p in pattern.items())
+    if isinstance(pattern, list):
+        return isinstance(value, list) and all(any(_contains(v, p) for v in value) for p in pattern)
+    return _is_scalar(value) and _scalar_key(value) == _scalar_key(pattern)
@@ -0,0 +1,74 @@
+import os
+import asyncio
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+import numpy as np
+
+# Seconds to wait for the LLM before answering extractively; 0 waits as long as generation takes
+GENERATION_DEADLINE = float(os.environ.get("RAG_GENERATION_DEADLINE", "0"))
+# Latency samples kept per mode for percentiles
+LATENCY_WINDOW = int(os.environ.get("RAG_LATENCY_WINDOW", "1000"))
+
+# Yielded by first_item_deadline when the first item is late
+DEADLINE = object()
+
+
+class LatencyStats:
+    """Rolling per-mode latency percentiles (e.g. rag / offline / extractive / cached)."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, mode: str, elapsed_ms: float):
+        with self._lock:
+            self._samples.setdefault(mode, deque(maxlen=self.window)).append(elapsed_ms)
+            self._counts[mode] = self._counts.get(mode, 0) + 1
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            samples = {mode: np.asarray(values) for mode, values in self._samples.items()}
+            counts = dict(self._counts)
+        return {
+            mode: {
+                "count": counts[mode],
+                "p50_ms": round(float(np.percentile(values, 50)), 1),
+                "p95_ms": round(float(np.percentile(values, 95)), 1),
+                "max_ms": round(float(values.max()), 1),
+            }
+            for mode, values in samples.items()
+        }
+
+
+async def first_item_deadline(stream: AsyncIterator[Any], deadline: Optional[float]) -> AsyncIterator[Any]:
+    """Re-yield `stream`, inserting DEADLINE once if its first item takes over `deadline` seconds.
+
+    The stream keeps running past the deadline; the caller decides whether
+    to keep consuming it. Closing this generator closes `stream`.
+    """
+    it = stream.__aiter__()
+    first = asyncio.ensure_future(it.__anext__())
+    try:
+        if deadline and deadline > 0:
+            done, _ = await asyncio.wait({first}, timeout=deadline)
+            if not done:
+                yield DEADLINE
+        try:
+            item = await first
+        except StopAsyncIteration:
+            return
+        yield item
+        async for item in it:
+            yield item
+    finally:
+        if not first.done():
+            first.cancel()
+            # let the cancelled read unwind before closing the generator it runs in
+            await asyncio.wait({first})
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,106 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Doc = Dict[str, Any]
+
+# Shared by all retrievers; lexical and vector stages are I/O or NumPy bound
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-retrieval")
+
+
+def reciprocal_rank_fusion(
+    rankings: Dict[str, List[Doc]],
+    weights: Optional[Dict[str, float]] = None,
+    k: int = 60,
+) -> List[Tuple[float, Doc]]:
+    """Merge ranked lists: score(d) = sum_i w_i / (k + rank_i(d)), rank starting at 1.
+
+    Documents are identified by their `id`; the first occurrence is kept.
+    """
+    weights = weights or {}
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Doc] = {}
+    for name, ranked in rankings.items():
+        w = weights.get(name, 1.0)
+        if w <= 0:
+            continue
+        for rank, doc in enumerate(ranked, 1):
+            doc_id = doc.get("id")
+            scores[doc_id] = scores.get(doc_id, 0.0) + w / (k + rank)
+            docs.setdefault(doc_id, doc)
+    fused = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+    return [(score, docs[doc_id]) for doc_id, score in fused]
+
+
+class HybridRetriever:
+    """Runs lexical and vector search in parallel and fuses them with RRF.
+
+    `lexical_search(query, limit)` and `vector_search(query_embedding, limit)`
+    return ranked document lists. Either stage may fail or be skipped (no
+    query embedding); the other one still produces results.
+    """
+
+    def __init__(
+        self,
+        lexical_search: Callable[[str, int], List[Doc]],
+        vector_search: Callable[[List[float], int], List[Doc]],
+        candidates: int = 50,
+        rrf_k: int = 60,
+        lexical_weight: float = 1.0,
+        vector_weight: float = 1.0,
+    ):
+        self.lexical_search = lexical_search
+        self.vector_search = vector_search
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.weights = {"lexical": lexical_weight, "vector": vector_weight}
+
+    def retrieve(
+        self,
+        query: str,
+        query_embedding: Optional[List[float]],
+        top_k: int,
+        weights: Optional[Dict[str, float]] = None,
+        vector_search: Optional[Callable[[List[float], int], List[Doc]]] = None,
+        lexical_search: Optional[Callable[[str, int], List[Doc]]] = None,
+    ) -> Tuple[List[Doc], Dict[str, Any]]:
+        """Return (top_k fused documents, per-stage timings in ms plus stage errors).
+
+        ``vector_search`` and ``lexical_search`` override a stage for this
+        call, e.g. to search the local embedder's index with a local query
+        embedding, or to apply metadata filters.
+        """
+        weights = dict(self.weights, **(weights or {}))
+        vector_search = vector_search or self.vector_search
+        lexical_search = lexical_search or self.lexical_search
+        start = time.perf_counter()
+        stages = {}
+        if weights.get("lexical", 0) > 0:
+            stages["lexical"] = _executor.submit(_timed, lexical_search, query, self.candidates)
+        if query_embedding and weights.get("vector", 0) > 0:
+            stages["vector"] = _executor.submit(_timed, vector_search, query_embedding, self.candidates)
+
+        rankings: Dict[str, List[Doc]] = {}
+        info: Dict[str, Any] = {}
+        for name, fut in stages.items():
+            ranked, elapsed_ms, error = fut.result()
+            info[f"{name}_ms"] = round(elapsed_ms, 2)
+            info[f"{name}_hits"] = len(ranked)
+            if error is not None:
+                info[f"{name}_error"] = str(error)
+            rankings[name] = ranked
+
+        fusion_start = time.perf_counter()
+        fused = reciprocal_rank_fusion(rankings, weights, self.rrf_k)
+        info["fusion_ms"] = round((time.perf_counter() - fusion_start) * 1000, 2)
+        info["retrieval_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return [doc for _, doc in fused[:top_k]], info
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    try:
+        result, error = fn(*args) or [], None
+    except Exception as e:
+        result, error = [], e
+    return result, (time.perf_counter() - start) * 1000, error
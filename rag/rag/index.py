@@ -0,0 +1,241 @@
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .filters import MetadataBitmaps
+
+# Storage precision of the in-memory matrix: float32 | float16 | int8. Reduced
+# precisions score a wider candidate pool, then re-rank it at full precision
+# with vectors fetched for just those candidates.
+INDEX_PRECISION = os.environ.get("RAG_INDEX_PRECISION", "float32").lower()
+RERANK_FACTOR = int(os.environ.get("RAG_INDEX_RERANK_FACTOR", "4"))
+PRECISIONS = ("float32", "float16", "int8")
+# Rows scored per block when the matrix has to be upcast, bounding temporaries
+_SCORE_BLOCK = 8192
+
+
+class VectorIndex:
+    """Process-resident, read-only snapshot of document embeddings.
+
+    Embeddings are stored as one contiguous float32 matrix of unit-normalized
+    rows, so a top-k query is a single matrix-vector product plus argpartition.
+    Instances are never mutated after construction; to pick up new documents
+    build a fresh index and swap the reference (see ``IndexHolder``).
+
+    The matrix is the only copy of the vectors the index keeps: indexed
+    documents are stored without their ``embedding``. With
+    ``precision="float16"`` or ``"int8"`` (per-row symmetric scalar
+    quantization) it takes 1/2 or 1/4 of the memory; the best
+    ``top_k * rerank_factor`` rows are then re-scored against full-precision
+    vectors that ``fetch_embeddings`` returns for their ids (e.g.
+    ``rag.db.get_embeddings``), so the final order is exact. Without it, or
+    if the fetch fails, results keep the quantized order.
+
+    ``embeddings`` indexes precomputed vectors (one row per document, e.g.
+    from the local embedder) instead of each document's ``embedding``.
+    """
+
+    def __init__(self, docs: List[Dict[str, Any]], precision: Optional[str] = None,
+                 rerank_factor: Optional[int] = None, embeddings: Optional[np.ndarray] = None,
+                 fetch_embeddings: Optional[Callable[[List[str]], Dict[str, Any]]] = None):
+        self.precision = (precision or INDEX_PRECISION).lower()
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unknown index precision {self.precision!r}; expected one of {PRECISIONS}")
+        self.rerank_factor = RERANK_FACTOR if rerank_factor is None else rerank_factor
+        self.fetch_embeddings = fetch_embeddings
+
+        if embeddings is not None:
+            usable = list(docs)
+            source = np.asarray(embeddings, dtype=np.float32)
+            if source.ndim != 2:
+                source = source.reshape(len(usable), -1) if usable else np.zeros((0, 0), dtype=np.float32)
+            self.dim = source.shape[1]
+            matrix = _normalize_rows(source)
+        else:
+            usable = [d for d in docs if d.get("embedding") is not None and len(d["embedding"])]
+            self.dim = len(usable[0]["embedding"]) if usable else 0
+            usable = [d for d in usable if len(d["embedding"]) == self.dim]
+            matrix = np.asarray([d["embedding"] for d in usable], dtype=np.float32).reshape(len(usable), self.dim)
+            norms = [d.get("embedding_norm") for d in usable]
+            if usable and all(norms):
+                # norms persisted at ingest time; skip recomputing them
+                matrix /= np.asarray(norms, dtype=np.float32)[:, None]
+            else:
+                matrix = _normalize_rows(matrix)
+
+        self.docs: List[Dict[str, Any]] = strip_embeddings(usable)
+        self.ids: List[str] = [d.get("id") for d in usable]
+        self.id_to_row: Dict[str, int] = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+        self.scales = None
+        if self.precision == "float16":
+            matrix = matrix.astype(np.float16)
+        elif self.precision == "int8":
+            matrix, self.scales = quantize_int8(matrix)
+        self.matrix = np.ascontiguousarray(matrix)
+        self._bitmaps: Optional[MetadataBitmaps] = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of vector storage: the matrix plus int8 scales (documents carry no embeddings)."""
+        return int(self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def filter_rows(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Rows whose metadata contains ``filters`` (see ``rag.filters``), for ``search(rows=...)``."""
+        if self._bitmaps is None:
+            self._bitmaps = MetadataBitmaps(self.docs)
+        return self._bitmaps.rows(filters)
+
+    def search(self, query_embedding: List[float], top_k: int,
+               rows: Optional[np.ndarray] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """Return up to ``top_k`` ``(cosine, doc)`` pairs, best first.
+
+        ``rows`` restricts scoring to those rows (e.g. ``filter_rows(...)``),
+        so a filtered query only touches its slice of the matrix.
+        """
+        if not len(self) or top_k <= 0 or query_embedding is None or len(query_embedding) != self.dim:
+            return []
+        if rows is not None and not len(rows):
+            return []
+        q = np.asarray(query_embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if norm == 0.0:
+            return []
+        q = q / norm
+        scores = self._approximate_scores(q, rows)
+        row_ids = np.arange(len(self.docs)) if rows is None else np.asarray(rows)
+
+        if self.precision == "float32" or self.rerank_factor <= 0 or self.fetch_embeddings is None:
+            top = _top_k(scores, top_k)
+            return [(float(scores[i]), self.docs[row_ids[i]]) for i in top]
+
+        pool = _top_k(scores, top_k * self.rerank_factor)
+        candidates = row_ids[pool]
+        exact = self._exact_scores(candidates, q, scores[pool])
+        order = _top_k(exact, top_k)
+        return [(float(exact[j]), self.docs[candidates[j]]) for j in order]
+
+    def _approximate_scores(self, q: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.precision == "float32":
+            return matrix @ q
+        # float16/int8 have no BLAS path; upcast block by block
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(scores), _SCORE_BLOCK):
+            block = matrix[start:start + _SCORE_BLOCK].astype(np.float32)
+            scores[start:start + _SCORE_BLOCK] = block @ q
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def _exact_scores(self, rows: np.ndarray, q: np.ndarray, approximate: np.ndarray) -> np.ndarray:
+        """Full-precision cosines for `rows`; rows whose vector can't be fetched keep `approximate`."""
+        try:
+            vectors = self.fetch_embeddings([self.ids[r] for r in rows])
+        except Exception as e:
+            print(f"Re-rank fetch failed, keeping quantized order: {e}")
+            return approximate
+        exact = np.array(approximate, dtype=np.float32)
+        for j, row in enumerate(rows):
+            vec = vectors.get(self.ids[row])
+            if vec is None or len(vec) != self.dim:
+                continue
+            vec = np.asarray(vec, dtype=np.float32)
+            norm = float(np.linalg.norm(vec))
+            if norm:
+                exact[j] = float(vec @ q) / norm
+        return exact
+
+
+class IndexHolder:
+    """Holds the current index snapshot and swaps it atomically on rebuild.
+
+    Readers take ``holder.index`` once and search that snapshot; a rebuild
+    constructs a new index off to the side and then replaces the reference,
+    so queries never wait on ingestion. ``factory`` builds the index from a
+    document list (``VectorIndex`` by default, or e.g. ``BM25Index``).
+    """
+
+    def __init__(self, factory: Callable[[List[Dict[str, Any]]], Any] = None):
+        self._factory = factory or VectorIndex
+        self._index = None
+        self._build_lock = threading.Lock()
+
+    @property
+    def index(self):
+        return self._index
+
+    def rebuild(self, load_docs: Callable[[], List[Dict[str, Any]]]):
+        # Loading happens under the build lock so concurrent rebuilds can't
+        # publish an older snapshot after a newer one.
+        with self._build_lock:
+            new_index = self._factory(load_docs())
+            self._index = new_index
+            return new_index
+
+
+def quantize_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: row ~= codes * scale."""
+    scales = np.abs(matrix).max(axis=1) / 127.0 if matrix.size else np.zeros(len(matrix), dtype=np.float32)
+    scales[scales == 0.0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def strip_embeddings(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Shallow copies of `docs` without their `embedding` (docs without one are reused as-is)."""
+    return [{k: v for k, v in d.items() if k != "embedding"} if "embedding" in d else d for d in docs]
+
+
+def recall_at_k(docs: List[Dict[str, Any]], queries: List[List[float]], k: int = 5,
+                precisions=PRECISIONS, rerank_factor: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+    """Recall@k of each index precision against exact float32 search, plus its vector storage size.
+
+    Re-rank vectors are looked up in `docs`, standing in for the database.
+    """
+    exact = VectorIndex(docs, precision="float32", rerank_factor=0)
+    truth = [{d.get("id") for _, d in exact.search(q, k)} for q in queries]
+    vectors = {d.get("id"): d.get("embedding") for d in docs}
+
+    def fetch(ids):
+        return {i: vectors.get(i) for i in ids}
+
+    report = {}
+    for precision in precisions:
+        index = VectorIndex(docs, precision=precision, rerank_factor=rerank_factor, fetch_embeddings=fetch)
+        hits = sum(
+            len(expected & {d.get("id") for _, d in index.search(q, k)})
+            for q, expected in zip(queries, truth)
+        )
+        total = sum(len(expected) for expected in truth)
+        report[precision] = {"recall": hits / total if total else 1.0, "nbytes": index.nbytes}
+    return report
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.arange(0)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def embedding_norm(embedding) -> Optional[float]:
+    """L2 norm of an embedding (None if missing or zero), stored alongside it at ingest."""
+    if embedding is None or not len(embedding):
+        return None
+    norm = float(np.linalg.norm(np.asarray(embedding, dtype=np.float32)))
+    return norm or None
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    if not matrix.size:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return matrix / norms
@@ -1,43 +1,297 @@
 import os
 import json
 import uuid
-from typing import List
+import hashlib
+import time
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
 from .cache import get_cached_embedding, set_cached_embedding
-from .vertex import embed_text
-from .db import insert_document, init_db
+from .vertex import embed_texts, EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+from .db import insert_documents, init_db, get_content_hashes, get_source_ids, delete_documents
+from .chunking import chunk_document, CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_STRATEGY
+from .worker import QueueProcessor, QUEUE_WORKERS, QUEUE_MAX_ATTEMPTS
+from .sources import batched
+from .metrics import peak_rss_mb
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), "..")
 QUEUE_DIR = os.path.join(BASE_DIR, "queue")
 os.makedirs(QUEUE_DIR, exist_ok=True)
 
-def queue_documents(docs: List[dict]):
-    """Write docs to queue as JSON files for offline-safe ingestion."""
+def queue_documents(docs: Iterable[dict]) -> int:
+    """Write docs to queue as JSON files for offline-safe ingestion; returns how many were queued."""
+    count = 0
     for d in docs:
         fname = f"{uuid.uuid4().hex}.json"
         path = os.path.join(QUEUE_DIR, fname)
         with open(path, "w", encoding="utf-8") as f:
             json.dump(d, f)
+        count += 1
+    return count
 
-def process_queue():
-    """Process queued documents: compute embeddings (with local cache) and insert into Postgres."""
+def document_id(content: str) -> str:
+    """Stable default id derived from the content (unlike the per-process salted hash())."""
+    return "doc-" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+def normalize_document(d: dict) -> Dict[str, Any]:
+    content = d.get('content') or d.get('text') or ''
+    return {
+        'id': d.get('id') or document_id(content),
+        'content': content,
+        'metadata': d.get('metadata') or {},
+    }
+
+def fingerprint(doc: dict, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                chunk_strategy: str = CHUNK_STRATEGY) -> str:
+    """Hash of everything that determines a document's stored rows.
+
+    Chunk settings are included so changing them re-chunks the corpus on the
+    next sync even if no text changed.
+    """
+    payload = json.dumps(
+        [doc.get('content') or '', doc.get('metadata') or {}, [chunk_size, chunk_overlap, chunk_strategy]],
+        sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def print_progress(batches_done: int, batches_total: int, texts_done: int):
+    print(f"  embedded batch {batches_done}/{batches_total} ({texts_done} texts)")
+
+def embed_with_cache(
+    texts: List[str],
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int, int], None]] = None,
+) -> List:
+    """Embed texts, calling the batch API only for cache misses.
+
+    Returns one entry per text: the embedding, or the exception raised for
+    the batch that contained it.
+    """
+    results = [get_cached_embedding(t) for t in texts]
+    misses = [i for i, emb in enumerate(results) if not emb]
+    if misses:
+        fresh = embed_texts(
+            [texts[i] for i in misses],
+            batch_size=batch_size,
+            concurrency=concurrency,
+            on_progress=on_progress,
+            return_exceptions=True,
+        )
+        for i, emb in zip(misses, fresh):
+            results[i] = emb
+            if not isinstance(emb, Exception):
+                set_cached_embedding(texts[i], emb)
+    return results
+
+def ingest_batch(
+    docs: List[dict],
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    chunk_strategy: str = CHUNK_STRATEGY,
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int, int], None]] = None,
+    conn=None,
+    force: bool = False,
+) -> Dict[str, Any]:
+    """Chunk, embed and upsert documents given as {'id', 'content', 'metadata'} dicts.
+
+    Documents whose stored fingerprint matches are skipped before any
+    embedding call (unless `force`). A document is written only if every one
+    of its chunks embedded; its old chunks are replaced in the same
+    transaction. Returns the added, updated and skipped ids, the ingested ids
+    (added + updated), the chunk count and per-document failures.
+
+    Without `conn`, the hash lookup and the upsert each take a pooled
+    connection only for their own statement, so none is held (idle in
+    transaction) while embedding waits on the API.
+    """
+    # later duplicates of an id win, as they would in the upsert
+    docs = list({d['id']: d for d in (normalize_document(d) for d in docs)}.values())
+    existing = {} if force else get_content_hashes([d['id'] for d in docs], conn=conn)
+    added, updated, skipped, pending = [], [], [], []
+    for d in docs:
+        fp = fingerprint(d, chunk_size, chunk_overlap, chunk_strategy)
+        if d['id'] in existing and existing[d['id']] == fp:
+            skipped.append(d['id'])
+            continue
+        pending.append((d, fp))
+
+    chunked = [
+        (d, fp, chunk_document(d['id'], d['content'], d['metadata'],
+                               size=chunk_size, overlap=chunk_overlap, strategy=chunk_strategy))
+        for d, fp in pending
+    ]
+    texts = [c['content'] for _, _, chunks in chunked for c in chunks]
+    embeddings = iter(embed_with_cache(texts, batch_size=batch_size, concurrency=concurrency, on_progress=on_progress))
+
+    rows, failed = [], []
+    for d, fp, chunks in chunked:
+        doc_embeddings = [next(embeddings) for _ in chunks]
+        error = next((e for e in doc_embeddings if isinstance(e, Exception)), None)
+        if error is not None:
+            failed.append({"id": d['id'], "error": str(error)})
+            continue
+        if not chunks:
+            failed.append({"id": d['id'], "error": "empty content"})
+            continue
+        rows.extend(
+            (c['id'], c['content'], c['metadata'], emb, c['parent_id'], fp)
+            for c, emb in zip(chunks, doc_embeddings)
+        )
+        (updated if d['id'] in existing else added).append(d['id'])
+
+    insert_documents(rows, conn=conn, replace_parents=True)
+    return {
+        "added": added,
+        "updated": updated,
+        "skipped": skipped,
+        "ingested": added + updated,
+        "chunks": len(rows),
+        "failed": failed,
+    }
+
+def sync_documents(
+    docs: List[dict],
+    prune: bool = False,
+    group_size: Optional[int] = None,
+    conn=None,
+    **ingest_kwargs,
+) -> Dict[str, Any]:
+    """Bring the store in line with `docs` (e.g. a nightly corpus export).
+
+    Documents are ingested incrementally in groups; with `prune`, stored
+    documents absent from `docs` are deleted. Returns the id lists plus a
+    `summary` of counts.
+    """
+    docs = [normalize_document(d) for d in docs]
+    group_size = group_size or EMBED_BATCH_SIZE * EMBED_CONCURRENCY
+    result: Dict[str, Any] = {"added": [], "updated": [], "skipped": [], "deleted": [], "failed": [], "chunks": 0}
+    for start in range(0, len(docs), group_size):
+        batch = ingest_batch(docs[start:start + group_size], conn=conn, **ingest_kwargs)
+        for key in ("added", "updated", "skipped", "failed"):
+            result[key].extend(batch[key])
+        result["chunks"] += batch["chunks"]
+    if prune:
+        keep = {d['id'] for d in docs}
+        stale = [sid for sid in get_source_ids(conn=conn) if sid not in keep]
+        delete_documents(stale, conn=conn)
+        result["deleted"] = stale
+    result["ingested"] = result["added"] + result["updated"]
+    result["summary"] = {key: len(result[key]) for key in ("added", "updated", "skipped", "deleted", "failed")}
+    return result
+
+def ingest_stream(
+    docs: Iterable[dict],
+    prune: bool = False,
+    group_size: Optional[int] = None,
+    conn=None,
+    on_group: Optional[Callable[[Dict[str, Any]], None]] = None,
+    **ingest_kwargs,
+) -> Dict[str, Any]:
+    """Ingest a document stream of any length (e.g. from rag.sources) in bounded memory.
+
+    Documents are pulled `group_size` at a time and each group is chunked,
+    embedded in API batches and upserted by `ingest_batch` before the next
+    is read, so peak memory depends on the group size, not the corpus. Only
+    counts are accumulated (plus the ids seen, with `prune`). `on_group`
+    gets the running totals after every group. Returns the counts,
+    per-document failures and throughput.
+    """
+    group_size = group_size or EMBED_BATCH_SIZE * EMBED_CONCURRENCY
+    totals = {"added": 0, "updated": 0, "skipped": 0, "deleted": 0, "failed": 0}
+    failed: List[Dict[str, str]] = []
+    seen = set()
+    documents = chunks = groups = 0
+    started = time.perf_counter()
+    for group in batched((normalize_document(d) for d in docs), group_size):
+        batch = ingest_batch(group, conn=conn, **ingest_kwargs)
+        for key in ("added", "updated", "skipped", "failed"):
+            totals[key] += len(batch[key])
+        failed.extend(batch["failed"])
+        if prune:
+            seen.update(d['id'] for d in group)
+        documents += len(group)
+        chunks += batch["chunks"]
+        groups += 1
+        if on_group:
+            on_group(dict(totals, groups=groups, **_throughput(documents, chunks, started)))
+    if prune:
+        stale = [sid for sid in get_source_ids(conn=conn) if sid not in seen]
+        delete_documents(stale, conn=conn)
+        totals["deleted"] = len(stale)
+    return {"summary": totals, "failed": failed, "groups": groups, **_throughput(documents, chunks, started)}
+
+def _throughput(documents: int, chunks: int, started: float) -> Dict[str, Any]:
+    elapsed = time.perf_counter() - started
+    return {
+        "documents": documents,
+        "chunks": chunks,
+        "elapsed_s": round(elapsed, 2),
+        "docs_per_s": round(documents / elapsed, 1) if elapsed else 0.0,
+        "chunks_per_s": round(chunks / elapsed, 1) if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def print_throughput(stats: Dict[str, Any]):
+    peak = f", peak RSS {stats['peak_rss_mb']} MB" if stats.get("peak_rss_mb") is not None else ""
+    print(f"  {stats['documents']} documents, {stats['chunks']} chunks in {stats['elapsed_s']}s "
+          f"({stats['docs_per_s']} docs/s, {stats['chunks_per_s']} chunks/s{peak})")
+
+def print_summary(summary: Dict[str, int]):
+    print("Added {added}, updated {updated}, skipped {skipped} unchanged, deleted {deleted}, failed {failed}".format(**summary))
+
+def process_queue(
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    chunk_strategy: str = CHUNK_STRATEGY,
+    workers: int = QUEUE_WORKERS,
+    max_attempts: int = QUEUE_MAX_ATTEMPTS,
+    wait_for_retries: bool = True,
+):
+    """Process queued documents: chunk, compute embeddings (with local cache) and insert into Postgres.
+
+    `workers` threads claim groups of batch_size * concurrency files (see
+    rag.worker.QueueProcessor); each group lands in the database as one
+    multi-row upsert on a pooled connection taken just for the write. Failed files are
+    retried with backoff and dead-lettered after `max_attempts`.
+    """
     init_db()
-    files = [f for f in os.listdir(QUEUE_DIR) if f.endswith('.json')]
-    for fn in files:
-        path = os.path.join(QUEUE_DIR, fn)
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                d = json.load(f)
-            text = d.get('content') or d.get('text') or ''
-            doc_id = d.get('id') or str(uuid.uuid4())
-            metadata = d.get('metadata') or {}
-
-            emb = get_cached_embedding(text)
-            if not emb:
-                emb = embed_text(text)
-                set_cached_embedding(text, emb)
-
-            insert_document(doc_id, text, metadata, emb)
-            # move/delete queue file
-            os.remove(path)
-        except Exception as e:
-            print(f"Failed to process {path}: {e}")
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    concurrency = concurrency or EMBED_CONCURRENCY
+    totals = {"added": 0, "updated": 0, "skipped": 0, "deleted": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def ingest_files(items):
+        docs = {name: normalize_document(d) for name, d in items}
+        result = ingest_batch(
+            list(docs.values()),
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            chunk_strategy=chunk_strategy,
+            batch_size=batch_size,
+            concurrency=concurrency,
+            on_progress=print_progress,
+        )
+        with lock:
+            for key in ("added", "updated", "skipped", "failed"):
+                totals[key] += len(result[key])
+        failed = {f['id']: f['error'] for f in result['failed']}
+        print(f"Ingested {len(docs) - len(failed)}/{len(docs)} claimed files ({result['chunks']} chunks)")
+        return {name: failed.get(d['id']) for name, d in docs.items()}
+
+    processor = QueueProcessor(
+        ingest_files,
+        QUEUE_DIR,
+        workers=workers,
+        batch_files=batch_size * concurrency,
+        max_attempts=max_attempts,
+        wait_for_retries=wait_for_retries,
+    )
+    stats = processor.run()
+    print_summary(totals)
+    print(f"Queue: {stats['completed']} files done, {stats['retried']} retries, "
+          f"{stats['dead_lettered']} dead-lettered (checkpoint {processor.checkpoint_path})")
+    return dict(totals, queue=stats)
@@ -0,0 +1,124 @@
+import os
+import json
+import zlib
+import threading
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from .text import tokenize
+from .vertex import Embedder
+
+LOCAL_EMBED_DIM = int(os.environ.get("RAG_LOCAL_EMBED_DIM", "512"))
+LOCAL_VOCAB_FILE = os.environ.get("RAG_LOCAL_VOCAB") or os.path.join(
+    os.path.dirname(__file__), "..", "cache", "local_vocab.json"
+)
+NGRAM_RANGE = (3, 5)
+
+
+@lru_cache(maxsize=200_000)
+def _token_buckets(token: str, dim: int, lo: int, hi: int) -> Tuple[int, ...]:
+    # word-boundary padded character n-grams, hashed into `dim` buckets
+    padded = f" {token} "
+    grams = [padded[i:i + n] for n in range(lo, hi + 1) for i in range(max(1, len(padded) - n + 1))]
+    return tuple(zlib.crc32(g.encode("utf-8")) % dim for g in grams)
+
+
+class HashedNgramEmbedder(Embedder):
+    """Offline TF-IDF embedder over hashed character n-grams.
+
+    Needs no network or model download: every text maps to a fixed-size
+    vector (sublinear tf times idf, L2-normalized). Document frequencies per
+    bucket are the vocabulary; they are fit on the corpus and persisted to
+    JSON so query vectors match the index they are compared against. Before
+    any fit, idf is uniform and vectors are plain n-gram tf.
+    """
+
+    name = "local"
+
+    def __init__(self, dim: int = LOCAL_EMBED_DIM, ngram_range: Tuple[int, int] = NGRAM_RANGE,
+                 vocab_path: str = LOCAL_VOCAB_FILE):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.vocab_path = vocab_path
+        self.doc_count = 0
+        self.df = np.zeros(dim, dtype=np.float32)
+        self._idf = np.ones(dim, dtype=np.float32)
+        self._lock = threading.Lock()
+        if vocab_path and os.path.exists(vocab_path):
+            try:
+                self.load(vocab_path)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring local embedder vocabulary {vocab_path}: {e}")
+
+    def embed(self, text: str) -> List[float]:
+        return self.embed_many([text])[0].tolist()
+
+    def embed_many(self, texts: Sequence[str]) -> np.ndarray:
+        """Unit-normalized float32 matrix with one row per text."""
+        return self._weight(self._counts(texts))
+
+    def fit(self, texts: Sequence[str]) -> "HashedNgramEmbedder":
+        """Replace the vocabulary with document frequencies of `texts`."""
+        df = np.zeros(self.dim, dtype=np.float32)
+        for start in range(0, len(texts), 1024):
+            df += (self._counts(texts[start:start + 1024]) > 0).sum(axis=0)
+        self._set_vocabulary(df, len(texts))
+        return self
+
+    def fit_transform(self, texts: Sequence[str]) -> np.ndarray:
+        """fit(texts) then embed_many(texts), counting n-grams only once."""
+        counts = self._counts(texts)
+        self._set_vocabulary((counts > 0).sum(axis=0).astype(np.float32), len(texts))
+        return self._weight(counts)
+
+    def _weight(self, counts: np.ndarray) -> np.ndarray:
+        mask = counts > 0
+        counts[mask] = 1.0 + np.log(counts[mask])
+        counts *= self._idf
+        norms = np.linalg.norm(counts, axis=1, keepdims=True)
+        norms[norms == 0.0] = 1.0
+        counts /= norms
+        return counts
+
+    def save(self, path: str = None):
+        path = path or self.vocab_path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        data = {
+            "dim": self.dim,
+            "ngram_range": list(self.ngram_range),
+            "doc_count": self.doc_count,
+            "df": self.df.astype(int).tolist(),
+        }
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, path: str = None):
+        with open(path or self.vocab_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["dim"] != self.dim or tuple(data["ngram_range"]) != tuple(self.ngram_range):
+            raise ValueError("vocabulary was built with different dim/ngram settings")
+        self._set_vocabulary(np.asarray(data["df"], dtype=np.float32), int(data["doc_count"]))
+
+    def _set_vocabulary(self, df: np.ndarray, doc_count: int):
+        with self._lock:
+            self.df = df
+            self.doc_count = doc_count
+            self._idf = self._compute_idf()
+
+    def _compute_idf(self) -> np.ndarray:
+        if not self.doc_count:
+            return np.ones(self.dim, dtype=np.float32)
+        return (np.log((1.0 + self.doc_count) / (1.0 + self.df)) + 1.0).astype(np.float32)
+
+    def _counts(self, texts: Sequence[str]) -> np.ndarray:
+        lo, hi = self.ngram_range
+        counts = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            buckets = [b for tok in tokenize(text) for b in _token_buckets(tok, self.dim, lo, hi)]
+            if buckets:
+                counts[row] = np.bincount(buckets, minlength=self.dim)
+        return counts
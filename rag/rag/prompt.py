@@ -0,0 +1,85 @@
+import os
+import math
+from typing import Any, Dict, List, Tuple
+
+from .chunking import split_sentences
+
+# Upper bound on the estimated size of a generation prompt, in tokens
+PROMPT_TOKEN_BUDGET = int(os.environ.get("RAG_PROMPT_TOKEN_BUDGET", "3000"))
+# ~4 characters per token for English text (same estimate as chunking)
+CHARS_PER_TOKEN = 4.0
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Leading whole sentences of `text` that fit in `max_tokens` ("" if none do)."""
+    kept: List[str] = []
+    used = 0
+    for sentence in split_sentences(text):
+        cost = estimate_tokens(sentence) + (1 if kept else 0)
+        if used + cost > max_tokens:
+            break
+        kept.append(sentence)
+        used += cost
+    return " ".join(kept)
+
+
+def pack_passages(docs: List[Dict[str, Any]], budget: int) -> Tuple[List[str], Dict[str, int]]:
+    """Fit document passages into `budget` tokens, best-ranked documents first.
+
+    `docs` are in rank order. Each document goes in whole if it fits,
+    otherwise trimmed to the sentences that fit the remaining budget, and is
+    dropped if not even its first sentence does. Passages are formatted as
+    "Document <n>:" blocks numbered in packing order.
+    """
+    passages: List[str] = []
+    stats = {"context_tokens": 0, "tokens_dropped": 0, "documents_included": 0,
+             "documents_trimmed": 0, "documents_dropped": 0}
+    remaining = max(0, budget)
+    for doc in docs:
+        content = (doc.get("content") or "").strip()
+        full = estimate_tokens(content)
+        header = f"Document {len(passages) + 1}:\n"
+        room = remaining - estimate_tokens(header) - 1
+        trimmed = full > room
+        text = trim_to_tokens(content, room) if trimmed else content
+        if not text:
+            stats["documents_dropped"] += 1
+            stats["tokens_dropped"] += full
+            continue
+        passage = f"{header}{text}\n\n"
+        used = estimate_tokens(passage)
+        passages.append(passage)
+        remaining -= used
+        stats["context_tokens"] += used
+        stats["documents_included"] += 1
+        if trimmed:
+            stats["documents_trimmed"] += 1
+            stats["tokens_dropped"] += max(0, full - estimate_tokens(text))
+    return passages, stats
+
+
+def build_prompt(preamble: str, docs: List[Dict[str, Any]], closing: str,
+                 budget: int = None) -> Tuple[str, Dict[str, int]]:
+    """Assemble preamble + packed document passages + closing within a token budget.
+
+    Returns the prompt and its token accounting: the budget, estimated tokens
+    used by the whole prompt, context tokens dropped, and how many documents
+    were included, trimmed or dropped.
+    """
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    fixed = estimate_tokens(preamble) + estimate_tokens(closing)
+    passages, stats = pack_passages(docs, budget - fixed)
+    prompt = preamble + "".join(passages) + closing
+    return prompt, {
+        "token_budget": budget,
+        "tokens_used": estimate_tokens(prompt),
+        "tokens_dropped": stats["tokens_dropped"],
+        "context_tokens": stats["context_tokens"],
+        "documents_included": stats["documents_included"],
+        "documents_trimmed": stats["documents_trimmed"],
+        "documents_dropped": stats["documents_dropped"],
+    }
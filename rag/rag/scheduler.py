@@ -0,0 +1,248 @@
+"""Process-wide rate scheduler for Gemini generation and embedding calls.
+
+Every call to the API (rag.vertex over HTTP, and the LangChain agents via
+a callback) takes a permit from one shared ``LLMScheduler`` first. Permits
+come from two token buckets, one for requests per minute and one for tokens
+per minute. Waiting callers are queued by priority class, so interactive
+chat goes ahead of background agent runs and ingestion batches. A 429 from
+any caller pauses everyone for a while, instead of each caller retrying on
+its own schedule.
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+# Limits for the whole process; 0 disables a limit
+LLM_RPM = float(os.environ.get("RAG_LLM_RPM", "0"))
+LLM_TPM = float(os.environ.get("RAG_LLM_TPM", "1000000"))
+
+# Lower value = served first
+PRIORITIES = {"interactive": 0, "default": 1, "background": 2, "batch": 3}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("llm_priority", default="interactive")
+# A waiter that isn't first in line re-checks at least this often
+_IDLE_POLL = 1.0
+
+
+@contextmanager
+def llm_priority(name: str):
+    """Run the calls made in this block (same thread / task) at priority `name`."""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority {name!r}; expected one of {list(PRIORITIES)}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Refills at `per_minute / 60` units per second up to one minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.unlimited = per_minute <= 0
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        if not self.unlimited:
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        if self.unlimited or self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.level -= amount  # may go negative when usage is settled upward
+
+
+class Permit:
+    """Granted slot for one call; `settle` corrects the token estimate afterwards."""
+
+    def __init__(self, scheduler: "LLMScheduler", tokens: float):
+        self._scheduler = scheduler
+        self.tokens = tokens
+
+    def settle(self, actual_tokens: Optional[float]):
+        if actual_tokens is None:
+            return
+        self._scheduler._adjust_tokens(actual_tokens - self.tokens)
+        self.tokens = actual_tokens
+
+
+class _Waiter:
+    __slots__ = ("priority", "tokens", "event", "loop")
+
+    def __init__(self, priority: str, tokens: float, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.tokens = tokens
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class LLMScheduler:
+    """Grants API calls in priority order within requests/tokens-per-minute budgets.
+
+    ``acquire`` blocks the calling thread and ``aacquire`` awaits without
+    blocking the event loop; both share one queue. Only the first waiter in
+    line may take from the buckets, so a stream of cheap background calls
+    can't starve an interactive one.
+    """
+
+    def __init__(self, rpm: float = LLM_RPM, tpm: float = LLM_TPM):
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._lock = threading.Lock()
+        self._queue: List[Tuple[int, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._depth = {name: 0 for name in PRIORITIES}
+        self._granted = {name: 0 for name in PRIORITIES}
+        self._wait_ms = {name: 0.0 for name in PRIORITIES}
+        self._max_depth = 0
+        self._rate_limited = 0
+
+    def acquire(self, tokens: float = 0, priority: Optional[str] = None) -> Permit:
+        waiter = self._enqueue(tokens, priority)
+        started = time.monotonic()
+        try:
+            while True:
+                waiter.event.clear()
+                wait = self._poll(waiter, started)
+                if wait == 0.0:
+                    return Permit(self, waiter.tokens)
+                waiter.event.wait(_IDLE_POLL if wait is None else min(wait, _IDLE_POLL))
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def aacquire(self, tokens: float = 0, priority: Optional[str] = None) -> Permit:
+        waiter = self._enqueue(tokens, priority, asyncio.get_running_loop())
+        started = time.monotonic()
+        try:
+            while True:
+                waiter.event.clear()
+                wait = self._poll(waiter, started)
+                if wait == 0.0:
+                    return Permit(self, waiter.tokens)
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), _IDLE_POLL if wait is None else min(wait, _IDLE_POLL))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def penalize(self, seconds: float):
+        """Hold every caller for `seconds` (the API answered 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._rate_limited += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            return {
+                "rpm_limit": self._requests.capacity or None,
+                "tpm_limit": self._tokens.capacity or None,
+                "queue_depth": dict(self._depth),
+                "max_queue_depth": self._max_depth,
+                "granted": dict(self._granted),
+                "avg_wait_ms": {
+                    name: round(self._wait_ms[name] / self._granted[name], 1) if self._granted[name] else 0.0
+                    for name in PRIORITIES
+                },
+                "requests_available": None if self._requests.unlimited else round(self._requests.level, 1),
+                "tokens_available": None if self._tokens.unlimited else round(self._tokens.level),
+                "paused_seconds": round(max(0.0, self._paused_until - now), 1),
+                "rate_limited": self._rate_limited,
+            }
+
+    def _enqueue(self, tokens: float, priority: Optional[str], loop=None) -> _Waiter:
+        priority = priority or _priority.get()
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}; expected one of {list(PRIORITIES)}")
+        if not self._tokens.unlimited:
+            tokens = min(tokens, self._tokens.capacity)  # would never fit otherwise
+        waiter = _Waiter(priority, tokens, loop)
+        with self._lock:
+            heapq.heappush(self._queue, (PRIORITIES[priority], next(self._seq), waiter))
+            self._depth[priority] += 1
+            self._max_depth = max(self._max_depth, len(self._queue))
+        return waiter
+
+    def _poll(self, waiter: _Waiter, started: float) -> Optional[float]:
+        """0.0 if `waiter` got its permit, else seconds until it may (None: not first in line)."""
+        with self._lock:
+            if self._queue[0][2] is not waiter:
+                return None
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            wait = max(self._paused_until - now, self._requests.time_until(1), self._tokens.time_until(waiter.tokens))
+            if wait > 0:
+                return wait
+            heapq.heappop(self._queue)
+            self._requests.take(1)
+            self._tokens.take(waiter.tokens)
+            self._depth[waiter.priority] -= 1
+            self._granted[waiter.priority] += 1
+            self._wait_ms[waiter.priority] += (now - started) * 1000
+            self._wake_next()
+            return 0.0
+
+    def _abandon(self, waiter: _Waiter):
+        with self._lock:
+            for i, (_, _, w) in enumerate(self._queue):
+                if w is waiter:
+                    self._queue.pop(i)
+                    heapq.heapify(self._queue)
+                    self._depth[waiter.priority] -= 1
+                    self._wake_next()
+                    break
+
+    def _adjust_tokens(self, delta: float):
+        with self._lock:
+            self._tokens.take(delta)
+
+    def _wake_next(self):
+        if self._queue:
+            self._queue[0][2].wake()
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """The process-wide scheduler (created from RAG_LLM_RPM / RAG_LLM_TPM)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
+
+
+def usage_tokens(data: Any) -> Optional[int]:
+    """Total tokens billed for a Gemini response, if it reports them."""
+    usage = data.get("usageMetadata") if isinstance(data, dict) else None
+    return (usage or {}).get("totalTokenCount")
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+_groups: Dict[str, "SingleFlight"] = {}
+_groups_lock = threading.Lock()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one upstream call.
+
+    While a call for ``key`` is in flight, further callers with that key wait
+    for it and get its result (or its exception) instead of calling again.
+    Nothing is cached: once the call finishes, the next caller starts a new
+    one. ``do`` coalesces threads; ``ado`` coalesces tasks on an event loop,
+    and the shared call is shielded so one caller being cancelled doesn't
+    cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._stats = {"calls": 0, "executions": 0, "shared": 0}
+        with _groups_lock:
+            _groups[name] = self
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._stats["executions"] += 1
+            else:
+                self._stats["shared"] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        task_key = (loop, key)  # tasks belong to one event loop
+        with self._lock:
+            self._stats["calls"] += 1
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = loop.create_task(fn(*args, **kwargs))
+                task.add_done_callback(partial(self._forget, task_key))
+                self._stats["executions"] += 1
+            else:
+                self._stats["shared"] += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls) + len(self._tasks))
+
+    def _forget(self, task_key, task: asyncio.Task):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even if every waiter was cancelled
+
+
+def singleflight_stats() -> Dict[str, Dict[str, int]]:
+    """Call, execution and shared-result counts of every SingleFlight group."""
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {g.name: g.stats() for g in groups}
@@ -0,0 +1,173 @@
+import os
+import json
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Characters read from a JSON array file per refill
+READ_SIZE = 1 << 16
+TEXT_EXTENSIONS = (".txt", ".md")
+FORMATS = ("json", "jsonl", "text")
+
+
+def detect_format(path: str) -> str:
+    """`text` for directories and .txt/.md files, `jsonl` for .jsonl/.ndjson, else `json`."""
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path) or ext in TEXT_EXTENSIONS:
+        return "text"
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    return "json"
+
+
+def iter_source(path: str, fmt: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Stream documents from a JSON array, JSON Lines file, or text file / directory.
+
+    Documents are yielded one at a time, so memory use doesn't grow with the
+    size of the source.
+    """
+    fmt = fmt or detect_format(path)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown source format {fmt!r}; expected one of {FORMATS}")
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    if fmt == "text":
+        return iter_text_files(path)
+    if fmt == "jsonl":
+        return _documents(iter_jsonl(path), path)
+    return _documents(iter_json_array(path), path)
+
+
+def iter_jsonl(path: str) -> Iterator[Any]:
+    """One JSON value per non-blank line."""
+    with open(path, "r", encoding="utf-8-sig") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{lineno}: invalid JSON: {e}") from e
+
+
+def iter_json_array(path: str, read_size: int = READ_SIZE) -> Iterator[Any]:
+    """Elements of a top-level JSON array, parsed incrementally.
+
+    Only the element being decoded (plus one read) is held in memory, unlike
+    ``json.load`` which materializes the whole array.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8-sig") as f:
+        reader = _Reader(f, read_size)
+        if reader.peek() != "[":
+            raise ValueError(f"{path}: expected a JSON array of documents")
+        reader.pos += 1
+        if reader.peek() == "]":
+            return
+        while True:
+            yield reader.decode(decoder)
+            ch = reader.peek()
+            reader.pos += 1
+            if ch == "]":
+                return
+            if ch != ",":
+                raise ValueError(f"{path}: expected ',' or ']' between array elements, got {ch or 'end of file'!r}")
+
+
+def iter_text_files(path: str, extensions: Tuple[str, ...] = TEXT_EXTENSIONS) -> Iterator[Dict[str, Any]]:
+    """One document per .txt/.md file under `path` (or `path` itself), in sorted order.
+
+    The id is the file's path relative to the directory, so re-syncing the
+    same tree updates documents in place.
+    """
+    if os.path.isfile(path):
+        root, files = os.path.dirname(path), [path]
+    else:
+        root, files = path, _walk(path, extensions)
+    for file_path in files:
+        with open(file_path, "r", encoding="utf-8-sig", errors="replace") as f:
+            content = f.read().strip()
+        if not content:
+            continue
+        rel = os.path.relpath(file_path, root).replace(os.sep, "/")
+        metadata = {"source": rel, "format": os.path.splitext(file_path)[1].lower().lstrip(".")}
+        title = _markdown_title(content) if metadata["format"] == "md" else None
+        if title:
+            metadata["title"] = title
+        yield {"id": rel, "content": content, "metadata": metadata}
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Consecutive lists of up to `size` items."""
+    it = iter(items)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+class _Reader:
+    __slots__ = ("f", "read_size", "buf", "pos")
+
+    def __init__(self, f, read_size: int):
+        self.f = f
+        self.read_size = read_size
+        self.buf = ""
+        self.pos = 0
+
+    def more(self) -> bool:
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-whitespace character ("" at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def decode(self, decoder: json.JSONDecoder) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # a number ending at the buffer edge may continue in the next read
+            if end == len(self.buf) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def _documents(values: Iterable[Any], path: str) -> Iterator[Dict[str, Any]]:
+    for i, value in enumerate(values):
+        if not isinstance(value, dict):
+            raise ValueError(f"{path}: document {i} is a {type(value).__name__}, expected an object")
+        yield value
+
+
+def _walk(root: str, extensions: Tuple[str, ...]) -> Iterator[str]:
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if name.lower().endswith(extensions):
+                yield os.path.join(dirpath, name)
+
+
+def _markdown_title(content: str) -> Optional[str]:
+    for line in content.splitlines():
+        if line.startswith("# "):
+            return line[2:].strip()
+        if line.strip():
+            return None
+    return None
@@ -0,0 +1,38 @@
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Small English stopword list; enough to keep BM25 postings and tsquery terms
+# focused on content words without pulling in an NLP dependency.
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have if in into is it its of on or
+such that the their then there these they this to was were will with what
+when where which who why how do does should can could would i we you our
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens, the same split used everywhere in retrieval."""
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+def query_terms(text: str, min_len: int = 3) -> List[str]:
+    """Distinct content terms of a query, in first-seen order."""
+    seen = []
+    for tok in tokenize(text):
+        if len(tok) >= min_len and tok not in STOPWORDS and tok not in seen:
+            seen.append(tok)
+    return seen
+
+
+def term_frequencies(text: str) -> Dict[str, int]:
+    """Token counts of a text; persisted at ingest so queries never re-tokenize."""
+    return dict(Counter(tokenize(text)))
+
+
+def doc_terms(doc: Dict) -> Dict[str, int]:
+    """Precomputed term frequencies of a document, or computed on the fly for legacy rows."""
+    terms: Optional[Dict[str, int]] = doc.get("terms")
+    return terms if terms is not None else term_frequencies(doc.get("content", ""))
@@ -1,8 +1,17 @@
 import os
-import requests
-from typing import List
+import asyncio
+import httpx
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+from typing import AsyncIterator, Callable, List, Optional
 import time
 
+from .singleflight import SingleFlight
+from .scheduler import get_scheduler, usage_tokens
+from .prompt import estimate_tokens
+
 # Use Google AI Studio API key (Gemini API)
 API_KEY = os.environ.get("VITE_GEMINI_API_KEY") or os.environ.get("VERTEX_API_KEY")  # Support both env var names
 
@@ -10,32 +19,164 @@ if not API_KEY:
     # don't raise here; allow code to provide clearer error later
     pass
 
-def _post(url, json_body, max_retries=3):
+# Pooled HTTP clients (one sync, one async per event loop), reused across calls
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("RAG_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("RAG_HTTP_READ_TIMEOUT", "60"))
+# Upper bound on one attempt, from sending the request to the last byte of the response
+HTTP_TOTAL_TIMEOUT = float(os.environ.get("RAG_HTTP_TOTAL_TIMEOUT", "120"))
+HTTP2 = os.environ.get("RAG_HTTP2", "0") == "1"
+HTTP_MAX_CONNECTIONS = int(os.environ.get("RAG_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("RAG_HTTP_MAX_KEEPALIVE", "10"))
+
+# Concurrent identical embedding requests share one upstream call
+_embed_flight = SingleFlight("embed_text")
+
+# Batch embedding: the batchEmbedContents endpoint accepts up to 100 texts
+EMBED_BATCH_SIZE = int(os.environ.get("RAG_EMBED_BATCH_SIZE", "100"))
+EMBED_CONCURRENCY = int(os.environ.get("RAG_EMBED_CONCURRENCY", "4"))
+
+
+class AdaptiveBackoff:
+    """Delay shared by concurrent callers: grows on 429s, decays on success.
+
+    One worker hitting the rate limit slows every worker down, instead of each
+    hammering the API with its own fixed retry schedule.
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0, factor: float = 2.0, decay: float = 0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.decay = decay
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def penalize(self) -> float:
+        with self._lock:
+            self.delay = min(self.maximum, max(self.initial, self.delay * self.factor))
+            return self.delay
+
+    def reward(self):
+        with self._lock:
+            self.delay = self.delay * self.decay if self.delay >= 0.1 else 0.0
+
+
+# Long-lived clients: connections and TLS sessions are kept alive between calls
+_client = None
+_client_lock = threading.Lock()
+# One AsyncClient per event loop: its connections are bound to the loop that opened them
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+def _client_options():
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401 -- httpx needs it for HTTP/2
+        except ImportError:
+            print("RAG_HTTP2=1 but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+    return {
+        "http2": http2,
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+    }
+
+def _get_client() -> httpx.Client:
+    global _client
+    with _client_lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(**_client_options())
+        return _client
+
+def _get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            _prune_async_clients()
+            client = _async_clients[loop] = httpx.AsyncClient(**_client_options())
+        return client
+
+def _prune_async_clients():
+    """Forget clients whose loop has closed (e.g. after asyncio.run).
+
+    A closed loop can't run aclose(); dropping the last reference lets the
+    client's sockets be collected instead of piling up across loops.
+    """
+    for loop in [loop for loop in _async_clients if loop.is_closed()]:
+        del _async_clients[loop]
+
+def _check_deadline(deadline: float):
+    if time.monotonic() > deadline:
+        raise httpx.TimeoutException(f"No complete response within {HTTP_TOTAL_TIMEOUT}s")
+
+def _post(url, json_body, max_retries=3, backoff: Optional[AdaptiveBackoff] = None,
+          tokens: float = 0, priority: Optional[str] = None):
+    """POST with retries; every attempt waits for a permit from the shared scheduler."""
     headers = {"Content-Type": "application/json"}
+    scheduler = get_scheduler()
     for attempt in range(max_retries + 1):
         try:
-            resp = requests.post(url, json=json_body, headers=headers, timeout=60)
-            if resp.status_code == 429:  # Rate limited
-                if attempt < max_retries:
-                    wait_time = (2 ** attempt) + 1  # Exponential backoff: 2, 5, 9 seconds
-                    print(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}...")
-                    time.sleep(wait_time)
-                    continue
-            resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.RequestException as e:
+            if backoff:
+                backoff.wait()
+            permit = scheduler.acquire(tokens, priority)
+            deadline = time.monotonic() + HTTP_TOTAL_TIMEOUT
+            with _get_client().stream("POST", url, json=json_body, headers=headers) as resp:
+                if resp.status_code == 429:  # Rate limited
+                    if attempt < max_retries:
+                        if backoff:
+                            wait_time = backoff.penalize()
+                            print(f"Rate limited, backing off to {wait_time:.1f}s before retry {attempt + 1}/{max_retries}...")
+                        else:
+                            wait_time = (2 ** attempt) + 1  # Exponential backoff: 2, 5, 9 seconds
+                            print(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}...")
+                        # every caller holds off, not just this one
+                        scheduler.penalize(wait_time)
+                        continue
+                resp.raise_for_status()
+                chunks = []
+                for chunk in resp.iter_bytes():
+                    _check_deadline(deadline)
+                    chunks.append(chunk)
+            if backoff:
+                backoff.reward()
+            data = json.loads(b"".join(chunks))
+            permit.settle(usage_tokens(data))
+            return data
+        except httpx.HTTPError as e:
             if attempt < max_retries:
                 wait_time = (2 ** attempt) + 1
                 print(f"Request failed, retrying in {wait_time}s... ({e})")
                 time.sleep(wait_time)
-            else:
+            elif isinstance(e, httpx.HTTPStatusError):
                 raise
+            else:
+                raise RuntimeError(f"Connection to Gemini failed (max retries exceeded): {e!r}") from e
 
-def embed_text(text: str, model: str = "text-embedding-004") -> List[float]:
-    """Call Google AI Studio embedding endpoint. Returns list of floats."""
+def is_unavailable_error(error: BaseException) -> bool:
+    """True if `error` (or its cause) means Gemini couldn't be reached or rate limited us.
+
+    Covers httpx transport errors (DNS, connect, TLS, timeouts) and 429s,
+    including when wrapped by `_post` / `_apost` after their last retry.
+    """
+    while error is not None:
+        if isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError)):
+            return True
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+            return True
+        error = error.__cause__
+    return False
+
+def _require_api_key():
     if not API_KEY:
         raise RuntimeError("VITE_GEMINI_API_KEY or VERTEX_API_KEY must be set in environment (Google AI Studio API key)")
 
+def _embed_request(text: str, model: str):
     url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:embedContent?key={API_KEY}"
     body = {
         "model": f"models/{model}",
@@ -43,19 +184,146 @@ def embed_text(text: str, model: str = "text-embedding-004") -> List[float]:
             "parts": [{"text": text}]
         }
     }
-    data = _post(url, body)
+    return url, body
+
+def _parse_embedding(data) -> List[float]:
     # expected shape: { "embedding": {"values": [...]} }
     emb = data.get("embedding", {}).get("values")
     if not emb:
         raise RuntimeError(f"No embedding in response: {data}")
     return emb
 
-def generate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature: float = 0.2, max_output_tokens: int = 512) -> str:
-    """Call Google AI Studio generation endpoint. Returns generated text."""
-    if not API_KEY:
-        raise RuntimeError("VITE_GEMINI_API_KEY or VERTEX_API_KEY must be set in environment (Google AI Studio API key)")
+def embed_text(text: str, model: str = "text-embedding-004") -> List[float]:
+    """Call Google AI Studio embedding endpoint. Returns list of floats.
+
+    Concurrent calls for the same text share one request.
+    """
+    _require_api_key()
+    return _embed_flight.do((model, text), _embed_one, text, model)
+
+def _embed_one(text: str, model: str) -> List[float]:
+    url, body = _embed_request(text, model)
+    return _parse_embedding(_post(url, body, tokens=estimate_tokens(text)))
+
+def _embed_batch(texts: List[str], model: str, backoff: Optional[AdaptiveBackoff] = None,
+                 priority: str = "batch") -> List[List[float]]:
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:batchEmbedContents?key={API_KEY}"
+    body = {
+        "requests": [
+            {"model": f"models/{model}", "content": {"parts": [{"text": t}]}}
+            for t in texts
+        ]
+    }
+    data = _post(url, body, backoff=backoff, tokens=sum(estimate_tokens(t) for t in texts), priority=priority)
+    # expected shape: { "embeddings": [{"values": [...]}, ...] }
+    embeddings = [e.get("values") for e in data.get("embeddings", [])]
+    if len(embeddings) != len(texts) or not all(embeddings):
+        raise RuntimeError(f"Batch embedding returned {len(embeddings)} vectors for {len(texts)} texts")
+    return embeddings
+
+def embed_texts(
+    texts: List[str],
+    model: str = "text-embedding-004",
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    on_progress: Optional[Callable[[int, int, int], None]] = None,
+    return_exceptions: bool = False,
+) -> List:
+    """Embed many texts via the batch endpoint, running batches concurrently.
+
+    Results are returned in input order. `on_progress(batches_done, batches_total,
+    texts_done)` is called as each batch finishes. With `return_exceptions=True`
+    a failed batch yields its exception in place of each of its embeddings
+    instead of aborting the whole call. Batches run at "batch" priority in
+    the shared scheduler, behind interactive queries.
+    """
+    _require_api_key()
+    if not texts:
+        return []
+
+    batch_size = max(1, min(batch_size or EMBED_BATCH_SIZE, 100))
+    concurrency = max(1, concurrency or EMBED_CONCURRENCY)
+    batches = [(start, texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+    results: List = [None] * len(texts)
+    backoff = AdaptiveBackoff()
+    done_batches = 0
+    done_texts = 0
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as pool:
+        futures = {pool.submit(_embed_batch, batch, model, backoff): (start, batch) for start, batch in batches}
+        for fut in as_completed(futures):
+            start, batch = futures[fut]
+            try:
+                embeddings = fut.result()
+            except Exception as e:
+                if not return_exceptions:
+                    for other in futures:
+                        other.cancel()
+                    raise
+                embeddings = [e] * len(batch)
+            results[start:start + len(batch)] = embeddings
+            done_batches += 1
+            done_texts += len(batch)
+            if on_progress:
+                on_progress(done_batches, len(batches), done_texts)
+    return results
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={API_KEY}"
+class Embedder:
+    """Text -> vector backend. `get_embedder(name)` returns a shared instance.
+
+    Built in: "gemini" (Google AI Studio API) and "local" (offline hashed
+    character n-gram TF-IDF, see rag.local_embed). Others can be added with
+    `register_embedder`.
+    """
+
+    name = "base"
+
+    def embed(self, text: str) -> List[float]:
+        raise NotImplementedError
+
+    def embed_many(self, texts: List[str]):
+        return [self.embed(t) for t in texts]
+
+
+class GeminiEmbedder(Embedder):
+    name = "gemini"
+
+    def __init__(self, model: str = "text-embedding-004"):
+        self.model = model
+
+    def embed(self, text: str) -> List[float]:
+        return embed_text(text, model=self.model)
+
+    def embed_many(self, texts: List[str]):
+        return embed_texts(texts, model=self.model)
+
+
+def _local_embedder():
+    from .local_embed import HashedNgramEmbedder
+    return HashedNgramEmbedder()
+
+# Query-side embedder: "gemini" (falls back to "local" when the API fails) or "local" (never calls the API)
+EMBEDDER = os.environ.get("RAG_EMBEDDER", "gemini").lower()
+_embedder_factories = {"gemini": GeminiEmbedder, "local": _local_embedder}
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+def register_embedder(name: str, factory: Callable[[], Embedder]):
+    with _embedders_lock:
+        _embedder_factories[name] = factory
+        _embedders.pop(name, None)
+
+def get_embedder(name: Optional[str] = None) -> Embedder:
+    name = (name or EMBEDDER).lower()
+    with _embedders_lock:
+        if name not in _embedders:
+            if name not in _embedder_factories:
+                raise ValueError(f"Unknown embedder {name!r}; registered: {sorted(_embedder_factories)}")
+            _embedders[name] = _embedder_factories[name]()
+        return _embedders[name]
+
+def _generate_request(prompt: str, model: str, temperature: float, max_output_tokens: int, method: str = "generateContent"):
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:{method}?key={API_KEY}"
     body = {
         "contents": [{
             "parts": [{"text": prompt}]
@@ -65,7 +333,9 @@ def generate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature:
             "maxOutputTokens": max_output_tokens
         }
     }
-    data = _post(url, body)
+    return url, body
+
+def _parse_generation(data) -> str:
     # expected shape: { "candidates": [{"content": {"parts": [{"text": "..."}]}}] }
     candidates = data.get("candidates")
     if not candidates:
@@ -79,3 +349,140 @@ def generate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature:
         return parts[0]["text"]
     
     raise RuntimeError(f"Could not extract text from response: {data}")
+
+def generate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature: float = 0.2, max_output_tokens: int = 512) -> str:
+    """Call Google AI Studio generation endpoint. Returns generated text."""
+    _require_api_key()
+    url, body = _generate_request(prompt, model, temperature, max_output_tokens)
+    return _parse_generation(_post(url, body, tokens=estimate_tokens(prompt) + max_output_tokens))
+
+
+# ---------------------------------------------------------------------------
+# Async variants: same endpoints over a pooled httpx.AsyncClient, so callers
+# on an event loop (FastAPI routes) never block it while waiting on Gemini.
+# ---------------------------------------------------------------------------
+
+async def _apost(url, json_body, max_retries=3, tokens: float = 0, priority: Optional[str] = None):
+    client = _get_async_client()
+    scheduler = get_scheduler()
+    for attempt in range(max_retries + 1):
+        try:
+            permit = await scheduler.aacquire(tokens, priority)
+            try:
+                resp = await asyncio.wait_for(client.post(url, json=json_body), HTTP_TOTAL_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                raise httpx.TimeoutException(f"No complete response within {HTTP_TOTAL_TIMEOUT}s") from e
+            if resp.status_code == 429 and attempt < max_retries:  # Rate limited
+                wait_time = (2 ** attempt) + 1
+                print(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}...")
+                scheduler.penalize(wait_time)
+                continue
+            resp.raise_for_status()
+            data = resp.json()
+            permit.settle(usage_tokens(data))
+            return data
+        except httpx.HTTPStatusError:
+            raise
+        except httpx.HTTPError as e:
+            if attempt < max_retries:
+                wait_time = (2 ** attempt) + 1
+                print(f"Request failed, retrying in {wait_time}s... ({e!r})")
+                await asyncio.sleep(wait_time)
+            else:
+                raise RuntimeError(f"Connection to Gemini failed (max retries exceeded): {e!r}") from e
+
+async def aembed_text(text: str, model: str = "text-embedding-004") -> List[float]:
+    """Async version of embed_text."""
+    _require_api_key()
+    return await _embed_flight.ado((model, text), _aembed_one, text, model)
+
+async def _aembed_one(text: str, model: str) -> List[float]:
+    url, body = _embed_request(text, model)
+    return _parse_embedding(await _apost(url, body, tokens=estimate_tokens(text)))
+
+async def agenerate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature: float = 0.2, max_output_tokens: int = 512) -> str:
+    """Async version of generate_text."""
+    _require_api_key()
+    url, body = _generate_request(prompt, model, temperature, max_output_tokens)
+    return _parse_generation(await _apost(url, body, tokens=estimate_tokens(prompt) + max_output_tokens))
+
+def _parse_stream_chunk(data) -> str:
+    # each SSE event carries a partial candidate; the last one may only hold finishReason
+    parts = ((data.get("candidates") or [{}])[0].get("content") or {}).get("parts") or []
+    return "".join(p.get("text", "") for p in parts)
+
+async def astream_generate_text(prompt: str, model: str = "gemini-2.0-flash-exp", temperature: float = 0.2, max_output_tokens: int = 512, max_retries: int = 3) -> AsyncIterator[str]:
+    """Stream generated text via streamGenerateContent (SSE), yielding pieces as they arrive.
+
+    Rate limits and connection errors are retried only before the first piece
+    is yielded. Closing the generator (e.g. the HTTP client went away) closes
+    the upstream stream too.
+    """
+    _require_api_key()
+    url, body = _generate_request(prompt, model, temperature, max_output_tokens, method="streamGenerateContent")
+    url += "&alt=sse"
+    client = _get_async_client()
+    scheduler = get_scheduler()
+    started = False
+    for attempt in range(max_retries + 1):
+        try:
+            permit = await scheduler.aacquire(estimate_tokens(prompt) + max_output_tokens)
+            deadline = time.monotonic() + HTTP_TOTAL_TIMEOUT
+            async with client.stream("POST", url, json=body) as resp:
+                if resp.status_code == 429 and attempt < max_retries:  # Rate limited
+                    wait_time = (2 ** attempt) + 1
+                    print(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}/{max_retries}...")
+                    scheduler.penalize(wait_time)
+                    continue
+                if resp.is_error:
+                    await resp.aread()
+                resp.raise_for_status()
+                usage = None
+                async for line in resp.aiter_lines():
+                    _check_deadline(deadline)
+                    if not line.startswith("data:"):
+                        continue
+                    data = json.loads(line[5:].strip())
+                    usage = usage_tokens(data) or usage
+                    text = _parse_stream_chunk(data)
+                    if text:
+                        started = True
+                        yield text
+                permit.settle(usage)
+                return
+        except httpx.HTTPStatusError:
+            raise
+        except httpx.HTTPError as e:
+            if attempt < max_retries and not started:
+                wait_time = (2 ** attempt) + 1
+                print(f"Request failed, retrying in {wait_time}s... ({e!r})")
+                await asyncio.sleep(wait_time)
+            else:
+                raise RuntimeError(f"Connection to Gemini failed (max retries exceeded): {e!r}") from e
+
+def close_clients():
+    """Close the pooled sync HTTP client."""
+    global _client
+    with _client_lock:
+        if _client is not None and not _client.is_closed:
+            _client.close()
+        _client = None
+
+async def aclose_clients():
+    """Close the pooled async and sync HTTP clients (call on app shutdown).
+
+    The running loop's client is closed here; clients of other loops that
+    are still running are closed on their own loop.
+    """
+    current = asyncio.get_running_loop()
+    with _client_lock:
+        clients = list(_async_clients.items())
+        _async_clients.clear()
+    for loop, client in clients:
+        if client.is_closed:
+            continue
+        if loop is current:
+            await client.aclose()
+        elif loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    close_clients()
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+QUEUE_WORKERS = int(os.environ.get("RAG_QUEUE_WORKERS", "1"))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("RAG_QUEUE_MAX_ATTEMPTS", "5"))
+QUEUE_RETRY_BASE = float(os.environ.get("RAG_QUEUE_RETRY_BASE", "5"))
+QUEUE_RETRY_MAX = float(os.environ.get("RAG_QUEUE_RETRY_MAX", "600"))
+# Claims older than this are assumed to belong to a crashed worker and requeued
+QUEUE_CLAIM_TIMEOUT = float(os.environ.get("RAG_QUEUE_CLAIM_TIMEOUT", "900"))
+
+# process_batch([(file name, document), ...]) -> {file name: error or None}
+BatchProcessor = Callable[[List[Tuple[str, Dict[str, Any]]]], Dict[str, Optional[str]]]
+
+
+class QueueProcessor:
+    """Drains a directory of queued JSON documents with a pool of workers.
+
+    A worker claims a file by atomically renaming it into ``processing/``, so
+    any number of threads and processes can share one queue. A failed file
+    goes back to the queue with its attempt count and errors recorded in the
+    document, and its mtime set to the time it may be retried (claimers skip
+    files whose mtime is in the future). After ``max_attempts`` failures, or
+    if it is not valid JSON, it is moved to ``dead-letter/``. Run progress is
+    checkpointed to ``checkpoints/<run id>.json``.
+    """
+
+    def __init__(self, process_batch: BatchProcessor, queue_dir: str,
+                 workers: int = QUEUE_WORKERS, batch_files: int = 100,
+                 max_attempts: int = QUEUE_MAX_ATTEMPTS, retry_base: float = QUEUE_RETRY_BASE,
+                 retry_max: float = QUEUE_RETRY_MAX, claim_timeout: float = QUEUE_CLAIM_TIMEOUT,
+                 wait_for_retries: bool = True):
+        self.process_batch = process_batch
+        self.queue_dir = queue_dir
+        self.processing_dir = os.path.join(queue_dir, "processing")
+        self.dead_letter_dir = os.path.join(queue_dir, "dead-letter")
+        self.checkpoint_dir = os.path.join(queue_dir, "checkpoints")
+        for d in (self.queue_dir, self.processing_dir, self.dead_letter_dir, self.checkpoint_dir):
+            os.makedirs(d, exist_ok=True)
+
+        self.workers = max(1, workers)
+        self.batch_files = max(1, batch_files)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.claim_timeout = claim_timeout
+        self.wait_for_retries = wait_for_retries
+
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.token = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.checkpoint_path = os.path.join(self.checkpoint_dir, f"{self.run_id}.json")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started_at = time.time()
+        self.stats = {"completed": 0, "retried": 0, "dead_lettered": 0, "recovered": 0, "batches": 0}
+        self._last_file = None
+
+    def run(self) -> Dict[str, Any]:
+        """Process until the queue is empty (including pending retries unless disabled)."""
+        self.recover_stale_claims()
+        self._checkpoint("running")
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rag-queue") as pool:
+                for fut in [pool.submit(self._work) for _ in range(self.workers)]:
+                    fut.result()
+        except BaseException:
+            self._checkpoint("aborted")
+            raise
+        self._checkpoint("stopped" if self._stop.is_set() else "finished")
+        return dict(self.stats)
+
+    def stop(self):
+        """Let workers finish their current batch, then exit."""
+        self._stop.set()
+
+    def claim(self, limit: int) -> List[Tuple[str, str]]:
+        """Claim up to `limit` due files; returns (queue file name, claimed path) pairs."""
+        now = time.time()
+        claimed = []
+        for name in sorted(os.listdir(self.queue_dir)):
+            if len(claimed) >= limit:
+                break
+            if not name.endswith(".json"):
+                continue
+            src = os.path.join(self.queue_dir, name)
+            dst = os.path.join(self.processing_dir, f"{name}.{self.token}")
+            try:
+                if os.stat(src).st_mtime > now:
+                    continue  # backing off after a failure
+                os.rename(src, dst)
+                # claim time, used to detect claims abandoned by a crashed worker
+                os.utime(dst, None)
+            except FileNotFoundError:
+                continue  # another worker claimed it first
+            claimed.append((name, dst))
+        return claimed
+
+    def recover_stale_claims(self) -> int:
+        """Return claims older than the claim timeout to the queue."""
+        cutoff = time.time() - self.claim_timeout
+        recovered = 0
+        for claim in os.listdir(self.processing_dir):
+            path = os.path.join(self.processing_dir, claim)
+            name = claim.split(".json.", 1)[0] + ".json"
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                os.rename(path, os.path.join(self.queue_dir, name))
+            except FileNotFoundError:
+                continue
+            recovered += 1
+        if recovered:
+            print(f"Requeued {recovered} files abandoned by a previous worker")
+        with self._lock:
+            self.stats["recovered"] += recovered
+        return recovered
+
+    def _work(self):
+        while not self._stop.is_set():
+            claimed = self.claim(self.batch_files)
+            if claimed:
+                self._process(claimed)
+                continue
+            wait = self._next_due()
+            if wait is None or not self.wait_for_retries:
+                return
+            self._stop.wait(min(wait, self.retry_max))
+
+    def _next_due(self) -> Optional[float]:
+        """Seconds until the earliest queued file may be retried, None if the queue is empty."""
+        due = None
+        now = time.time()
+        for name in os.listdir(self.queue_dir):
+            if name.endswith(".json"):
+                try:
+                    wait = max(0.0, os.stat(os.path.join(self.queue_dir, name)).st_mtime - now)
+                except FileNotFoundError:
+                    continue
+                due = wait if due is None else min(due, wait)
+        return due
+
+    def _process(self, claimed: List[Tuple[str, str]]):
+        items, paths = [], {}
+        for name, path in claimed:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    doc = json.load(f)
+                if not isinstance(doc, dict):
+                    raise ValueError("queued document must be a JSON object")
+            except (ValueError, UnicodeDecodeError) as e:
+                self._dead_letter(name, path, None, f"invalid document: {e}")
+                continue
+            items.append((name, doc))
+            paths[name] = path
+        if not items:
+            return
+
+        try:
+            errors = self.process_batch(items)
+        except Exception as e:
+            errors = {name: str(e) for name, _ in items}
+
+        for name, doc in items:
+            error = errors.get(name)
+            if error is None:
+                os.remove(paths[name])
+                with self._lock:
+                    self.stats["completed"] += 1
+                    self._last_file = name
+            else:
+                self._retry_or_dead_letter(name, paths[name], doc, error)
+        with self._lock:
+            self.stats["batches"] += 1
+        self._checkpoint("running")
+
+    def _retry_or_dead_letter(self, name: str, path: str, doc: Dict[str, Any], error: str):
+        attempts = int(doc.get("_attempts", 0)) + 1
+        doc = dict(doc, _attempts=attempts, _errors=(doc.get("_errors") or [])[-(self.max_attempts - 1):] + [error])
+        if attempts >= self.max_attempts:
+            self._dead_letter(name, path, doc, error)
+            return
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        _write_json(path, doc)
+        not_before = time.time() + delay
+        os.utime(path, (not_before, not_before))
+        os.rename(path, os.path.join(self.queue_dir, name))
+        with self._lock:
+            self.stats["retried"] += 1
+        print(f"Failed to process {name} (attempt {attempts}/{self.max_attempts}), retrying in {delay:.0f}s: {error}")
+
+    def _dead_letter(self, name: str, path: str, doc: Optional[Dict[str, Any]], error: str):
+        if doc is not None:
+            _write_json(path, doc)
+        dst = os.path.join(self.dead_letter_dir, name)
+        if os.path.exists(dst):
+            dst = os.path.join(self.dead_letter_dir, f"{name[:-5]}-{uuid.uuid4().hex[:8]}.json")
+        os.rename(path, dst)
+        with self._lock:
+            self.stats["dead_lettered"] += 1
+        print(f"Moved {name} to dead-letter: {error}")
+
+    def _checkpoint(self, status: str):
+        with self._lock:
+            data = dict(
+                self.stats,
+                run_id=self.run_id,
+                worker=self.token,
+                workers=self.workers,
+                status=status,
+                last_file=self._last_file,
+                started_at=self._started_at,
+                updated_at=time.time(),
+            )
+            _write_json(self.checkpoint_path, data, atomic=True)
+
+
+def _write_json(path: str, data: Dict[str, Any], atomic: bool = False):
+    target = path + ".tmp" if atomic else path
+    with open(target, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    if atomic:
+        os.replace(target, path)